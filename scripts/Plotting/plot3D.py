@@ -1,12 +1,16 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
-import h5py
 import os
 from stl import mesh
 import yaml
+import sys
 from matplotlib.colors import LinearSegmentedColormap
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from profiling import profilerFromArguments
+from reservoirSampling import sampleRows
+
 '''
 Author: Simon Lavoie
 simon.lavoie@mail.mcgill.ca
@@ -22,39 +26,52 @@ if it was present when the simulation was run).
 Photon positions are plotted on a color gradient from white to red to black based
 on when they were generated.
 Source origins are plotted as black "X's".
+At most PointBudget photons and origins are drawn: they are a uniform random sample of the
+run, drawn chunk by chunk without loading every position, which keeps the order in which
+they were generated. Run with --points <N> to change the budget.
+Run with --profile to record the time and memory spent in each phase.
 
 '''
+Profiler = profilerFromArguments("plot3D")
+
+# Largest number of photons (and origins) scattered on the geometry
+PointBudget = 100000
+if "--points" in sys.argv:
+    index = sys.argv.index("--points")
+    PointBudget = int(sys.argv[index + 1])
+    del sys.argv[index:index + 2]
+
 # Yaml card to know what geometry is relevant
 yaml_card = "/home/slavoie/LoLX/chroma-simulation/Yaml/LoLX/LoLX.yaml"
 
 file_path = input("Enter path of file to visualize: ")
 
-with h5py.File(file_path, 'r') as hdf:
-    FinalPostitionGroup = hdf.get("FinalPosition")
-    FinalPosition = np.array(FinalPostitionGroup.get("FinalPosition"))
-    x_finalPos = FinalPosition[:, 0]
-    y_finalPos = FinalPosition[:, 1]
-    z_finalPos = FinalPosition[:, 2]
-    OriginGroup = hdf.get("Origin")
-    Origins = np.array(OriginGroup.get("Origin"))
+Profiler.begin("load")
+PhotonIndices, FinalPosition, TotalPhotons = sampleRows(file_path, "FinalPosition", PointBudget)
+x_finalPos = FinalPosition[:, 0]
+y_finalPos = FinalPosition[:, 1]
+z_finalPos = FinalPosition[:, 2]
+_, Origins, _ = sampleRows(file_path, "Origin", PointBudget)
 
 # Create a figure and a 3D axis
+Profiler.begin("render")
 fig = plt.figure()
 ax = fig.add_subplot(111, projection='3d')
 
-# Define a custom colormap from white to red to black
-colors = np.linspace(0, 1, len(x_finalPos))
+# Define a custom colormap from white to red to black, following the position of the
+# sampled photons among all photons generated
+colors = PhotonIndices / max(TotalPhotons - 1, 1)
 cmap = LinearSegmentedColormap.from_list('CustomColormap', ['white', 'red', 'black'])
 
 # Plot the final positions with the color gradient
-#sc = ax.scatter(x_finalPos, y_finalPos, z_finalPos, c=colors, cmap=cmap, marker='o', label="FinalPosition")
+sc = ax.scatter(x_finalPos, y_finalPos, z_finalPos, c=colors, cmap=cmap, vmin=0, vmax=1, marker='o', s=1, label="FinalPosition")
 
 # Plot the origin as a black 'x'
 ax.scatter(Origins[:, 0], Origins[:, 1], Origins[:, 2], c='lime', marker='x', label="Origin")
 
 # Set colorbar properties
-#cbar = plt.colorbar(sc, ax=ax)
-#cbar.set_label('Earliest to Latest Photon')
+cbar = plt.colorbar(sc, ax=ax)
+cbar.set_label('Earliest to Latest Photon')
 
 # Keep track of largest points to plot to scale axes later
 Largest_x = 0
@@ -90,15 +107,9 @@ with open(yaml_card, "r") as yaml_card:
                 y = vertices[:, 1]
                 z = vertices[:, 2]
 
-                for i in range(len(x)):
-                    if x[i] > Largest_x:
-                        Largest_x = x[i]
-                    
-                    if y[i] > Largest_y:
-                        Largest_y = y[i]
-                    
-                    if z[i] > Largest_z:
-                        Largest_z = z[i]
+                Largest_x = max(Largest_x, np.max(x))
+                Largest_y = max(Largest_y, np.max(y))
+                Largest_z = max(Largest_z, np.max(z))
 
                 # Assign colors based on file index
                 if filename == "Sphere.stl":
@@ -166,5 +177,6 @@ ax.set_zlabel('Z')
 ax.set_title('STL Files Reconstruction')
 
 plt.legend(loc="lower left")
+Profiler.end(draw_figures=True)
 # Show the plot
 plt.show()
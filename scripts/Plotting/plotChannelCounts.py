@@ -2,9 +2,18 @@ import numpy as np
 import h5py
 import pandas as pd
 import matplotlib.pyplot as plt
+import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from profiling import profilerFromArguments
+from simulationData import channelCounts, NumChannels
+
+# Run with --profile to record the time and memory spent in each phase
+Profiler = profilerFromArguments("plotChannelCounts")
+
 def plotChannelCounts(file_path):
+    Profiler.begin("load")
     with h5py.File(file_path, 'r') as hdf:
         # dictionary to store the extracted data
         extracted_data = {}
@@ -21,16 +30,17 @@ def plotChannelCounts(file_path):
         ChannelCharges = extracted_data['ChannelCharges']
         ChannelIDs = extracted_data['ChannelIDs']
 
-    SortedChannelCharges = np.zeros(720)
-    for i in range(len(ChannelIDs)):
-        SortedChannelCharges[ChannelIDs[i]] += ChannelCharges[i]
+    Profiler.begin("compute")
+    SortedChannelCharges = channelCounts(ChannelIDs, ChannelCharges, NumChannels)
 
-    SortedChannelIDs = np.arange(720)
+    SortedChannelIDs = np.arange(NumChannels)
 
+    Profiler.begin("render")
     plt.bar(SortedChannelIDs, SortedChannelCharges, color="black")
     plt.title("Bar Chart of Photon Count Over Channel IDs")
     plt.xlabel("Channel ID")
     plt.ylabel("Photon Count")
+    Profiler.end(draw_figures=True)
     plt.show()
 
 def read_file(file_path):
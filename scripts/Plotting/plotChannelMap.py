@@ -0,0 +1,89 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import Normalize
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from channelGeometry import loadChannelGeometry, channelPolygons
+from channelMatrix import loadChannelMatrix, channelTotals
+from profiling import profilerFromArguments
+
+'''
+Paints the total charge of every channel of a run onto the unwrapped detector surface.
+
+Where plotDetectedPhotons and plotLoLXLightMap bin every DetectedPos, this script only needs
+one value per channel: the channel totals of the run's channel matrix (channelMatrix.py,
+built on the first use and cached next to the run), drawn on the polygons of a channel
+geometry table built once per detector with Utilities/channelGeometry.py. Drawing a run
+therefore costs the same whatever its number of photons.
+
+Intended use case: python3 plotChannelMap.py <GEOMETRY> <PATH> [--per-event]
+where <GEOMETRY> is the .channelgeometry.npz of the detector. --per-event draws the mean
+charge per event instead of the total. Add --profile to record the time and memory spent
+in each phase.
+'''
+
+Profiler = profilerFromArguments("plotChannelMap")
+
+def plotChannelMap(geometry_path, file_path, per_event=False):
+    Profiler.begin("load")
+    Table = loadChannelGeometry(geometry_path)
+    Matrix = loadChannelMatrix(file_path)
+
+    Profiler.begin("compute")
+    Totals = channelTotals(Matrix)
+    if per_event:
+        Totals = Totals / max(Matrix.shape[0], 1)
+    ChannelIDs = Table["ChannelIDs"]
+    Values = np.zeros(len(ChannelIDs))
+    Known = ChannelIDs < len(Totals)
+    Values[Known] = Totals[ChannelIDs[Known]]
+    Unplaced = np.setdiff1d(np.flatnonzero(Totals), ChannelIDs)
+    if len(Unplaced) > 0:
+        print(f"{len(Unplaced)} channels with charge are not in the channel geometry and are not drawn "
+              f"({np.sum(Totals[Unplaced]) / np.sum(Totals):.2%} of the charge).")
+
+    Profiler.begin("render")
+    Polygons = channelPolygons(Table)
+    Panels = np.unique(Table["Panels"])
+    num_columns = min(len(Panels), 3)
+    num_rows = -(-len(Panels) // num_columns)
+    fig, axes = plt.subplots(num_rows, num_columns, figsize=(4 * num_columns, 4 * num_rows), squeeze=False)
+    norm = Normalize(vmin=0, vmax=max(np.max(Values), 1e-30))
+
+    for ax, panel in zip(axes.ravel(), Panels):
+        OnPanel = np.flatnonzero(Table["Panels"] == panel)
+        collection = PolyCollection([Polygons[index] for index in OnPanel], array=Values[OnPanel], cmap='plasma',
+                                    norm=norm, edgecolors='black', linewidths=0.2)
+        ax.add_collection(collection)
+        u_min, u_max, v_min, v_max = Table["PanelExtents"][panel]
+        ax.set_xlim(u_min, u_max)
+        ax.set_ylim(v_min, v_max)
+        ax.set_aspect('equal')
+        ax.set_title(Table["PanelNames"][panel])
+        ax.set_xlabel('Location (mm)')
+        ax.set_ylabel('Location (mm)')
+    for ax in axes.ravel()[len(Panels):]:
+        ax.axis('off')
+
+    fig.suptitle(f"{os.path.basename(file_path)}: {format(int(np.sum(Totals)), ',')} total charge over {len(ChannelIDs)} channels")
+    cbar = fig.colorbar(plt.cm.ScalarMappable(norm=norm, cmap='plasma'), ax=axes.ravel().tolist())
+    cbar.set_label('Mean Charge per Event' if per_event else 'Total Charge')
+    Profiler.end(draw_figures=True)
+    plt.show()
+
+
+if __name__ == '__main__':
+    per_event = "--per-event" in sys.argv
+    arguments = [argument for argument in sys.argv[1:] if argument != "--per-event"]
+    if len(arguments) < 2:
+        print("Please provide a channel geometry and a file path as arguments.")
+    else:
+        geometry_path = arguments[0]
+        file_path = arguments[1]
+        try:
+            plotChannelMap(geometry_path, file_path, per_event)
+        except FileNotFoundError as error:
+            print(error)
@@ -0,0 +1,80 @@
+import numpy as np
+import h5py
+import matplotlib.pyplot as plt
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from simulationData import iterateChunks
+from surfaceMap import SurfaceMap
+from profiling import profilerFromArguments
+
+'''
+Plots the detected photons of any geometry as light maps of each detector component.
+
+Rather than assuming the LoLX cube (plotLoLXLightMap) or the nEXO cylinder
+(plotDetectedPhotons), every DetectedPos is mapped to the triangle it landed on among the
+STLs of the components listed in the YAML card. Each component is then unwrapped into flat
+panels (six faces for box-like components, side and caps for cylindrical ones) and all
+panels are filled in a single pass over the photons, read chunk by chunk.
+
+Intended use case: python3 plotComponentLightMap.py <YAML> <PATH> <BIN_COUNT> [COMPONENT ...]
+where the optional components restrict the mapping to the listed components, for instance
+only the detecting ones. One figure is drawn for each component photons landed on.
+Add --profile to record the time and memory spent in each phase.
+'''
+
+Profiler = profilerFromArguments("plotComponentLightMap")
+
+def plotComponentLightMap(yaml_card, file_path, bin_count, components=None):
+    Profiler.begin("geometry")
+    surface_map = SurfaceMap.fromYAMLFile(yaml_card, components, bin_count)
+
+    # Reading and binning are interleaved, chunk by chunk
+    Profiler.begin("compute")
+    Histograms = None
+    with h5py.File(file_path, 'r') as hdf:
+        for _, _, chunk in iterateChunks(hdf, ["DetectedPos"]):
+            Histograms = surface_map.histogram(chunk["DetectedPos"], Histograms)
+
+    if Histograms is None:
+        print(f"No detected photons in '{file_path}'.")
+        return
+
+    Profiler.begin("render")
+    for name, (panel_names, panel_histograms, extents) in surface_map.componentHistograms(Histograms).items():
+        NumDetected = np.sum(panel_histograms)
+        if NumDetected == 0:
+            continue
+
+        Max = np.max(panel_histograms)
+        fig, axes = plt.subplots(1, len(panel_names), figsize=(4 * len(panel_names), 4), squeeze=False)
+        for panel_index, panel_name in enumerate(panel_names):
+            ax = axes[0, panel_index]
+            ax.set_title(panel_name)
+            cf = ax.imshow(panel_histograms[panel_index].T / Max, cmap='plasma', origin='lower',
+                           extent=extents[panel_index], aspect='auto', vmin=0, vmax=1)
+            ax.set_xlabel('Location (mm)')
+        axes[0, 0].set_ylabel('Location (mm)')
+
+        fig.suptitle(f"{name}: {format(int(NumDetected), ',')} photons detected")
+        cbar = fig.colorbar(cf, ax=axes[0, -1])
+        cbar.set_label('Light Intensity (Normalized)')
+        plt.tight_layout()
+
+    Profiler.end(draw_figures=True)
+    plt.show()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("Please provide a YAML card, a file path and a bin count as arguments.")
+    else:
+        yaml_card = sys.argv[1]
+        file_path = sys.argv[2]
+        bin_count = int(sys.argv[3])
+        components = sys.argv[4:] if len(sys.argv) > 4 else None
+        try:
+            plotComponentLightMap(yaml_card, file_path, bin_count, components)
+        except FileNotFoundError as error:
+            print(error)
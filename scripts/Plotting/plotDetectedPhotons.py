@@ -2,8 +2,14 @@ import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from profiling import profilerFromArguments
+from sharedExecutor import SharedMemoryExecutor, cylinderProjection
+from photonBatch import PhotonBatch
+
 
 # This script plots the detected photons onto a projection of the surface of the detector (which is a cylinder) which is shown as a 2D rectangle
 # The photons are plotted as a heatmap, where brighter colours represent a larger number of photon counts. Use less bins for less photons.
@@ -15,36 +21,42 @@ import sys
 
 # This script assumes you have the ability to view the generated plot. From this window,
 # the user may decide where to save it, if saving it is desired
+# Add --profile to record the time and memory spent in each phase
+# Add --workers <N> to bin the photons on N cores, sharing a single copy of DetectedPos between them
 
-def plotDetectedPhotons(file_path, bin_count):
-    with h5py.File(file_path, 'r') as hdf:
-        # dictionary to store the extracted data
-        extracted_data = {}
-
-        # list of desired keys to extract data from
-        keys_to_extract = ['DetectedPos', 'DetectorHit']
+Profiler = profilerFromArguments("plotDetectedPhotons")
 
-        # Loop over the keys and extract the data
-        for key in keys_to_extract:
-            group = hdf.get(key)
-            extracted_data[key] = np.array(group.get(key))
+def plotDetectedPhotons(file_path, bin_count, num_workers=1):
+    Profiler.begin("load")
+    if num_workers > 1:
+        with SharedMemoryExecutor(file_path, ['DetectedPos'], num_workers) as executor:
+            Profiler.begin("compute")
+            heatmap, xedges, yedges = cylinderProjection(executor, bin_count)
+        plotHeatmap(heatmap, xedges, yedges)
+        return
 
-        # Access the extracted data
-        DetectedPos = extracted_data['DetectedPos']
+    with h5py.File(file_path, 'r') as hdf:
+        # float32 columns of the detected positions, read without intermediate copies
+        Photons = PhotonBatch.fromFile(hdf, 'DetectedPos')
 
-    x, y, z = np.transpose(DetectedPos)
+    Profiler.begin("compute")
+    x, y, z = Photons['x'], Photons['y'], Photons['z']
 
     # Not general, only true for nEXO
     r = 760 # mm
 
-    # Map from (x, y) points into angle from positive x-axis
-    theta = np.mod(np.arctan2(y, x), 2 * np.pi)
-    projection = r * theta
+    # Map from (x, y) points into angle from positive x-axis, computed in place
+    projection = np.arctan2(y, x)
+    np.mod(projection, 2 * np.pi, out=projection)
+    projection *= r
 
     # Create a 2D histogram
     heatmap, xedges, yedges = np.histogram2d(projection, z, bins=bin_count)
+    plotHeatmap(heatmap, xedges, yedges)
 
+def plotHeatmap(heatmap, xedges, yedges):
     # Define the colormap
+    Profiler.begin("render")
     cmap = colors.LinearSegmentedColormap.from_list('my_colormap', ['black', '#972AA8', 'white'])
 
     # Plot the heatmap
@@ -57,17 +69,23 @@ def plotDetectedPhotons(file_path, bin_count):
     plt.title('Detector Position on Cylindrical Projection')
 
     # Display the plot
+    Profiler.end(draw_figures=True)
     plt.show()
 
 def read_file(file_path):
     try:
-        plotDetectedPhotons(file_path, bin_count)
+        plotDetectedPhotons(file_path, bin_count, num_workers)
     except FileNotFoundError:
         print(f"File '{file_path}' not found.")
     except IOError:
         print(f"Error reading file '{file_path}'.")
 
 if __name__ == '__main__':
+    num_workers = 1
+    if "--workers" in sys.argv:
+        index = sys.argv.index("--workers")
+        num_workers = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
     if len(sys.argv) < 3:
         print("Please provide a file path and bin size as an argument.")
     else:
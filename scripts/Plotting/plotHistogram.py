@@ -3,7 +3,16 @@ import h5py
 import matplotlib.pyplot as plt
 from scipy.stats import iqr
 import math
+import os
+import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from profiling import profilerFromArguments
+
+# Run with --profile to record the time and memory spent in each phase
+Profiler = profilerFromArguments("plotHistogram")
+
+Profiler.begin("load")
 path = '/home/slavoie/packages/data/nexo/test/histogramTest/chroma_nEXO_LARGE_230525_120046_r5750.h5'
 with h5py.File(path, 'r') as hdf:
     keys = list(hdf.keys())
@@ -23,6 +32,7 @@ with h5py.File(path, 'r') as hdf:
     NumDetected = extracted_data['NumDetected']
 
 # Determine the optimal number of bins
+Profiler.begin("compute")
 IQR = iqr(NumDetected)
 maxCount = max(NumDetected)
 minCount = min(NumDetected)
@@ -37,11 +47,13 @@ sigmaCount = np.std(NumDetected)
 totalNumberOfSimulatedPhotons = 10000 * 50000
 
 # Plot histogram
+Profiler.begin("render")
 plt.hist(NumDetected, bins=binCount, density=True, label=f"$\mu$ = {math.trunc(np.round(meanCount))}\n$\sigma$ = {math.trunc(np.round(sigmaCount))}", color="#972AA8")
 plt.xlabel("Number of photons detected")
 plt.ylabel("Proportion of occurences")
 plt.title("Photon detection count histogram")
 plt.legend(loc="upper right")
+Profiler.end(draw_figures=True)
 plt.show()
 plt.savefig('/home/slavoie/packages/data/nexo/test/histogramTest/histogram.png')
 
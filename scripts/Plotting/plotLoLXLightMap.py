@@ -2,51 +2,35 @@ import numpy as np
 import matplotlib.pyplot as plt
 import h5py
 from datetime import datetime
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from uncertainty import binomialInterval, bootstrapHistogram
+from profiling import profilerFromArguments
+from photonBatch import PhotonBatch
+from simulationData import separatePointsByFace, getDataset
+
+# Run with --profile to record the time and memory spent in each phase
+Profiler = profilerFromArguments("plotLoLXLightMap")
 
 simFile = input("Enter file: ")
 
+Profiler.begin("load")
 with h5py.File(simFile, 'r') as hdf:
 
-    Flags = np.array(hdf.get("Flags").get("Flags"))
-    DetectedPos = np.array(hdf.get("DetectedPos").get("DetectedPos"))
-    MetaData = dict()
-    
-    for key, value in hdf.attrs.items():
-        if isinstance(value, bytes):
-            MetaData[key] = value.decode()
-        else:
-            MetaData[key] = value
-
+    # Only the number of simulated photons is needed, not the flags themselves
+    TotalPhotons = len(getDataset(hdf, "Flags"))
+    # float32 columns of the detected positions, read without intermediate copies
+    Photons = PhotonBatch.fromFile(hdf, "DetectedPos")
 
-TotalPhotons = len(Flags)
-NumDetected = len(DetectedPos)
+Profiler.begin("compute")
+NumDetected = len(Photons)
 FractionDetected = NumDetected / TotalPhotons
+FractionDetectedLower, FractionDetectedUpper = binomialInterval(NumDetected, TotalPhotons)
 
-def separatePointsByFace(Points):
-    Length = 20.9 # mm
-    Points = np.array(Points)  # Convert the list of points to a NumPy array
-
-    x, y, z = Points[:, 0], Points[:, 1], Points[:, 2]
-    
-    WestMask = (x < -Length)
-    BottomMask = (z < -Length)
-    EastMask = (x > Length) 
-    NorthMask = (y < -Length) 
-    SouthMask = (y > Length)
-    TopMask = (z > Length)
-    
-    PackagedCube = [
-        [y[WestMask], z[WestMask]],
-        [y[BottomMask],-x[BottomMask]],
-        [-y[EastMask], z[EastMask]],
-        [-x[NorthMask], z[NorthMask]],
-        [z[SouthMask], x[SouthMask]],
-        [x[TopMask], y[TopMask]]
-    ]
-    return PackagedCube
-   
 def plotLightMap(Style="contour"):
-    DetectedFaces = separatePointsByFace(DetectedPos)
+    DetectedFaces = separatePointsByFace(Photons["x"], Photons["y"], Photons["z"])
 
     # Define the dimensions of the square (ranging from -25 to +25)
     x_min, x_max = -25, 25
@@ -91,6 +75,7 @@ def plotLightMap(Style="contour"):
             counts, xedges, yedges, im = ax.hist2d(dim1, dim2, bins=num_bins, range=[[x_min, x_max], [z_min, z_max]], cmap=cmap)
             histogram_data.append((counts, xedges, yedges))
 
+    Profiler.begin("render")
     if Style.lower() == "contour":
         Heights = [H for H, _, _ in contour_data]
         Heights_flattened = [value for sublist in Heights for value in sublist]
@@ -128,7 +113,13 @@ def plotLightMap(Style="contour"):
             # Plot the heatmap
             cf = ax.imshow(counts_norm.T, cmap=cmap, origin='lower', extent=[x_min, x_max, z_min, z_max], aspect='auto') 
             ax.grid()
-            
+
+    # Exact binomial band on the fraction of all simulated photons landing in each bin
+    BinCounts = np.array([H for H, _, _ in contour_data + histogram_data])
+    BinFractionLower, BinFractionUpper = binomialInterval(BinCounts, TotalPhotons)
+    # Bootstrap error of the normalized map as drawn, which includes the fluctuation of its brightest bin
+    BinNormalizedError = bootstrapHistogram(BinCounts)
+
     plt.tight_layout()
 
     # Get the current date and time
@@ -138,7 +129,7 @@ def plotLightMap(Style="contour"):
     fig.suptitle(f"LoLX Detected Photon Heatmap", fontsize=16, y=0.95)
 
     # Add the FractionDetected as a subtitle at the bottom of the figure
-    fig.text(0.5, 0.03, f"Photons Simulated: {format(TotalPhotons, ',')}\nPhotons Detected: {format(NumDetected, ',')}\nFraction Detected: {FractionDetected:.2f}", ha='center', fontsize=12)
+    fig.text(0.5, 0.03, f"Photons Simulated: {format(TotalPhotons, ',')}\nPhotons Detected: {format(NumDetected, ',')}\nFraction Detected: {FractionDetected:.4f} (+{FractionDetectedUpper - FractionDetected:.4f} / -{FractionDetected - FractionDetectedLower:.4f})", ha='center', fontsize=12)
 
     # Add color bar on the right of all subplots with enough whitespace
     cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])  # [left, bottom, width, height]
@@ -151,6 +142,12 @@ def plotLightMap(Style="contour"):
     # Save the figure with the current date and time in the filename and increase the resolution (dpi)
     filename = f"/home/slavoie/Images/heatmap_{current_datetime}.png"
     plt.savefig(filename, dpi=500)
+
+    # The per-bin error bands are saved next to the figure
+    np.savez_compressed(filename.replace(".png", "_errors.npz"), FaceNames=face_names, BinCounts=BinCounts,
+                        BinFractionLower=BinFractionLower, BinFractionUpper=BinFractionUpper,
+                        BinNormalizedError=BinNormalizedError, TotalPhotons=TotalPhotons)
+    Profiler.end(draw_figures=True)
     plt.show()  
 
 plotLightMap("histogram")
@@ -1,7 +1,11 @@
 import h5py
 import numpy as np
+import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from profiling import profilerFromArguments
+
 
 """
 Author: Simon Lavoie
@@ -16,7 +20,9 @@ This script immediately uses the Flags and NumDetected arrays to infer the NumPh
 and NumSources as specified by the YAML.
 It also prints out the human-readable flag descriptions for each unique flag, alongside
 how often each unique flag was seen (as a percentage).
+Run with --profile to record the time and memory spent reading and printing the keys.
 """
+Profiler = profilerFromArguments("printSimulationOutput")
 
 file_path = input("Enter path of file to visualize: ")
 # Find the index where "chroma-simulation/" ends
@@ -93,10 +99,12 @@ with h5py.File(file_path, 'r') as hdf:
             print(f"Invalid input, try again")
 
     # Loop over the keys and extract the data
+    Profiler.begin("load")
     for index, key in enumerate(keys_to_extract):
         ProgressBar(index, len(keys_to_extract), '  Extracting key %d of %d:' % (index + 1, len(keys_to_extract)))
         group = hdf.get(key)
         extracted_data[key] = np.array(group.get(key))
+    Profiler.end()
 
 def interpretFlags():
     # At first glance, simply viewing the Flags array doesn't mean much to the user unless they are
@@ -194,6 +202,7 @@ while True:
     else: 
         print("Invalid input, try again.")
 
+Profiler.begin("print")
 for key in keys_to_extract:
     print(f"###{str(key)}###")
     print(f"type: {type(extracted_data[key])}")
@@ -2,6 +2,17 @@ import numpy as np
 import h5py
 import yaml
 import matplotlib.pyplot as plt
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from uncertainty import binomialErrors, bootstrapFractions
+from fresnelFit import fitRefractiveIndex, getAOI, sheetAOI
+from spectralAnalysis import loadOpticalProperties, complexIndex
+from stlGeometry import Geometry
+from profiling import profilerFromArguments
+from flagIndex import countSelected
+from simulationData import SURFACE_DETECT, REFLECT_SPECULAR
 
 '''
 Author: Simon Lavoie 
@@ -15,16 +26,28 @@ This generation method defines a laser moving along the inner surface of the sph
 present in the stated geometry, pointing towards the origin. This results in
 photons with incident angles ranging from 0 to 90 degrees. These angles are plotted 
 against the fraction of photons which were reflected for each source (each source 
-defines a different incident angle). The incident angles are computed assuming
-the proper geometry is used.'''
+defines a different incident angle). The incident angles are computed by following
+the beam of each source to the Sheet STL and measuring it against the normal of the
+triangle it hits, so the sheet may be placed and oriented arbitrarily. If the Sheet STL
+cannot be found, they are computed assuming the ReflectivityStudy sphere instead.
+Run with --fit to fit the complex refractive index of the sheet to the simulated
+reflectivity instead of using the one found in the optical properties.
+Run with --bootstrap to draw error bars from bootstrap replicas of every source instead of
+the exact binomial interval.'''
+
+FitRefractiveIndex = "--fit" in sys.argv
+BootstrapErrors = "--bootstrap" in sys.argv
+# Run with --profile to record the time and memory spent in each phase
+Profiler = profilerFromArguments("reflectivityStudy")
 
 yaml_path = "//home//slavoie//LoLX//chroma-simulation//Yaml//LoLX//LoLXReflectivityStudy.yaml"
 
 file_path = input("Enter simulation file: ")
 
+Profiler.begin("load")
 with h5py.File(file_path, 'r') as hdf:
-    FlagsGroup = hdf.get("Flags")
-    Flags = np.array(FlagsGroup.get("Flags"))
+    # The flags are counted through their index rather than loaded whole
+    TotalPhotons = len(hdf.get("Flags").get("Flags"))
     NumDetectedGroup = hdf.get("NumDetected")
     NumDetected = np.array(NumDetectedGroup.get("NumDetected"))
     OriginGroup = hdf.get("Origin")
@@ -32,10 +55,14 @@ with h5py.File(file_path, 'r') as hdf:
     PhotonWavelengthGroup = hdf.get("PhotonWavelength")
     PhotonWavelength = np.array(PhotonWavelengthGroup.get("PhotonWavelength"))
 
-# assuming that each wavelength is the same 
-Wavelength = PhotonWavelength[0]    
+Profiler.begin("compute")
+# assuming that each wavelength is the same, runs with a spectrum of wavelengths are
+# analyzed bin by bin with Utilities/spectralAnalysis.py
+Wavelength = PhotonWavelength[0]
+if np.any(PhotonWavelength != Wavelength):
+    print(f"Photons span {np.min(PhotonWavelength):.4g} to {np.max(PhotonWavelength):.4g} nm, the optical properties at "
+          f"{Wavelength:.4g} nm are used. Use spectralAnalysis.py for a wavelength-resolved comparison.")
 NumSources = len(NumDetected)
-TotalPhotons = len(Flags)
 PhotonsPerSource = TotalPhotons / NumSources
 
 # Load refractive index values directly from yaml
@@ -45,67 +72,32 @@ yaml_file = yaml.load(open(yaml_path, 'r'), Loader=yaml.FullLoader)
 SheetMaterial = yaml_file["Components"]["Sheet"]["Surface"][0]
 OutsideMaterial = yaml_file["Components"]["Sheet"]["Outside"][0]
 
-# extract refractive indices
-OpticalProperties = yaml.load(open(yaml_file["Detector"]["OpticalProperties"], "r"), Loader=yaml.FullLoader)
-OutsideIndexDataReal = OpticalProperties[OutsideMaterial]["IndexOfRefractionRe"]
-SurfaceIndexDataReal = OpticalProperties[SheetMaterial]["IndexOfRefractionRe"]
-try:
-    OutsideIndexDataImaginary = OpticalProperties[OutsideMaterial]["IndexOfRefractionIm"]
-    OutsideHasImaginaryComponent = True
-except KeyError:
-    OutsideHasImaginaryComponent = False
-    k1 = 0
+# extract refractive indices. Refractive index data can either be wavelength dependent
+# (interpolated at the wavelength of the photons) or single-valued.
+OpticalProperties = loadOpticalProperties(yaml_file)
+n1 = complex(complexIndex(OpticalProperties[OutsideMaterial], Wavelength))
+n2 = complex(complexIndex(OpticalProperties[SheetMaterial], Wavelength))
 
+# Angle of incidence of each source on the sheet
 try:
-    SurfaceIndexDataImaginary = OpticalProperties[SheetMaterial]["IndexOfRefractionIm"]
-    SurfaceHasImaginaryComponent = True
-except KeyError:
-    SurfaceHasImaginaryComponent = False
-    k2 = 0
-    
-# Refractive index data can either be wavelength dependent or single-valued
-if isinstance(OutsideIndexDataReal, dict):
-    
-    for index, tuples in enumerate(OutsideIndexDataReal.values()):
-        if tuples[0] == Wavelength:
-            n1 = tuples[1]
-            if OutsideHasImaginaryComponent:
-                k1 = list(OutsideIndexDataImaginary.values())[index][1]
-else:
-    n1 = OutsideIndexDataReal
-    if OutsideHasImaginaryComponent:
-        k1 = OutsideIndexDataImaginary
-
-if isinstance(SurfaceIndexDataReal, dict):
-    for index, tuples in enumerate(SurfaceIndexDataReal.values()):
-        if tuples[0] == Wavelength:
-            n2 = tuples[1]
-            if SurfaceHasImaginaryComponent:
-                k2 = list(SurfaceIndexDataImaginary.values())[index][1]
+    geometry = Geometry.fromYAML(yaml_file, components=["Sheet"])
+    AOI = sheetAOI(Origin, geometry)
+except FileNotFoundError:
+    print("Sheet STL not found, assuming the ReflectivityStudy geometry to compute angles of incidence.")
+    AOI = getAOI(Origin)
+
+# Each source will have a unique incident angle, and therefore unique reflectivity.
+# Photons flagged exactly 68 (SURFACE_DETECT + REFLECT_SPECULAR), counted source by source
+Reflected = SURFACE_DETECT | REFLECT_SPECULAR
+NumReflected = countSelected(file_path, require=Reflected, forbid=~Reflected)
+Reflectivity = NumReflected / PhotonsPerSource # Get fraction reflected
+
+# Exact binomial error bars on the fraction reflected by each source, or bootstrap ones
+if BootstrapErrors:
+    ReflectivityLower, ReflectivityUpper, _ = bootstrapFractions(NumReflected, PhotonsPerSource)
+    ReflectivityErrors = (Reflectivity - ReflectivityLower, ReflectivityUpper - Reflectivity)
 else:
-    n2 = SurfaceIndexDataReal
-    if SurfaceHasImaginaryComponent:
-        k2 = SurfaceIndexDataImaginary
-        
-
-# Assuming proper geometry is loaded:
-def getAOI(xCoordinate):
-    SphereRadius = 152.6
-    return np.arcsin(xCoordinate / SphereRadius) * 180 / np.pi
-
-AOI = np.array([getAOI(xCoordinate) for xCoordinate in Origin[:, 0]])
-
-# Each source will have a unique incident angle, and therefore unique reflectivity
-FlagsSplitBySource = np.split(Flags, NumSources)
-
-Reflectivity = []
-for Source in FlagsSplitBySource:
-    NumReflected = 0
-    for Flag in Source:
-        if Flag == 68: # SURFACE_DETECT + REFLECT_SPECULAR
-            NumReflected += 1
-    Reflectivity.append(NumReflected)
-Reflectivity = np.array(Reflectivity) / PhotonsPerSource # Get fraction reflected
+    ReflectivityErrors = binomialErrors(NumReflected, PhotonsPerSource)
 
 def reflecivity_s(incident_angle, z1, z2, epsilon_1, epsilon_2):
     incident_angle = np.array(incident_angle) / 180 * np.pi
@@ -117,15 +109,25 @@ def reflecivity_p(incident_angle, z1, z2, epsilon_1, epsilon_2):
     cos_transmitted_angle = np.sqrt(1 - (epsilon_1 / epsilon_2) * np.sin(incident_angle) ** 2 )
     return abs((z2 * cos_transmitted_angle - z1 * np.cos(incident_angle)) / (z2 * cos_transmitted_angle + z1 * np.cos(incident_angle))) ** 2
 
-incident_angles = AOI
+# Sorted so the theory curves are drawn left to right whatever the order of the sources
+incident_angles = np.sort(AOI)
 
 #else:
 # define constants
 epsilon_0 = 8.854e-12
 mu_0 = 4 * np.pi * 1e-7
 characteristic_impedance_0 = np.sqrt(mu_0 / epsilon_0)
-n1 = n1 + 1j * k1
-n2 = 1.05 + 1j * 1.5
+
+if FitRefractiveIndex:
+    # Symmetric errors taken as the larger side of the binomial interval, floored at one
+    # photon so that sources with no reflections keep a finite weight
+    Sigma = np.maximum(np.max(ReflectivityErrors, axis=0), 1 / PhotonsPerSource)
+    Fit = fitRefractiveIndex(AOI, Reflectivity, n1, Sigma)
+    print(f"Refractive index from the optical properties: {np.real(n2)} + {np.imag(n2)}i")
+    n2 = Fit["n"][0] + 1j * Fit["k"][0]
+    print(f"Fitted refractive index: ({Fit['n'][0]:.4f} +/- {Fit['n_error'][0]:.4f}) + ({Fit['k'][0]:.4f} +/- {Fit['k_error'][0]:.4f})i")
+    print(f"Reduced chi-square: {Fit['ReducedChiSquare'][0]:.2f}")
+
 epislon_1 = np.real(n1) ** 2 - np.imag(n1) ** 2 + 2j * np.real(n1) * np.imag(n1)
 characteristic_impedance_1 = characteristic_impedance_0 / np.sqrt(epislon_1) # z1
 epsilon_2 = np.real(n2) ** 2 - np.imag(n2) ** 2 + 2j * np.real(n2) * np.imag(n2)
@@ -137,14 +139,15 @@ R_theory_p = reflecivity_p(incident_angles, characteristic_impedance_1, characte
 Average = (R_theory_p + R_theory_s) / 2
 
 # Calculate residuals
-residuals = Reflectivity - Average
+residuals = Reflectivity[np.argsort(AOI)] - Average
 
 # Create a figure with subplots
+Profiler.begin("render")
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 8))
 
 # Plot scatter plot of simulated reflectivity
 plt.suptitle("Reflectivity Comparison Plot")
-ax1.scatter(AOI, Reflectivity, c="b", s=10, label=fr"Simulated Reflectivity ($n_2$ = {np.real(n2)} + {np.imag(n2)}i, $\lambda$ = {Wavelength} nm)")
+ax1.errorbar(AOI, Reflectivity, yerr=ReflectivityErrors, fmt="o", c="b", ms=3, label=fr"Simulated Reflectivity ($n_2$ = {np.real(n2):.4g} + {np.imag(n2):.4g}i{' (fitted)' if FitRefractiveIndex else ''}, $\lambda$ = {Wavelength} nm)")
 ax1.plot(incident_angles, R_theory_s, c="#3900bf", label="Theoretical Reflectivity (S-Polarization)")
 ax1.plot(incident_angles, R_theory_p, c="#00a3bf", label="Theoretical Reflectivity (P-polarization)")
 ax1.plot(incident_angles, Average, c="r", label="Average")
@@ -153,7 +156,7 @@ ax1.set_ylabel("Reflectivity")
 ax1.legend(loc="upper left")
 
 # Plot scatter plot of residuals
-ax2.scatter(AOI, residuals, c="b", s=10, label="Residuals")
+ax2.errorbar(incident_angles, residuals, yerr=np.array(ReflectivityErrors)[:, np.argsort(AOI)], fmt="o", c="b", ms=3, label="Residuals")
 ax2.set_xlabel("Angle of Incidence (Degrees)")
 ax2.set_ylabel("Residuals\n(Simulation - Average)")
 ax2.legend(loc="upper right")
@@ -161,4 +164,5 @@ ax2.legend(loc="upper right")
 # Adjust spacing between subplots
 plt.tight_layout()
 
+Profiler.end(draw_figures=True)
 plt.show()
@@ -0,0 +1,96 @@
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.colors as colors
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from heatmapPyramid import HeatmapPyramid, buildPyramid, pyramidPath
+from profiling import profilerFromArguments
+
+'''
+Interactive, zoomable view of the detected photons of a run, drawn from the heatmap pyramid
+built by Utilities/heatmapPyramid.py (it is built first if the run has no sidecar yet).
+
+Whenever the view is zoomed or panned, the finest level that still fits the axes' pixels is
+picked and only the tiles covering the view are read, so zooming into a hot spot of a map
+made from billions of photons costs a few tile reads instead of rebinning every photon.
+
+Intended use case: python3 viewHeatmapPyramid.py <PATH>
+where <PATH> is either a simulation output or a .pyramid.h5 sidecar.
+Add --profile to record the time and memory spent in each phase.
+'''
+
+Profiler = profilerFromArguments("viewHeatmapPyramid")
+
+class PyramidViewer:
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+        self.fig, self.ax = plt.subplots(figsize=(10, 6))
+        self.cmap = colors.LinearSegmentedColormap.from_list('my_colormap', ['black', '#972AA8', 'white'])
+
+        Counts, extent, level = pyramid.readView(*pyramid.Extent, max_pixels=self.maxPixels())
+        self.image = self.ax.imshow(Counts.T, origin='lower', extent=extent, cmap=self.cmap, aspect='auto', interpolation='nearest')
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax, label='Photon Count')
+        self.ax.set_xlim(pyramid.Extent[0], pyramid.Extent[1])
+        self.ax.set_ylim(pyramid.Extent[2], pyramid.Extent[3])
+
+        if pyramid.Projection == "cylinder":
+            self.ax.set_xlabel('$r\\theta$ (mm)')
+            self.ax.set_ylabel('Z-coordinate')
+        else:
+            self.ax.set_xlabel(f'{pyramid.Projection[0].upper()}-coordinate (mm)')
+            self.ax.set_ylabel(f'{pyramid.Projection[1].upper()}-coordinate (mm)')
+        self.setTitle(level)
+
+        self.ax.callbacks.connect('xlim_changed', self.update)
+        self.ax.callbacks.connect('ylim_changed', self.update)
+
+    def maxPixels(self):
+        # Width of the axes on screen, in pixels
+        bbox = self.ax.get_window_extent()
+        return max(int(max(bbox.width, bbox.height)), 64)
+
+    def setTitle(self, level):
+        bins = self.pyramid.levelBins(level)
+        self.ax.set_title(f'Detected Photons (level {level}, {bins} x {bins} bins)')
+
+    def update(self, ax):
+        u_min, u_max = sorted(self.ax.get_xlim())
+        v_min, v_max = sorted(self.ax.get_ylim())
+        Counts, extent, level = self.pyramid.readView(u_min, u_max, v_min, v_max, max_pixels=self.maxPixels())
+        self.image.set_data(Counts.T)
+        self.image.set_extent(extent)
+        self.image.set_clim(0, max(np.max(Counts), 1))
+        self.setTitle(level)
+        # Setting the extent must not change the view being zoomed into
+        self.ax.set_xlim(u_min, u_max, emit=False)
+        self.ax.set_ylim(v_min, v_max, emit=False)
+        self.fig.canvas.draw_idle()
+
+
+def viewHeatmapPyramid(file_path):
+    Profiler.begin("load")
+    if not file_path.endswith(".pyramid.h5"):
+        if not os.path.exists(pyramidPath(file_path)):
+            print(f"Building the heatmap pyramid of '{file_path}'...")
+            buildPyramid(file_path)
+        file_path = pyramidPath(file_path)
+
+    with HeatmapPyramid(file_path) as pyramid:
+        Profiler.begin("render")
+        viewer = PyramidViewer(pyramid)
+        Profiler.end(draw_figures=True)
+        plt.show()
+    return viewer
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Please provide a file path as an argument.")
+    else:
+        file_path = sys.argv[1]
+        try:
+            viewHeatmapPyramid(file_path)
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
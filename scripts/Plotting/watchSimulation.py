@@ -0,0 +1,206 @@
+import numpy as np
+import h5py
+import matplotlib.pyplot as plt
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Utilities"))
+from simulationData import FaceNames, NumChannels, getDataset, faceHistograms, channelCounts, countFlags, describeFlag
+from profiling import profilerFromArguments
+
+'''
+Follows a simulation output while chroma is still writing it, so that a bad multi-hour
+job can be spotted (and killed) early instead of waiting for it to finish before running
+plotLoLXLightMap or plotChannelCounts.
+
+The file is opened in HDF5 single-writer/multi-reader (SWMR) mode. Every poll refreshes
+the datasets, reads only the rows appended since the previous poll and adds them to the
+running face light map, channel counts and flag tallies. If the file was not written in
+SWMR mode it is simply reopened at every poll instead.
+
+Intended use case: python3 watchSimulation.py <PATH> <POLL_SECONDS>
+Add --no-plot to only print the running summary. The watch stops when the file stops
+growing for 10 polls or on Ctrl+C. Use Utilities/writeSyntheticSimulation.py with a delay
+to try it out on a file that grows. Add --profile to record the time and memory spent in
+each poll ("load") and plot update ("render"); the waits between polls are left out.
+'''
+
+Profiler = profilerFromArguments("watchSimulation")
+
+class SimulationWatcher:
+    def __init__(self, file_path, num_bins=350):
+        self.file_path = file_path
+        self.num_bins = num_bins
+
+        # Number of rows of each key already accounted for (ChannelIDs and ChannelCharges
+        # are read together and share the count of ChannelIDs)
+        self.rows_read = {"Flags": 0, "DetectedPos": 0, "ChannelIDs": 0}
+
+        self.LightMap = np.zeros((len(FaceNames), num_bins, num_bins))
+        self.ChannelCharges = np.zeros(NumChannels)
+        self.FlagCounts = dict()
+        # Flag counts as of the last printed summary
+        self.PrintedCounts = dict()
+        self.hdf = None
+
+    def open(self):
+        try:
+            self.hdf = h5py.File(self.file_path, 'r', libver='latest', swmr=True)
+            self.swmr = True
+        except OSError:
+            self.hdf = h5py.File(self.file_path, 'r')
+            self.swmr = False
+
+    def close(self):
+        if self.hdf is not None:
+            self.hdf.close()
+            self.hdf = None
+
+    def newRows(self, key, *aligned_keys):
+        # Returns the rows of key appended since the last call (None if the dataset
+        # has not been created yet). With aligned_keys, returns a tuple with the same rows
+        # of every key, stopping at the shortest dataset since a writer may have extended
+        # one before the others.
+        datasets = [getDataset(self.hdf, name) for name in (key,) + aligned_keys]
+        if any(dataset is None for dataset in datasets):
+            return None
+        if self.swmr:
+            for dataset in datasets:
+                dataset.refresh()
+        start = self.rows_read[key]
+        stop = min(dataset.shape[0] for dataset in datasets)
+        if stop <= start:
+            return None
+        self.rows_read[key] = stop
+        if len(datasets) == 1:
+            return datasets[0][start:stop]
+        return tuple(dataset[start:stop] for dataset in datasets)
+
+    def poll(self):
+        # Updates the running summaries, returning whether anything new was read
+        if self.hdf is None or not self.swmr:
+            self.close()
+            self.open()
+
+        grew = False
+
+        Flags = self.newRows("Flags")
+        if Flags is not None:
+            countFlags(Flags, self.FlagCounts)
+            grew = True
+
+        DetectedPos = self.newRows("DetectedPos")
+        if DetectedPos is not None:
+            self.LightMap += faceHistograms(DetectedPos, self.num_bins)
+            grew = True
+
+        # ChannelIDs and ChannelCharges are read over the same rows to keep them aligned;
+        # rows present in only one of them are read at a later poll
+        Channels = self.newRows("ChannelIDs", "ChannelCharges")
+        if Channels is not None:
+            ChannelIDs, ChannelCharges = Channels
+            self.ChannelCharges += channelCounts(ChannelIDs, ChannelCharges)
+            grew = True
+
+        return grew
+
+    @property
+    def TotalPhotons(self):
+        return self.rows_read["Flags"]
+
+    @property
+    def NumDetected(self):
+        return self.rows_read["DetectedPos"]
+
+    def printSummary(self):
+        # The flags are described the first time they appear, then only their changed
+        # percentages are printed on one line
+        print(f"Photons simulated: {format(self.TotalPhotons, ',')}, photons detected: {format(self.NumDetected, ',')}")
+        Changed = []
+        for flag, count in sorted(self.FlagCounts.items(), key=lambda item: -item[1]):
+            percentage = round(count / self.TotalPhotons * 100, 2)
+            if flag not in self.PrintedCounts:
+                print(f"  {flag}: {describeFlag(flag)} (Percentage: {percentage})")
+            elif self.PrintedCounts[flag] != percentage:
+                Changed.append(f"{flag}: {percentage}%")
+            self.PrintedCounts[flag] = percentage
+        if len(Changed) > 0:
+            print("  " + ", ".join(Changed))
+
+
+def watchSimulation(file_path, poll_seconds, show_plot=True, max_idle_polls=10):
+    watcher = SimulationWatcher(file_path)
+
+    if show_plot:
+        plt.ion()
+        fig, axes = plt.subplots(2, 4, figsize=(16, 8))
+        images = []
+        for face_index, face_name in enumerate(FaceNames):
+            ax = axes[face_index // 3, face_index % 3]
+            ax.set_title(face_name)
+            ax.set_xticks([])
+            ax.set_yticks([])
+            images.append(ax.imshow(watcher.LightMap[face_index].T, cmap='plasma', origin='lower', extent=[-25, 25, -25, 25], vmin=0, vmax=1))
+        channel_ax = axes[0, 3]
+        bars = channel_ax.bar(np.arange(len(watcher.ChannelCharges)), watcher.ChannelCharges, color="black")
+        channel_ax.set_title("Channel counts")
+        flag_ax = axes[1, 3]
+        flag_ax.set_title("Flag fractions")
+
+    idle_polls = 0
+    try:
+        while idle_polls < max_idle_polls:
+            Profiler.begin("load")
+            rendered = False
+            if watcher.poll():
+                idle_polls = 0
+                watcher.printSummary()
+
+                if show_plot and watcher.TotalPhotons > 0:
+                    Profiler.begin("render")
+                    rendered = True
+                    Max = max(np.max(watcher.LightMap), 1)
+                    for face_index, image in enumerate(images):
+                        image.set_data(watcher.LightMap[face_index].T / Max)
+                    for bar, height in zip(bars, watcher.ChannelCharges):
+                        bar.set_height(height)
+                    channel_ax.set_ylim(0, max(np.max(watcher.ChannelCharges), 1) * 1.05)
+
+                    flag_ax.clear()
+                    flag_ax.set_title("Flag fractions")
+                    flags = sorted(watcher.FlagCounts)
+                    fractions = [watcher.FlagCounts[flag] / watcher.TotalPhotons for flag in flags]
+                    flag_ax.barh([str(flag) for flag in flags], fractions, color="#972AA8")
+                    flag_ax.set_xlim(0, 1)
+
+                    fig.suptitle(f"{os.path.basename(file_path)}: {format(watcher.TotalPhotons, ',')} photons, "
+                                 f"fraction detected {watcher.NumDetected / watcher.TotalPhotons:.2f}")
+            else:
+                idle_polls += 1
+            Profiler.end(draw_figures=rendered)
+
+            if show_plot:
+                plt.pause(poll_seconds)
+            else:
+                time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    print(f"Stopped watching '{file_path}'.")
+    return watcher
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != "--no-plot"]
+    if len(arguments) < 1:
+        print("Please provide a file path and optionally a polling interval (in seconds) as arguments.")
+    else:
+        file_path = arguments[0]
+        poll_seconds = float(arguments[1]) if len(arguments) > 1 else 5
+        try:
+            watchSimulation(file_path, poll_seconds, show_plot="--no-plot" not in sys.argv)
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
@@ -0,0 +1,188 @@
+import numpy as np
+import h5py
+import os
+import sys
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import ConvexHull, QhullError
+
+from simulationData import getDataset
+from surfaceMap import SurfaceMap
+
+'''
+Builds a channel geometry table: where every channel sits on the unwrapped detector
+surface, as a centroid and a polygon, so that per-channel quantities (ChannelCharges, the
+channel totals of channelMatrix, ...) can be drawn as detector maps without going back to
+the positions of the photons.
+
+The STL files do not say which channel each part of the detector is read out by, so the
+table is calibrated once from a run that wrote DetectedPos and DetectorHit:
+  - the triangles of the detecting components are split into tiles, the groups of
+    triangles connected by shared vertices (one tile per SiPM when they are separate solids);
+  - the detected photons (evenly spread over the run, at most max_photons of them) are
+    mapped to the triangle they landed on and unwrapped with surfaceMap;
+  - a tile belongs to a channel when at least purity of its photons were read out by that
+    channel. The polygon of the channel is then the outline of its tiles on the panel where
+    its photons landed, and its centroid is their centroid.
+  - channels sharing a tile (several channels on one solid) fall back to the outline and
+    mean of their own photons.
+Polygons are the convex hulls of the unwrapped points. Channels that saw no photon in the
+calibration run have no geometry.
+
+The table is saved next to the YAML card as <card>.channelgeometry.npz, to be drawn by
+Plotting/plotChannelMap.py for any run of the same detector.
+
+Intended use case: python3 channelGeometry.py <YAML> <PATH> [COMPONENT ...] [--output <NPZ>] [--photons <N>]
+where the optional components are the detecting ones (all components of the card by default).
+'''
+
+def channelGeometryPath(yaml_card):
+    return os.path.splitext(yaml_card)[0] + ".channelgeometry.npz"
+
+
+def triangleTiles(Triangles, decimals=4):
+    # Tile index of every triangle, tiles being the sets of triangles connected by shared vertices
+    Vertices = np.round(Triangles.reshape(-1, 3), decimals)
+    _, VertexIDs = np.unique(Vertices, axis=0, return_inverse=True)
+    VertexIDs = VertexIDs.ravel()
+    num_triangles = len(Triangles)
+    num_vertices = int(np.max(VertexIDs)) + 1 if len(VertexIDs) > 0 else 0
+    # Bipartite graph of triangles and their vertices
+    Rows = np.repeat(np.arange(num_triangles), 3)
+    Graph = sparse.coo_matrix((np.ones(len(Rows)), (Rows, num_triangles + VertexIDs)),
+                              shape=(num_triangles + num_vertices,) * 2)
+    _, Labels = connected_components(Graph, directed=False)
+    _, Tiles = np.unique(Labels[:num_triangles], return_inverse=True)
+    return Tiles.ravel()
+
+
+def outline(Points):
+    # Convex hull of 2D points, or their bounding box when they are too few or aligned
+    Points = np.asarray(Points, dtype=np.float64)
+    try:
+        return Points[ConvexHull(Points).vertices]
+    except (QhullError, ValueError):
+        Low, High = np.min(Points, axis=0), np.max(Points, axis=0)
+        return np.array([[Low[0], Low[1]], [High[0], Low[1]], [High[0], High[1]], [Low[0], High[1]]])
+
+
+def unwrapOnPanel(surface_map, Points, panel):
+    # 2D coordinates of points on a global panel of the surface map
+    component = surface_map.PanelComponents[panel]
+    u, v = surface_map.Components[component].coordinates(Points, np.full(len(Points), panel - surface_map.PanelOffsets[component]))
+    UV = np.column_stack([u, v])
+    if surface_map.Components[component].unwrap == "cylinder" and panel == surface_map.PanelOffsets[component]:
+        # Keeps polygons crossing the seam of an unrolled side in one piece
+        low, high = surface_map.PanelExtents[panel][:2]
+        if np.ptp(UV[:, 0]) > (high - low) / 2:
+            UV[UV[:, 0] < 0, 0] += high - low
+    return UV
+
+
+def buildChannelGeometry(yaml_card, file_path, components=None, max_photons=1 << 20, purity=0.9):
+    # Channel geometry table of the detector of a YAML card, calibrated from a run
+    surface_map = SurfaceMap.fromYAMLFile(yaml_card, components, num_bins=1)
+    geometry = surface_map.geometry
+    Tiles = triangleTiles(geometry.Triangles)
+
+    with h5py.File(file_path, 'r') as hdf:
+        DetectedPos = getDataset(hdf, "DetectedPos")
+        DetectorHit = getDataset(hdf, "DetectorHit")
+        if DetectedPos is None or DetectorHit is None:
+            raise KeyError(f"{hdf.filename} needs DetectedPos and DetectorHit to calibrate the channel geometry")
+        step = max(-(-len(DetectedPos) // max_photons), 1)
+        Points = DetectedPos[::step].astype(np.float64)
+        Hits = DetectorHit[::step].astype(np.int64)
+
+    TriangleIDs, _ = geometry.nearestTriangles(Points)
+    Panels, u, v = surface_map.unwrapPoints(Points, TriangleIDs)
+    HitTiles = Tiles[TriangleIDs]
+
+    # Channel read out for most of the photons of every tile, and how many of them it has
+    Pairs, PairCounts = np.unique(np.column_stack([HitTiles, Hits]), axis=0, return_counts=True)
+    Order = np.lexsort((-PairCounts, Pairs[:, 0]))
+    Pairs, PairCounts = Pairs[Order], PairCounts[Order]
+    First = np.flatnonzero(np.r_[True, Pairs[1:, 0] != Pairs[:-1, 0]])
+    TileTotals = np.add.reduceat(PairCounts, First)
+    TileChannels = np.full(np.max(Tiles) + 1, -1)
+    Pure = PairCounts[First] >= purity * TileTotals
+    TileChannels[Pairs[First[Pure], 0]] = Pairs[First[Pure], 1]
+
+    Areas = np.linalg.norm(np.cross(geometry.Triangles[:, 1] - geometry.Triangles[:, 0],
+                                    geometry.Triangles[:, 2] - geometry.Triangles[:, 0]), axis=1) / 2
+    Centroids = geometry.Triangles.mean(axis=1)
+
+    Table = {"ChannelIDs": [], "Panels": [], "Centroids": [], "CentroidsUV": [], "NumHits": [], "FromTiles": [], "Polygons": []}
+    for channel in np.unique(Hits):
+        OnChannel = Hits == channel
+        panel = int(np.argmax(np.bincount(Panels[OnChannel])))
+        # Triangles of the tiles of the channel facing the same panel as its photons
+        Owned = np.flatnonzero((TileChannels[Tiles] == channel) & (surface_map.TrianglePanels == panel))
+        if len(Owned) > 0:
+            Centroid = np.sum(Centroids[Owned] * Areas[Owned, None], axis=0) / max(np.sum(Areas[Owned]), 1e-30)
+            Polygon = outline(unwrapOnPanel(surface_map, geometry.Triangles[Owned].reshape(-1, 3), panel))
+        else:
+            OnPanel = OnChannel & (Panels == panel)
+            Centroid = np.mean(Points[OnPanel], axis=0)
+            Polygon = outline(unwrapOnPanel(surface_map, Points[OnPanel], panel))
+        Table["ChannelIDs"].append(channel)
+        Table["Panels"].append(panel)
+        Table["Centroids"].append(Centroid)
+        Table["CentroidsUV"].append(np.mean(Polygon, axis=0))
+        Table["NumHits"].append(int(np.sum(OnChannel)) * step)
+        Table["FromTiles"].append(len(Owned) > 0)
+        Table["Polygons"].append(Polygon)
+
+    Polygons = Table.pop("Polygons")
+    Table = {key: np.array(values) for key, values in Table.items()}
+    # Polygons have different numbers of vertices, so they are stored one after the other
+    Table["PolygonOffsets"] = np.concatenate([[0], np.cumsum([len(polygon) for polygon in Polygons])])
+    Table["PolygonVertices"] = np.concatenate(Polygons) if len(Polygons) > 0 else np.empty((0, 2))
+    Table["PanelNames"] = np.array([f"{name} {panel_name}" for name, component in zip(geometry.Names, surface_map.Components)
+                                    for panel_name in component.PanelNames])
+    Table["PanelExtents"] = surface_map.PanelExtents
+    return Table
+
+
+def saveChannelGeometry(Table, output_path):
+    np.savez(output_path, **Table)
+
+
+def loadChannelGeometry(geometry_path):
+    with np.load(geometry_path) as saved:
+        return {key: saved[key] for key in saved.files}
+
+
+def channelPolygons(Table):
+    # (vertices, 2) outline of every channel of the table
+    Offsets = Table["PolygonOffsets"]
+    return [Table["PolygonVertices"][start:stop] for start, stop in zip(Offsets[:-1], Offsets[1:])]
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--output": None, "--photons": str(1 << 20)}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+
+    if len(arguments) < 2:
+        print("Please provide a YAML card and a file path as arguments.")
+    else:
+        yaml_card, file_path = arguments[0], arguments[1]
+        components = arguments[2:] if len(arguments) > 2 else None
+        output_path = options["--output"] or channelGeometryPath(yaml_card)
+        try:
+            Table = buildChannelGeometry(yaml_card, file_path, components, int(options["--photons"]))
+        except FileNotFoundError as error:
+            print(error)
+            sys.exit(1)
+        saveChannelGeometry(Table, output_path)
+
+        print(f"{len(Table['ChannelIDs'])} channels located, {np.sum(Table['FromTiles'])} from their own tiles "
+              f"and {np.sum(~Table['FromTiles'])} from their photons only")
+        for panel in np.unique(Table["Panels"]):
+            print(f"{Table['PanelNames'][panel]:<24}{np.sum(Table['Panels'] == panel):>6} channels")
+        print(f"Channel geometry written to '{output_path}'.")
@@ -0,0 +1,146 @@
+import numpy as np
+import h5py
+import os
+import sys
+import scipy.sparse as sparse
+
+from simulationData import getDataset, readDataset, NumChannels
+
+'''
+Turns the flat channel output of a run into a sparse event x channel charge matrix, so that
+event-level questions no longer need a pass over the file each.
+
+Chroma writes the channels of all events one after the other in ChannelIDs/ChannelCharges,
+so the event boundaries have to come from a per-event count. They are taken from, in order:
+  - NumChannelsHit, the number of channel entries of each event, when the run wrote it;
+  - NumDetected, when there is one channel entry per detected photon;
+  - otherwise the matrix is built from DetectorHit and NumDetected, every detected photon
+    adding a charge of 1 to the channel it hit.
+The matrix is stored in CSR form (one row per event) next to the run as <run>.channels.npz,
+and the per-event sums, multiplicities, per-channel distributions and channel-channel
+covariance are sparse products on it.
+
+Intended use case: python3 channelMatrix.py <PATH> [--rebuild]
+prints a summary of the per-event channel structure of the run, building the matrix if needed.
+'''
+
+def channelMatrixPath(file_path):
+    return os.path.splitext(file_path)[0] + ".channels.npz"
+
+
+def eventOffsets(Counts):
+    # Start of every event in the flat arrays, with the total as the last entry
+    Offsets = np.zeros(len(Counts) + 1, dtype=np.int64)
+    np.cumsum(Counts, out=Offsets[1:])
+    return Offsets
+
+
+def buildChannelMatrix(file_path, num_channels=NumChannels):
+    # Reads the flat channel arrays of a run and returns its (events, channels) CSR matrix
+    with h5py.File(file_path, 'r') as hdf:
+        NumDetected = getDataset(hdf, "NumDetected")
+        NumChannelsHit = getDataset(hdf, "NumChannelsHit")
+        ChannelIDs = getDataset(hdf, "ChannelIDs")
+
+        if NumChannelsHit is not None:
+            Counts = NumChannelsHit[:]
+            Columns = readDataset(hdf, "ChannelIDs")
+            Charges = readDataset(hdf, "ChannelCharges")
+        elif NumDetected is not None and ChannelIDs is not None and len(ChannelIDs) == np.sum(NumDetected[:], dtype=np.int64):
+            Counts = NumDetected[:]
+            Columns = ChannelIDs[:]
+            Charges = readDataset(hdf, "ChannelCharges")
+        elif NumDetected is not None and getDataset(hdf, "DetectorHit") is not None:
+            Counts = NumDetected[:]
+            Columns = readDataset(hdf, "DetectorHit")
+            Charges = np.ones(len(Columns), dtype=np.float32)
+        else:
+            raise KeyError(f"Cannot tell which event the channels of {hdf.filename} belong to, "
+                           "it needs NumChannelsHit, or NumDetected with DetectorHit")
+
+    Offsets = eventOffsets(Counts)
+    if Offsets[-1] != len(Columns):
+        raise ValueError(f"The per-event counts add up to {Offsets[-1]} entries but there are {len(Columns)}")
+
+    Matrix = sparse.csr_matrix((Charges.astype(np.float64), Columns.astype(np.int32), Offsets),
+                               shape=(len(Counts), num_channels))
+    # An event can list a channel more than once (always the case when built from DetectorHit)
+    Matrix.sum_duplicates()
+    return Matrix
+
+
+def loadChannelMatrix(file_path, rebuild=False):
+    # Returns the matrix of a run, building and saving it next to the run the first time
+    matrix_path = channelMatrixPath(file_path)
+    if not rebuild and os.path.exists(matrix_path) and os.path.getmtime(matrix_path) >= os.path.getmtime(file_path):
+        return sparse.load_npz(matrix_path)
+    Matrix = buildChannelMatrix(file_path)
+    sparse.save_npz(matrix_path, Matrix)
+    return Matrix
+
+
+def eventCharges(Matrix):
+    # Total charge of every event
+    return np.asarray(Matrix.sum(axis=1)).ravel()
+
+
+def eventMultiplicity(Matrix):
+    # Number of channels hit in every event
+    return np.diff(Matrix.indptr)
+
+
+def channelTotals(Matrix):
+    # Total charge of every channel over the run, what plotChannelCounts draws
+    return np.asarray(Matrix.sum(axis=0)).ravel()
+
+
+def channelDistribution(Matrix, channel):
+    # Charge of one channel in every event, including the events where it was not hit
+    return Matrix[:, channel].toarray().ravel()
+
+
+def channelCovariance(Matrix):
+    # Channel-channel covariance of the per-event charges, (X^T X - n mean mean^T) / (n - 1)
+    num_events = Matrix.shape[0]
+    Mean = channelTotals(Matrix) / num_events
+    Products = (Matrix.T @ Matrix).toarray()
+    return (Products - num_events * np.outer(Mean, Mean)) / max(num_events - 1, 1)
+
+
+def channelCorrelation(Matrix):
+    Covariance = channelCovariance(Matrix)
+    Sigma = np.sqrt(np.diag(Covariance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Correlation = Covariance / np.outer(Sigma, Sigma)
+    # Channels that were never hit have no correlation with anything
+    return np.nan_to_num(Correlation)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Please provide a file path as an argument.")
+    else:
+        file_path = sys.argv[1]
+        try:
+            Matrix = loadChannelMatrix(file_path, rebuild="--rebuild" in sys.argv)
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            sys.exit(1)
+        except KeyError as error:
+            print(error)
+            sys.exit(1)
+
+        Charges = eventCharges(Matrix)
+        Multiplicity = eventMultiplicity(Matrix)
+        print(f"{Matrix.shape[0]} events, {Matrix.nnz} event-channel entries, saved to '{channelMatrixPath(file_path)}'")
+        print(f"Charge per event: mean {np.mean(Charges):.2f}, std {np.std(Charges):.2f}")
+        print(f"Channels hit per event: mean {np.mean(Multiplicity):.2f}, min {np.min(Multiplicity)}, max {np.max(Multiplicity)}")
+
+        Correlation = channelCorrelation(Matrix)
+        np.fill_diagonal(Correlation, 0)
+        Upper = np.triu_indices_from(Correlation, k=1)
+        Strongest = np.argsort(np.abs(Correlation[Upper]))[::-1][:5]
+        print("Most correlated channel pairs:")
+        for index in Strongest:
+            first, second = Upper[0][index], Upper[1][index]
+            print(f"  {first:>4} - {second:<4} {Correlation[first, second]:+.3f}")
@@ -0,0 +1,229 @@
+import numpy as np
+import h5py
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import chi2, chi2_contingency, ks_2samp, kstwo
+
+from simulationData import countFlags, channelCounts, faceHistograms, describeFlag, getDataset, NumChannels
+from prefetchLoader import PrefetchLoader
+from surfaceMap import SurfaceMap
+
+'''
+Statistical comparison of simulation runs, e.g. before and after a geometry or material
+change, instead of eyeballing two light maps or channel count plots side by side.
+
+Every run is first reduced to a summary in a single streaming pass, reading the next chunks
+(prefetchLoader) while the current one is reduced: its light map (the
+faces of the LoLX cube, or the panels of every component of a YAML card through
+surfaceMap), its total charge per channel, its flag counts and its NumDetected per event.
+Summaries of different runs are built in parallel, one process per run, and each run is
+summarized once however many comparisons it takes part in.
+
+Each candidate is then compared to its baseline with:
+  - the two-sample chi-square of the light maps, bin by bin, with the map of the signed
+    pulls. Runs with different numbers of photons are compared through the usual
+    normalization, (sqrt(N_B / N_A) a - sqrt(N_A / N_B) b)^2 / (a + b) for bin contents a, b;
+  - the same chi-square and pulls for the charge of every channel;
+  - a chi-square test of independence on the table of flag counts of the two runs;
+  - a two-sample Kolmogorov-Smirnov test on the NumDetected distributions.
+Candidates are ranked by the smallest p-value of their tests, so the runs that deviate the
+most from the baseline come first. Real deviations give p-values far below the smallest
+float, so the ranking uses their logarithms (log survival functions), which stay finite.
+Tests that cannot be run (a run without DetectedPos, no photons, a single flag) are
+reported as skipped, with a NaN p-value, and left out of the ranking.
+
+Intended use case: python3 compareRuns.py <BASELINE> <CANDIDATE_1> <CANDIDATE_2> ... [--pairs]
+            [--workers <N>] [--bins <N>] [--yaml <YAML>] [--output <NPZ>]
+With --pairs, runs are compared two by two (<BASELINE_1> <CANDIDATE_1> <BASELINE_2> ...).
+--output saves the pull maps of every comparison to a .npz file.
+'''
+
+# Surface map of the worker processes, built once per YAML card
+SurfaceMaps = dict()
+
+
+def lightMap(DetectedPos, Histograms, num_bins, yaml_card):
+    if yaml_card is None:
+        H = faceHistograms(DetectedPos, num_bins)
+        return H if Histograms is None else Histograms + H
+    if yaml_card not in SurfaceMaps:
+        SurfaceMaps[yaml_card] = SurfaceMap.fromYAMLFile(yaml_card, num_bins=num_bins)
+    return SurfaceMaps[yaml_card].histogram(DetectedPos, Histograms)
+
+
+def summarizeRun(file_path, num_bins=350, yaml_card=None, prefetch_depth=4):
+    # Reductions of a run needed by every comparison, from one pass over each dataset
+    Summary = {"file_path": file_path}
+    with h5py.File(file_path, 'r') as hdf:
+        has_positions = getDataset(hdf, "DetectedPos") is not None
+        has_channels = getDataset(hdf, "ChannelIDs") is not None
+        Summary["NumDetected"] = getDataset(hdf, "NumDetected")[:]
+
+    LightMap = None
+    if has_positions:
+        for _, _, _, chunk in PrefetchLoader(file_path, ["DetectedPos"], depth=prefetch_depth):
+            LightMap = lightMap(chunk["DetectedPos"], LightMap, num_bins, yaml_card)
+    Summary["LightMap"] = LightMap
+
+    Charges = np.zeros(NumChannels)
+    if has_channels:
+        for _, _, _, chunk in PrefetchLoader(file_path, ["ChannelIDs", "ChannelCharges"], depth=prefetch_depth):
+            Charges += channelCounts(chunk["ChannelIDs"], chunk["ChannelCharges"])
+    Summary["ChannelCharges"] = Charges
+
+    FlagCounts = dict()
+    TotalPhotons = 0
+    for _, _, stop, chunk in PrefetchLoader(file_path, ["Flags"], depth=prefetch_depth):
+        FlagCounts = countFlags(chunk["Flags"], FlagCounts)
+        TotalPhotons = stop
+    Summary["FlagCounts"] = FlagCounts
+    Summary["TotalPhotons"] = TotalPhotons
+    return Summary
+
+
+def twoSampleChiSquare(A, B):
+    # Chi-square and signed pulls between two histograms with possibly different totals.
+    # Returns (chi-square, degrees of freedom, pulls); empty bins get a pull of 0.
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    total_A, total_B = np.sum(A), np.sum(B)
+    Pulls = np.zeros(A.shape)
+    if total_A == 0 or total_B == 0:
+        return 0.0, 0, Pulls
+    Filled = (A + B) > 0
+    Pulls[Filled] = (np.sqrt(total_B / total_A) * A[Filled] - np.sqrt(total_A / total_B) * B[Filled]) / np.sqrt(A[Filled] + B[Filled])
+    return float(np.sum(Pulls ** 2)), max(int(np.sum(Filled)) - 1, 0), Pulls
+
+
+def chiSquareLogP(statistic, ndf):
+    # Natural logarithm of the p-value of a chi-square, finite even when the p-value underflows.
+    # NaN when there is nothing to test.
+    return float(chi2.logsf(statistic, ndf)) if ndf > 0 else np.nan
+
+
+def compareSummaries(Baseline, Candidate):
+    Comparison = {"baseline": Baseline["file_path"], "candidate": Candidate["file_path"]}
+    LogPValues = dict()
+
+    # Light map shapes, normalized to the number of photons detected in each run. Runs
+    # without DetectedPos have no light map.
+    if Baseline["LightMap"] is not None and Candidate["LightMap"] is not None:
+        statistic, ndf, Comparison["LightMapPulls"] = twoSampleChiSquare(Baseline["LightMap"], Candidate["LightMap"])
+    else:
+        Shapes = [np.shape(Summary["LightMap"]) for Summary in [Baseline, Candidate] if Summary["LightMap"] is not None]
+        statistic, ndf, Comparison["LightMapPulls"] = np.nan, 0, np.full(Shapes[0], np.nan) if Shapes else None
+    Comparison["LightMapChiSquare"] = (statistic, ndf)
+    LogPValues["light map"] = chiSquareLogP(statistic, ndf)
+
+    statistic, ndf, Comparison["ChannelPulls"] = twoSampleChiSquare(Baseline["ChannelCharges"], Candidate["ChannelCharges"])
+    Comparison["ChannelChiSquare"] = (statistic, ndf)
+    LogPValues["channels"] = chiSquareLogP(statistic, ndf)
+
+    # Flags that appear in either run, as a 2 x K contingency table. The test needs photons
+    # in both runs and at least two flags.
+    Flags = sorted(flag for flag in set(Baseline["FlagCounts"]) | set(Candidate["FlagCounts"])
+                   if Baseline["FlagCounts"].get(flag, 0) + Candidate["FlagCounts"].get(flag, 0) > 0)
+    Table = np.array([[Summary["FlagCounts"].get(flag, 0) for flag in Flags] for Summary in [Baseline, Candidate]]).reshape(2, len(Flags))
+    if len(Flags) > 1 and np.all(np.sum(Table, axis=1) > 0):
+        statistic, _, ndf, Expected = chi2_contingency(Table)
+        LogPValues["flags"] = chiSquareLogP(statistic, ndf)
+        FlagPulls = (Table[1] - Expected[1]) / np.sqrt(np.maximum(Expected[1], 1e-12))
+        Comparison["FlagPulls"] = dict(zip(Flags, FlagPulls))
+    else:
+        LogPValues["flags"] = np.nan
+        Comparison["FlagPulls"] = dict()
+
+    if len(Baseline["NumDetected"]) > 0 and len(Candidate["NumDetected"]) > 0:
+        Comparison["NumDetectedKS"] = ks_2samp(Baseline["NumDetected"], Candidate["NumDetected"]).statistic
+        # Asymptotic distribution of the statistic for the effective sample size of the two samples
+        n, m = len(Baseline["NumDetected"]), len(Candidate["NumDetected"])
+        LogPValues["NumDetected"] = float(kstwo.logsf(Comparison["NumDetectedKS"], max(round(n * m / (n + m)), 1)))
+    Comparison["DetectionFractions"] = tuple(np.sum(Summary["NumDetected"]) / max(Summary["TotalPhotons"], 1) for Summary in [Baseline, Candidate])
+
+    Comparison["LogPValues"] = LogPValues
+    Comparison["PValues"] = {test: np.exp(log_p) for test, log_p in LogPValues.items()}
+    # Worst of the tests that could be run, None if none could
+    Tested = {test: log_p for test, log_p in LogPValues.items() if not np.isnan(log_p)}
+    Comparison["worst"] = min(Tested, key=Tested.get) if Tested else None
+    return Comparison
+
+
+def summarizeRuns(file_paths, num_bins=350, yaml_card=None, num_workers=None):
+    # Summaries of the distinct runs, built in parallel
+    unique_paths = list(dict.fromkeys(file_paths))
+    num_workers = min(num_workers or os.cpu_count() or 1, len(unique_paths))
+    if num_workers <= 1:
+        Summaries = [summarizeRun(file_path, num_bins, yaml_card) for file_path in unique_paths]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            Summaries = list(pool.map(summarizeRun, unique_paths, [num_bins] * len(unique_paths), [yaml_card] * len(unique_paths)))
+    return dict(zip(unique_paths, Summaries))
+
+
+def compareRuns(pairs, num_bins=350, yaml_card=None, num_workers=None):
+    # Comparisons of (baseline, candidate) pairs, ranked from the most to the least significant
+    Summaries = summarizeRuns([path for pair in pairs for path in pair], num_bins, yaml_card, num_workers)
+    Comparisons = [compareSummaries(Summaries[baseline], Summaries[candidate]) for baseline, candidate in pairs]
+    return sorted(Comparisons, key=lambda comparison: comparison["LogPValues"][comparison["worst"]] if comparison["worst"] else np.inf)
+
+
+def printRanking(Comparisons):
+    print(f"{'rank':<6}{'candidate':<32}{'baseline':<32}{'light map':>14}{'channels':>14}{'flags p':>10}{'KS p':>10}{'detected':>18}  worst")
+    for rank, comparison in enumerate(Comparisons, 1):
+        light_statistic, light_ndf = comparison["LightMapChiSquare"]
+        channel_statistic, channel_ndf = comparison["ChannelChiSquare"]
+        PValues = comparison["PValues"]
+        before, after = comparison["DetectionFractions"]
+        worst = comparison["worst"]
+        if worst is not None:
+            worst = f"{worst} (p = {PValues[worst]:.3g}, log10 p = {comparison['LogPValues'][worst] / np.log(10):.1f})"
+        print(f"{rank:<6}{os.path.basename(comparison['candidate']):<32}{os.path.basename(comparison['baseline']):<32}"
+              f"{light_statistic / light_ndf if light_ndf > 0 else np.nan:>14.3f}{channel_statistic / channel_ndf if channel_ndf > 0 else np.nan:>14.3f}"
+              f"{PValues['flags']:>10.3g}{PValues.get('NumDetected', np.nan):>10.3g}{before:>8.4f} -> {after:.4f}"
+              f"  {worst or 'no test could be run'}")
+
+    print("\nLight map and channel columns are chi-square / ndf; nan marks a skipped test.")
+    for comparison in Comparisons:
+        FlagPulls = comparison["FlagPulls"]
+        if len(FlagPulls) > 0:
+            flag = max(FlagPulls, key=lambda flag: abs(FlagPulls[flag]))
+            LightMapPulls = comparison["LightMapPulls"]
+            light_pull = np.nanmax(np.abs(LightMapPulls)) if LightMapPulls is not None and not np.all(np.isnan(LightMapPulls)) else np.nan
+            print(f"{os.path.basename(comparison['candidate'])}: largest flag change {describeFlag(flag)} ({FlagPulls[flag]:+.1f} sigma), "
+                  f"largest light map pull {light_pull:.1f} sigma")
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--workers": None, "--bins": "350", "--yaml": None, "--output": None}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+    use_pairs = "--pairs" in arguments
+    arguments = [argument for argument in arguments if argument != "--pairs"]
+
+    if len(arguments) < 2 or (use_pairs and len(arguments) % 2 != 0):
+        print("Please provide a baseline and at least one candidate (or an even number of runs with --pairs) as arguments.")
+    else:
+        if use_pairs:
+            pairs = list(zip(arguments[0::2], arguments[1::2]))
+        else:
+            pairs = [(arguments[0], candidate) for candidate in arguments[1:]]
+        num_workers = int(options["--workers"]) if options["--workers"] is not None else None
+        try:
+            Comparisons = compareRuns(pairs, int(options["--bins"]), options["--yaml"], num_workers)
+        except FileNotFoundError as error:
+            print(error)
+            sys.exit(1)
+        printRanking(Comparisons)
+
+        if options["--output"] is not None:
+            np.savez_compressed(options["--output"],
+                                Candidates=[comparison["candidate"] for comparison in Comparisons],
+                                Baselines=[comparison["baseline"] for comparison in Comparisons],
+                                LightMapPulls=np.array([comparison["LightMapPulls"] for comparison in Comparisons]),
+                                ChannelPulls=np.array([comparison["ChannelPulls"] for comparison in Comparisons]))
+            print(f"Pull maps written to '{options['--output']}'.")
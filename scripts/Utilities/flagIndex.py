@@ -0,0 +1,277 @@
+import numpy as np
+import h5py
+import os
+import sys
+
+from simulationData import FlagDescriptions, SURFACE_DETECT, getDataset, photonSourceOffsets, describeFlag
+
+'''
+A sidecar index of the flags of a run, so that selections such as "photons with
+REFLECT_SPECULAR" or "photons that hit NAN_ABORT" only read the parts of the file that
+can contain them instead of loading and scanning all of Flags.
+
+The photons are split into blocks made of whole storage chunks of Flags (at least
+MinBlockRows photons), and the index records, for every block, how many photons have each
+of the 32 flag bits set. It is stored next to the run as <run>.flagindex.npz and rebuilt
+when the run is newer; when the directory of the run cannot be written to (read-only or
+shared data), the index is only kept in memory for the rest of the session.
+Building the index is a pass over Flags, so a count that needs that pass anyway
+(countSelected on a run without an index) is made during it instead of after it.
+
+A selection asks for the photons with every bit of require set and no bit of forbid set,
+optionally within a range of events (the sources of the run). Blocks are skipped without
+being read when one of the required bits never occurs in them, or when one of the
+forbidden bits is set for every photon of the block. Only the Flags of the other blocks are
+read, and the other columns are read only over the rows spanned by the selected photons:
+  - per-photon keys (Flags, FinalPosition, PhotonWavelength) share the rows of Flags;
+  - per-detected-photon keys (DetectedPos, DetectorHit) have one row per photon with
+    SURFACE_DETECT, in the same order. The index keeps the number of detected photons
+    before every block, so the row of a detected photon is known without reading the
+    earlier blocks. Asking for them adds SURFACE_DETECT to the required bits.
+
+Intended use case: python3 flagIndex.py <PATH> [--require <FLAGS>] [--forbid <FLAGS>] [--events <START>:<STOP>] [--rebuild]
+<FLAGS> are comma-separated bit names or values, e.g. --require SURFACE_DETECT,REFLECT_SPECULAR
+or --require 68. Prints the number of photons with each bit and the size of the selection.
+'''
+
+MinBlockRows = 1 << 14
+PhotonKeys = ["Flags", "FinalPosition", "PhotonWavelength"]
+DetectedKeys = ["DetectedPos", "DetectorHit"]
+
+
+def flagIndexPath(file_path):
+    return os.path.splitext(file_path)[0] + ".flagindex.npz"
+
+
+def blockRows(Flags):
+    # Whole storage chunks per block, so a block read never touches a chunk of its neighbours
+    chunk_rows = Flags.chunks[0] if Flags.chunks is not None else 1
+    return int(chunk_rows * -(-MinBlockRows // chunk_rows))
+
+
+# Indexes built or loaded during this session, by file path
+Indexes = dict()
+
+
+def buildFlagIndex(file_path, read_rows=1 << 20, visit=None):
+    # Counts of every flag bit in every block of photons of a run. visit(start, Flags) is
+    # called with every chunk of Flags read, so that a pass over the flags can be shared.
+    with h5py.File(file_path, 'r') as hdf:
+        Flags = getDataset(hdf, "Flags")
+        if Flags is None:
+            raise KeyError(f"'Flags' is not present in {hdf.filename}")
+        block_rows = blockRows(Flags)
+        # Whole blocks per read
+        read_rows = max(read_rows // block_rows, 1) * block_rows
+        num_blocks = -(-len(Flags) // block_rows)
+        BitCounts = np.zeros((num_blocks, 32), dtype=np.int64)
+        for start in range(0, len(Flags), read_rows):
+            Chunk = Flags[start:start + read_rows]
+            if visit is not None:
+                visit(start, Chunk)
+            BlockStarts = np.arange(0, len(Chunk), block_rows)
+            first_block = start // block_rows
+            for bit in range(32):
+                Set = ((Chunk >> np.uint32(bit)) & np.uint32(1)).astype(np.int64)
+                BitCounts[first_block:first_block + len(BlockStarts), bit] = np.add.reduceat(Set, BlockStarts)
+
+        DetectedPos = getDataset(hdf, "DetectedPos")
+        num_detected_rows = len(DetectedPos) if DetectedPos is not None else -1
+        length = len(Flags)
+
+    # Detected photons before every block, i.e. their first row in DetectedPos
+    DetectedBefore = np.zeros(num_blocks + 1, dtype=np.int64)
+    np.cumsum(BitCounts[:, SURFACE_DETECT.bit_length() - 1], out=DetectedBefore[1:])
+    return {"BitCounts": BitCounts, "DetectedBefore": DetectedBefore, "block_rows": block_rows, "length": length,
+            "num_detected_rows": num_detected_rows}
+
+
+def loadFlagIndex(file_path, rebuild=False, visit=None):
+    # Returns the index of a run, building and saving it next to the run the first time.
+    # visit is passed to buildFlagIndex, so it is only called when the index is built.
+    index_path = flagIndexPath(file_path)
+    modified = os.path.getmtime(file_path)
+    if not rebuild and file_path in Indexes and Indexes[file_path][0] >= modified:
+        return Indexes[file_path][1]
+    if not rebuild and os.path.exists(index_path) and os.path.getmtime(index_path) >= modified:
+        with np.load(index_path) as saved:
+            Index = {key: (saved[key] if saved[key].ndim > 0 else int(saved[key])) for key in saved.files}
+    else:
+        Index = buildFlagIndex(file_path, visit=visit)
+        try:
+            np.savez(index_path, **Index)
+        except OSError as error:
+            print(f"Could not save the flag index next to the run ({error.strerror}), keeping it in memory only.")
+    Indexes[file_path] = (modified, Index)
+    return Index
+
+
+def bitTotals(Index):
+    # Number of photons of the run with each bit set, without reading the file
+    return {bit: int(np.sum(Index["BitCounts"][:, bit])) for bit in FlagDescriptions if bit > 0}
+
+
+def candidateBlocks(Index, require=0, forbid=0, photon_range=None):
+    # Blocks that may hold photons matching the predicate
+    BitCounts = Index["BitCounts"]
+    block_rows = Index["block_rows"]
+    BlockStarts = np.arange(len(BitCounts), dtype=np.int64) * block_rows
+    BlockLengths = np.minimum(BlockStarts + block_rows, Index["length"]) - BlockStarts
+
+    Candidates = np.ones(len(BitCounts), dtype=bool)
+    for bit in range(32):
+        if require & (1 << bit):
+            Candidates &= BitCounts[:, bit] > 0
+        if forbid & (1 << bit):
+            Candidates &= BitCounts[:, bit] < BlockLengths
+    if photon_range is not None:
+        Candidates &= (BlockStarts < photon_range[1]) & (BlockStarts + BlockLengths > photon_range[0])
+    return np.flatnonzero(Candidates)
+
+
+def matchFlags(Flags, require, forbid):
+    # Photons with every bit of require and none of forbid (both already 32-bit masks)
+    return ((Flags & np.uint32(require)) == require) & ((Flags & np.uint32(forbid)) == 0)
+
+
+def readRows(dataset, Rows):
+    # Rows of a dataset, reading only the span between the first and last of them
+    if len(Rows) == 0:
+        return np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+    return dataset[Rows[0]:Rows[-1] + 1][Rows - Rows[0]]
+
+
+def selectPhotons(file_path, require=0, forbid=0, events=None, keys=(), Index=None):
+    # Photons with every bit of require and none of forbid, optionally in events [start, stop).
+    # Returns a dictionary with their PhotonIndices, Events and Flags, the requested keys,
+    # and the number of blocks read out of the total.
+    if Index is None:
+        Index = loadFlagIndex(file_path)
+    # Flags are 32 bits, so forbid=~68 reads as "every bit but those of 68"
+    require, forbid = int(require) & 0xFFFFFFFF, int(forbid) & 0xFFFFFFFF
+    if any(key in DetectedKeys for key in keys):
+        if Index["num_detected_rows"] != Index["DetectedBefore"][-1]:
+            raise ValueError(f"{file_path} has {Index['num_detected_rows']} detected positions but {Index['DetectedBefore'][-1]} "
+                             "photons with SURFACE_DETECT, so detected photons cannot be matched to their rows")
+        require |= SURFACE_DETECT
+    unknown = [key for key in keys if key not in PhotonKeys + DetectedKeys]
+    if len(unknown) > 0:
+        raise KeyError(f"{unknown} are neither per-photon nor per-detected-photon keys")
+
+    block_rows = Index["block_rows"]
+    Selection = {"PhotonIndices": [], "Flags": [], **{key: [] for key in keys}}
+    with h5py.File(file_path, 'r') as hdf:
+        Offsets = photonSourceOffsets(hdf, Index["length"])
+        photon_range = None if events is None else (Offsets[events[0]], Offsets[events[1]])
+        Blocks = candidateBlocks(Index, require, forbid, photon_range)
+        Flags = getDataset(hdf, "Flags")
+        datasets = {key: getDataset(hdf, key) for key in keys}
+
+        for block in Blocks:
+            start = int(block) * block_rows
+            BlockFlags = Flags[start:start + block_rows]
+            Mask = matchFlags(BlockFlags, require, forbid)
+            if photon_range is not None:
+                Rows = np.arange(start, start + len(BlockFlags))
+                Mask &= (Rows >= photon_range[0]) & (Rows < photon_range[1])
+            Selected = np.flatnonzero(Mask)
+            if len(Selected) == 0:
+                continue
+            Selection["PhotonIndices"].append(start + Selected)
+            Selection["Flags"].append(BlockFlags[Selected])
+
+            if any(key in DetectedKeys for key in keys):
+                # Row of each detected photon of the block, counting from the first of the block
+                DetectedRows = np.cumsum((BlockFlags & np.uint32(SURFACE_DETECT)) != 0, dtype=np.int64) - 1
+                DetectedRows = Index["DetectedBefore"][block] + DetectedRows[Selected]
+            for key, dataset in datasets.items():
+                if key == "Flags":
+                    continue
+                Rows = DetectedRows if key in DetectedKeys else start + Selected
+                Selection[key].append(readRows(dataset, Rows))
+
+        for key in Selection:
+            if len(Selection[key]) > 0:
+                Selection[key] = np.concatenate(Selection[key])
+            elif key in datasets:
+                Selection[key] = np.empty((0,) + datasets[key].shape[1:], dtype=datasets[key].dtype)
+            else:
+                Selection[key] = np.empty(0, dtype=np.int64 if key == "PhotonIndices" else np.uint32)
+    Selection["Events"] = np.searchsorted(Offsets, Selection["PhotonIndices"], side='right') - 1
+    Selection["num_events"] = len(Offsets) - 1
+    Selection["blocks_read"] = len(Blocks)
+    Selection["blocks_total"] = len(Index["BitCounts"])
+    return Selection
+
+
+def countSelected(file_path, require=0, forbid=0, events=None, Index=None):
+    # Number of matching photons in every event of the run. Without an index yet, the photons
+    # are counted during the pass that builds it, which costs the same as a plain scan.
+    require, forbid = int(require) & 0xFFFFFFFF, int(forbid) & 0xFFFFFFFF
+    with h5py.File(file_path, 'r') as hdf:
+        Offsets = photonSourceOffsets(hdf, len(getDataset(hdf, "Flags")))
+    Counts = np.zeros(len(Offsets) - 1, dtype=np.int64)
+    Visited = []
+
+    def visit(start, Flags):
+        Visited.append(start)
+        Events = np.searchsorted(Offsets, start + np.flatnonzero(matchFlags(Flags, require, forbid)), side='right') - 1
+        Counts[:] += np.bincount(Events, minlength=len(Counts))
+
+    if Index is None:
+        Index = loadFlagIndex(file_path, visit=visit)
+    if len(Visited) == 0:
+        Selection = selectPhotons(file_path, require, forbid, Index=Index)
+        Counts = np.bincount(Selection["Events"], minlength=Selection["num_events"])
+    if events is not None:
+        Counts[:events[0]] = 0
+        Counts[events[1]:] = 0
+    return Counts
+
+
+def parseFlags(text):
+    # "SURFACE_DETECT,REFLECT_SPECULAR" or "68" -> 68
+    Bits = {name: 1 << bit for bit, name in FlagDescriptions.items() if bit > 0}
+    value = 0
+    for part in text.split(","):
+        part = part.strip()
+        value |= Bits[part] if part in Bits else int(part, 0)
+    return value
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--require": "0", "--forbid": "0", "--events": None}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+    rebuild = "--rebuild" in arguments
+    arguments = [argument for argument in arguments if argument != "--rebuild"]
+
+    if len(arguments) < 1:
+        print("Please provide a file path as an argument.")
+    else:
+        file_path = arguments[0]
+        try:
+            Index = loadFlagIndex(file_path, rebuild)
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            sys.exit(1)
+
+        print(f"{Index['length']} photons in {len(Index['BitCounts'])} blocks of {Index['block_rows']}")
+        for bit, count in bitTotals(Index).items():
+            if count > 0:
+                print(f"{FlagDescriptions[bit]:<18}{count:>12} ({count / Index['length']:.2%})")
+
+        require, forbid = parseFlags(options["--require"]), parseFlags(options["--forbid"])
+        events = None if options["--events"] is None else tuple(int(value) for value in options["--events"].split(":"))
+        if require != 0 or forbid != 0 or events is not None:
+            keys = ["DetectedPos"] if require & SURFACE_DETECT and Index["num_detected_rows"] == Index["DetectedBefore"][-1] else []
+            Selection = selectPhotons(file_path, require, forbid, events, keys, Index)
+            print(f"\nRequiring {describeFlag(require) if require else 'nothing'}, forbidding {describeFlag(forbid) if forbid else 'nothing'}"
+                  f"{'' if events is None else f', events {events[0]} to {events[1] - 1}'}:")
+            print(f"{len(Selection['PhotonIndices'])} photons, reading {Selection['blocks_read']} of {Selection['blocks_total']} blocks")
+            if len(keys) > 0 and len(Selection["DetectedPos"]) > 0:
+                print(f"Mean detected position: {np.mean(Selection['DetectedPos'], axis=0)}")
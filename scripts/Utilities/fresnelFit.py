@@ -0,0 +1,236 @@
+import numpy as np
+import h5py
+import sys
+
+from simulationData import SURFACE_DETECT, REFLECT_SPECULAR, getDataset, readDataset, photonSourceOffsets
+from uncertainty import binomialErrors
+from flagIndex import countSelected
+from stlGeometry import Geometry
+
+'''
+Fits the complex refractive index n + ik of a material to simulated reflectivity curves,
+i.e. the fraction of photons reflected as a function of the angle of incidence (AOI) as
+produced by reflectivityStudy with the ReflectivityStudy geometry.
+
+The model is the average of the s and p Fresnel reflectivities (randomly polarized photons)
+going from a medium of index n1 into the material. Both the model and its derivatives with
+respect to n and k are analytic, and the least squares problem is solved with
+Levenberg-Marquardt steps taken for every curve at once: a batch of B curves is held as
+(B, M) arrays of angles and reflectivities (padded with NaN when curves have different
+lengths), so a whole calibration scan over runs or wavelengths is fitted in one call.
+
+Intended use case: python3 fresnelFit.py <N1> <PATH_1> <PATH_2> ... [--yaml <YAML>]
+where <N1> is the (real) refractive index of the medium surrounding the sheet. When the
+YAML card of the runs is given, the angles of incidence are computed from the Sheet STL
+instead of assuming the ReflectivityStudy sphere.
+'''
+
+# Radius of the sphere along which mountedLaser moves in the ReflectivityStudy geometry
+SphereRadius = 152.6 # mm
+
+
+def fresnelReflectivity(AOI, n1, n2):
+    # s and p reflectivities for angles of incidence AOI (in degrees). n1 and n2 may be
+    # complex and broadcast against AOI, e.g. n2 of shape (B, 1) against AOI of shape (B, M).
+    theta = np.radians(AOI)
+    cos_i = np.cos(theta)
+    cos_t = np.sqrt(1 - (n1 / n2 * np.sin(theta)) ** 2 + 0j)
+    r_s = (n1 * cos_i - n2 * cos_t) / (n1 * cos_i + n2 * cos_t)
+    r_p = (n2 * cos_i - n1 * cos_t) / (n2 * cos_i + n1 * cos_t)
+    return np.abs(r_s) ** 2, np.abs(r_p) ** 2
+
+
+def averageReflectivityAndGradient(AOI, n1, n2):
+    # Average of the s and p reflectivities, with its derivatives with respect to the real
+    # (n) and imaginary (k) parts of n2. The amplitudes r are holomorphic in n2, so for
+    # R = |r|^2 we have dR/dn = 2 Re(conj(r) dr/dn2) and dR/dk = -2 Im(conj(r) dr/dn2).
+    theta = np.radians(AOI)
+    cos_i = np.cos(theta)
+    sin_i = np.sin(theta)
+    # Powers are written as products, complex ** is several times slower
+    ratio = n1 / n2 * sin_i
+    cos_t = np.sqrt(1 - ratio * ratio + 0j)
+    dcos_t = ratio * ratio / (n2 * cos_t)
+
+    # s-polarization: r_s = (a - u) / (a + u) with a = n1 cos_i and u = n2 cos_t
+    a = n1 * cos_i
+    u = n2 * cos_t
+    du = cos_t + n2 * dcos_t
+    r_s = (a - u) / (a + u)
+    dr_s = -2 * a * du / ((a + u) * (a + u))
+
+    # p-polarization: r_p = (n2 cos_i - n1 cos_t) / (n2 cos_i + n1 cos_t)
+    numerator = n2 * cos_i - n1 * cos_t
+    denominator = n2 * cos_i + n1 * cos_t
+    dr_p = ((cos_i - n1 * dcos_t) * denominator - numerator * (cos_i + n1 * dcos_t)) / (denominator * denominator)
+    r_p = numerator / denominator
+
+    R = (r_s.real * r_s.real + r_s.imag * r_s.imag + r_p.real * r_p.real + r_p.imag * r_p.imag) / 2
+    product = (np.conj(r_s) * dr_s + np.conj(r_p) * dr_p) / 2
+    return R, 2 * np.real(product), -2 * np.imag(product)
+
+
+# The reflectivity of weakly absorbing materials barely depends on k, and curves with n2 < n1
+# have a second minimum near total internal reflection, so every curve is fitted from each
+# of these starting points and the best fit is kept
+StartingPoints = [1.5 + 1j, 1.5 + 0.05j, 0.8 + 0.05j, 3 + 3j]
+
+
+def fitRefractiveIndex(AOI, Reflectivity, n1, Sigma=None, starting_points=StartingPoints, max_iterations=200, tolerance=1e-10):
+    # Least squares fit of n2 = n + ik for a batch of curves of shape (B, M) (a single curve of
+    # shape (M,) is also accepted). NaN entries are ignored. Sigma holds the uncertainty of each
+    # point; without it all points are weighted equally. n1 may be a scalar or hold one value per curve.
+    # Returns a dictionary with n, k, their standard errors and the chi-square per degree of freedom.
+    AOI = np.atleast_2d(AOI).astype(float)
+    Reflectivity = np.atleast_2d(Reflectivity).astype(float)
+    AOI, Reflectivity = np.broadcast_arrays(AOI, Reflectivity)
+    NumCurves = Reflectivity.shape[0]
+    NumStarts = len(starting_points)
+    n1 = np.broadcast_to(np.asarray(n1), (NumCurves,))
+    if Sigma is not None:
+        Sigma = np.broadcast_to(np.atleast_2d(Sigma), Reflectivity.shape)
+
+    # Every (curve, starting point) pair becomes one row of the batch
+    B = NumCurves * NumStarts
+    AOI = np.repeat(AOI, NumStarts, axis=0)
+    Reflectivity = np.repeat(Reflectivity, NumStarts, axis=0)
+    n1 = np.repeat(n1, NumStarts).reshape(B, 1)
+
+    Valid = np.isfinite(AOI) & np.isfinite(Reflectivity)
+    Weights = np.ones_like(Reflectivity) if Sigma is None else 1 / np.maximum(np.repeat(Sigma, NumStarts, axis=0), 1e-12)
+    Weights = np.where(Valid, Weights, 0)
+    AOI = np.where(Valid, AOI, 0)
+    Reflectivity = np.where(Valid, Reflectivity, 0)
+
+    Parameters = np.tile([[np.real(n2), np.imag(n2)] for n2 in starting_points], (NumCurves, 1))
+    Damping = np.full(B, 1e-3)
+
+    def evaluate(Parameters, rows):
+        n2 = (Parameters[:, 0] + 1j * Parameters[:, 1]).reshape(-1, 1)
+        R, dRdn, dRdk = averageReflectivityAndGradient(AOI[rows], n1[rows], n2)
+        Residuals = Weights[rows] * (R - Reflectivity[rows])
+        Jacobian = Weights[rows, :, None] * np.stack([dRdn, dRdk], axis=-1)
+        return Residuals, Jacobian, np.sum(Residuals ** 2, axis=1)
+
+    AllRows = np.arange(B)
+    Residuals, Jacobian, Cost = evaluate(Parameters, AllRows)
+    Converged = np.zeros(B, dtype=bool)
+
+    for iteration in range(max_iterations):
+        # Only the curves still converging are evaluated
+        Active = AllRows[~Converged]
+        if len(Active) == 0:
+            break
+        JTJ = np.einsum('bmi,bmj->bij', Jacobian[Active], Jacobian[Active])
+        JTr = np.einsum('bmi,bm->bi', Jacobian[Active], Residuals[Active])
+
+        # Levenberg-Marquardt step, solved for every curve at once
+        Damped = JTJ + Damping[Active, None, None] * JTJ * np.eye(2) + 1e-15 * np.eye(2)
+        Step = -np.linalg.solve(Damped, JTr[..., None])[..., 0]
+
+        Candidate = Parameters[Active] + Step
+        Candidate[:, 0] = np.maximum(Candidate[:, 0], 1e-3) # n > 0
+        Candidate[:, 1] = np.abs(Candidate[:, 1])          # k >= 0, reflected so it can't stick at 0
+        CandidateResiduals, CandidateJacobian, CandidateCost = evaluate(Candidate, Active)
+
+        Improved = CandidateCost < Cost[Active]
+        Converged[Active] = (Improved & (Cost[Active] - CandidateCost <= tolerance * np.maximum(Cost[Active], 1e-30))) \
+                            | (~Improved & (Damping[Active] > 1e10))
+
+        Updated = Active[Improved]
+        Parameters[Updated] = Candidate[Improved]
+        Residuals[Updated] = CandidateResiduals[Improved]
+        Jacobian[Updated] = CandidateJacobian[Improved]
+        Cost[Updated] = CandidateCost[Improved]
+        Damping[Active] = np.where(Improved, Damping[Active] / 10, Damping[Active] * 10)
+
+    # Keep the best starting point of every curve
+    Best = np.arange(NumCurves) * NumStarts + np.argmin(Cost.reshape(NumCurves, NumStarts), axis=1)
+    Parameters, Jacobian, Cost, Valid, Converged = Parameters[Best], Jacobian[Best], Cost[Best], Valid[Best], Converged[Best]
+
+    # Standard errors from the inverse of the approximate Hessian, scaled by the reduced
+    # chi-square when no uncertainties were given
+    DegreesOfFreedom = np.maximum(np.sum(Valid, axis=1) - 2, 1)
+    ReducedChiSquare = Cost / DegreesOfFreedom
+    JTJ = np.einsum('bmi,bmj->bij', Jacobian, Jacobian) + 1e-15 * np.eye(2)
+    Covariance = np.linalg.inv(JTJ)
+    if Sigma is None:
+        Covariance *= ReducedChiSquare[:, None, None]
+
+    return {
+        "n": Parameters[:, 0],
+        "k": Parameters[:, 1],
+        "n_error": np.sqrt(Covariance[:, 0, 0]),
+        "k_error": np.sqrt(Covariance[:, 1, 1]),
+        "ReducedChiSquare": ReducedChiSquare,
+        "Converged": Converged
+    }
+
+
+def getAOI(Origin, SphereRadius=SphereRadius):
+    # Assuming the ReflectivityStudy geometry is loaded, the angle of incidence follows from
+    # the x-coordinate of each source on the sphere
+    return np.degrees(np.arcsin(Origin[:, 0] / SphereRadius))
+
+
+def sheetAOI(Origin, geometry):
+    # True angle of incidence of each source on the Sheet, following the beam of mountedLaser
+    # (pointed at the origin) to the triangle it hits
+    return geometry.rayIncidenceAngles(Origin, -Origin, component="Sheet")
+
+
+def reflectivityCurve(file_path, geometry=None):
+    # Angle of incidence, number of photons reflected (flag 68, SURFACE_DETECT + REFLECT_SPECULAR)
+    # and number of photons of each source of a reflectivity study run. Without a geometry,
+    # the angles are computed assuming the ReflectivityStudy sphere.
+    with h5py.File(file_path, 'r') as hdf:
+        Offsets = photonSourceOffsets(hdf, len(getDataset(hdf, "Flags")))
+        Origin = readDataset(hdf, "Origin")
+        Wavelength = readDataset(hdf, "PhotonWavelength", 0, 1)[0]
+
+    # Counted chunk by chunk, or from the flag index, as in reflectivityStudy
+    Reflected = SURFACE_DETECT | REFLECT_SPECULAR
+    NumReflected = countSelected(file_path, require=Reflected, forbid=~Reflected)
+    PhotonsPerSource = np.diff(Offsets)
+    AOI = getAOI(Origin) if geometry is None else sheetAOI(Origin, geometry)
+    return AOI, NumReflected, PhotonsPerSource, Wavelength
+
+
+def fitFiles(file_paths, n1, yaml_card=None):
+    # Fits every run in a single batch, padding curves to the same number of sources
+    geometry = None if yaml_card is None else Geometry.fromYAMLFile(yaml_card, components=["Sheet"])
+    Curves = [reflectivityCurve(file_path, geometry) for file_path in file_paths]
+    M = max(len(AOI) for AOI, _, _, _ in Curves)
+    AOI = np.full((len(Curves), M), np.nan)
+    Reflectivity = np.full((len(Curves), M), np.nan)
+    Sigma = np.ones((len(Curves), M))
+    for index, (angles, NumReflected, PhotonsPerSource, _) in enumerate(Curves):
+        AOI[index, :len(angles)] = angles
+        # Sources without photons are left as NaN, which the fit ignores
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Reflectivity[index, :len(angles)] = np.where(PhotonsPerSource > 0, NumReflected / PhotonsPerSource, np.nan)
+            # Symmetric error taken as the larger side of the binomial interval, floored at one
+            # photon so that sources with no reflections keep a finite weight
+            Sigma[index, :len(angles)] = np.maximum(np.max(binomialErrors(NumReflected, PhotonsPerSource), axis=0), 1 / PhotonsPerSource)
+    Fit = fitRefractiveIndex(AOI, Reflectivity, n1, Sigma)
+    Fit["Wavelength"] = np.array([Wavelength for _, _, _, Wavelength in Curves])
+    return Fit
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Please provide the refractive index of the outside medium and at least one file path as arguments.")
+    else:
+        arguments = sys.argv[1:]
+        yaml_card = None
+        if "--yaml" in arguments:
+            index = arguments.index("--yaml")
+            yaml_card = arguments[index + 1]
+            del arguments[index:index + 2]
+        n1 = float(arguments[0])
+        file_paths = arguments[1:]
+        Fit = fitFiles(file_paths, n1, yaml_card)
+        print("file, wavelength (nm), n, k, chi2/ndf")
+        for index, file_path in enumerate(file_paths):
+            print(f"{file_path}, {Fit['Wavelength'][index]}, {Fit['n'][index]:.4f} +/- {Fit['n_error'][index]:.4f}, "
+                  f"{Fit['k'][index]:.4f} +/- {Fit['k_error'][index]:.4f}, {Fit['ReducedChiSquare'][index]:.2f}")
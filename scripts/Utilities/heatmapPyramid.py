@@ -0,0 +1,175 @@
+import numpy as np
+import h5py
+import os
+import sys
+
+from prefetchLoader import PrefetchLoader
+
+'''
+Builds a multi-resolution pyramid of detected photon heatmaps, stored in an HDF5 sidecar
+next to the run, so that detector maps can be zoomed without rebinning every photon.
+
+Photons are binned once, chunk by chunk, at the finest resolution (a 2^n x 2^n grid), the
+next chunks being read by prefetchLoader while the current one is binned. Every
+coarser level is made of 2x2 sums of the previous one, down to a single bin. Each level is
+stored as a chunked dataset whose chunks are the tiles, so a viewer reading the bins covering
+its current view only touches the few tiles under it (see Plotting/viewHeatmapPyramid.py).
+
+The projections available are:
+  - "cylinder": (r * theta, z), the projection of plotDetectedPhotons (with r = 760 mm for nEXO);
+  - "xy", "xz", "yz": the photons' coordinates on two of the detector axes.
+
+Intended use case: python3 heatmapPyramid.py <PATH_1> <PATH_2> ... [--output <SIDECAR>] [--levels <N>]
+            [--projection <PROJECTION>] [--radius <R>]
+With several runs, their photons are summed into one pyramid. By default the sidecar is
+written next to the first run as <run>.pyramid.h5 and the finest level has 4096 x 4096 bins.
+'''
+
+TileSize = 256
+
+
+def project(DetectedPos, projection="cylinder", radius=760):
+    # 2D coordinates of the detected positions in the chosen projection
+    x, y, z = DetectedPos[:, 0], DetectedPos[:, 1], DetectedPos[:, 2]
+    if projection == "cylinder":
+        # Map from (x, y) points into angle from positive x-axis
+        theta = np.mod(np.arctan2(y, x), 2 * np.pi)
+        return radius * theta, z
+    axes = {"x": x, "y": y, "z": z}
+    if len(projection) == 2 and all(axis in axes for axis in projection):
+        return axes[projection[0]], axes[projection[1]]
+    raise ValueError(f"Unknown projection '{projection}', use 'cylinder', 'xy', 'xz' or 'yz'")
+
+
+def projectionExtent(file_paths, projection="cylinder", radius=760, prefetch_depth=4):
+    # Range of the projected coordinates over all runs, found with a first pass over the positions
+    Minimum = np.array([np.inf, np.inf])
+    Maximum = np.array([-np.inf, -np.inf])
+    for _, _, _, chunk in PrefetchLoader(file_paths, ["DetectedPos"], depth=prefetch_depth):
+        u, v = project(chunk["DetectedPos"], projection, radius)
+        if len(u) > 0:
+            Minimum = np.minimum(Minimum, [np.min(u), np.min(v)])
+            Maximum = np.maximum(Maximum, [np.max(u), np.max(v)])
+    if projection == "cylinder":
+        Minimum[0], Maximum[0] = 0, 2 * np.pi * radius
+    # Avoid empty ranges when all photons share a coordinate
+    Maximum = np.where(Maximum > Minimum, Maximum, Minimum + 1)
+    return Minimum[0], Maximum[0], Minimum[1], Maximum[1]
+
+
+def pyramidPath(file_path):
+    return os.path.splitext(file_path)[0] + ".pyramid.h5"
+
+
+def buildPyramid(file_paths, output_path=None, num_levels=13, projection="cylinder", radius=760, extent=None, prefetch_depth=4):
+    # Bins the detected photons of all runs at 2^(num_levels - 1) bins per side and writes
+    # every level of the pyramid to output_path. Returns the path of the sidecar.
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    if output_path is None:
+        output_path = pyramidPath(file_paths[0])
+    if extent is None:
+        extent = projectionExtent(file_paths, projection, radius, prefetch_depth)
+    u_min, u_max, v_min, v_max = extent
+
+    bins = 2 ** (num_levels - 1)
+    Finest = np.zeros(bins * bins, dtype=np.int64)
+    NumPhotons = 0
+    for _, _, _, chunk in PrefetchLoader(file_paths, ["DetectedPos"], depth=prefetch_depth):
+        u, v = project(chunk["DetectedPos"], projection, radius)
+        Column = np.floor((u - u_min) / (u_max - u_min) * bins).astype(np.int64)
+        Row = np.floor((v - v_min) / (v_max - v_min) * bins).astype(np.int64)
+        # Points exactly on the upper edge belong to the last bin, like in np.histogram2d
+        Column[Column == bins] = bins - 1
+        Row[Row == bins] = bins - 1
+        Inside = (Column >= 0) & (Column < bins) & (Row >= 0) & (Row < bins)
+        Finest += np.bincount(Column[Inside] * bins + Row[Inside], minlength=bins * bins)
+        NumPhotons += int(np.sum(Inside))
+
+    Level = Finest.reshape(bins, bins)
+    with h5py.File(output_path, 'w') as pyramid:
+        pyramid.attrs["Projection"] = projection
+        pyramid.attrs["Radius"] = radius
+        pyramid.attrs["Extent"] = np.array(extent, dtype=np.float64)
+        pyramid.attrs["NumLevels"] = num_levels
+        pyramid.attrs["NumPhotons"] = NumPhotons
+        pyramid.attrs["Sources"] = [os.path.abspath(file_path) for file_path in file_paths]
+
+        for level in range(num_levels):
+            tile = min(TileSize, Level.shape[0])
+            pyramid.create_dataset(f"level_{level}", data=Level, chunks=(tile, tile), compression="lzf", shuffle=True)
+            # Next level: sums of 2x2 blocks
+            if Level.shape[0] > 1:
+                half = Level.shape[0] // 2
+                Level = Level.reshape(half, 2, half, 2).sum(axis=(1, 3))
+
+    return output_path
+
+
+class HeatmapPyramid:
+    # Read access to a pyramid sidecar, reading only the tiles covering a view
+    def __init__(self, pyramid_path):
+        self.hdf = h5py.File(pyramid_path, 'r')
+        self.Extent = tuple(self.hdf.attrs["Extent"])
+        self.NumLevels = int(self.hdf.attrs["NumLevels"])
+        self.Projection = self.hdf.attrs["Projection"]
+        if isinstance(self.Projection, bytes):
+            self.Projection = self.Projection.decode()
+
+    def close(self):
+        self.hdf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def levelBins(self, level):
+        return self.hdf[f"level_{level}"].shape[0]
+
+    def chooseLevel(self, u_min, u_max, v_min, v_max, max_pixels):
+        # Finest level whose bins in the view fit in max_pixels along each axis
+        u_fraction = (u_max - u_min) / (self.Extent[1] - self.Extent[0])
+        v_fraction = (v_max - v_min) / (self.Extent[3] - self.Extent[2])
+        for level in range(self.NumLevels):
+            bins = self.levelBins(level)
+            if max(u_fraction, v_fraction) * bins <= max_pixels:
+                return level
+        return self.NumLevels - 1
+
+    def readView(self, u_min, u_max, v_min, v_max, max_pixels=1024, level=None):
+        # Returns (counts, extent of the returned bins, level) for the requested view.
+        # Only the bins (and therefore tiles) overlapping the view are read.
+        if level is None:
+            level = self.chooseLevel(u_min, u_max, v_min, v_max, max_pixels)
+        bins = self.levelBins(level)
+        e_u0, e_u1, e_v0, e_v1 = self.Extent
+        u_width = (e_u1 - e_u0) / bins
+        v_width = (e_v1 - e_v0) / bins
+
+        i0 = int(np.clip(np.floor((u_min - e_u0) / u_width), 0, bins - 1))
+        i1 = int(np.clip(np.ceil((u_max - e_u0) / u_width), i0 + 1, bins))
+        j0 = int(np.clip(np.floor((v_min - e_v0) / v_width), 0, bins - 1))
+        j1 = int(np.clip(np.ceil((v_max - e_v0) / v_width), j0 + 1, bins))
+
+        Counts = self.hdf[f"level_{level}"][i0:i1, j0:j1]
+        extent = (e_u0 + i0 * u_width, e_u0 + i1 * u_width, e_v0 + j0 * v_width, e_v0 + j1 * v_width)
+        return Counts, extent, level
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--output": None, "--levels": "13", "--projection": "cylinder", "--radius": "760"}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+
+    if len(arguments) < 1:
+        print("Please provide at least one file path as an argument.")
+    else:
+        output_path = buildPyramid(arguments, options["--output"], int(options["--levels"]),
+                                   options["--projection"], float(options["--radius"]))
+        print(f"Pyramid written to '{output_path}'.")
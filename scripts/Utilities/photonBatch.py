@@ -0,0 +1,149 @@
+import numpy as np
+import h5py
+import sys
+
+from simulationData import getDataset
+
+'''
+A compact in-memory representation of photons for the analysis scripts, to keep their
+working memory close to the size of the data on disk.
+
+A PhotonBatch holds the columns of a set of photons (x, y, z, wavelength, flags and event)
+in a single buffer, one contiguous block per column, with compact types: float32 for
+positions and wavelengths, uint32 for flags and int32 for event IDs. Only the columns asked
+for are allocated. Columns are read from the file straight into their block, without going
+through an (N, 3) array, and batch["x"] returns a view of the block rather than a copy, so
+x, y and z no longer need np.transpose(DetectedPos) and its copies.
+
+filter(mask) keeps the photons of a mask in place: every column is compacted block by block
+towards its start, so the only temporary is the size of one block.
+
+Intended use case: python3 photonBatch.py <PATH> [<KEY>]
+loads the photons of <KEY> (DetectedPos by default) with every column available for them and
+prints the memory the batch takes.
+'''
+
+ColumnTypes = {
+    "x": np.float32,
+    "y": np.float32,
+    "z": np.float32,
+    "wavelength": np.float32,
+    "flags": np.uint32,
+    "event": np.int32
+}
+PositionColumns = ("x", "y", "z")
+
+# Per-photon datasets that can fill each column, for positions read from DetectedPos or FinalPosition
+ColumnSources = {
+    "DetectedPos": {"count": "NumDetected"},
+    "FinalPosition": {"wavelength": "PhotonWavelength", "flags": "Flags", "count": "NumPhotons"}
+}
+
+
+class PhotonBatch:
+    def __init__(self, capacity, columns=PositionColumns):
+        self.capacity = capacity
+        self.size = 0
+        self.columns = tuple(columns)
+        row_bytes = sum(np.dtype(ColumnTypes[name]).itemsize for name in self.columns)
+        self.buffer = np.empty(capacity * row_bytes, dtype=np.uint8)
+
+        # Each column is a contiguous block of the buffer
+        self.Blocks = dict()
+        offset = 0
+        for name in self.columns:
+            dtype = np.dtype(ColumnTypes[name])
+            self.Blocks[name] = self.buffer[offset:offset + capacity * dtype.itemsize].view(dtype)
+            offset += capacity * dtype.itemsize
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        # Zero-copy view of a column
+        return self.Blocks[name][:self.size]
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def filter(self, Mask, block_rows=1 << 16):
+        # Keeps the photons where Mask is True, in place. Rows only move towards the start
+        # of their column, so compacting block by block never overwrites unread rows.
+        Mask = np.asarray(Mask, dtype=bool)
+        if len(Mask) != self.size:
+            raise ValueError(f"The mask has {len(Mask)} entries for {self.size} photons")
+        write = 0
+        for start in range(0, self.size, block_rows):
+            Kept = Mask[start:start + block_rows]
+            num_kept = int(np.count_nonzero(Kept))
+            for name in self.columns:
+                Column = self.Blocks[name]
+                Column[write:write + num_kept] = Column[start:start + block_rows][Kept]
+            write += num_kept
+        self.size = write
+        return self
+
+    @classmethod
+    def fromFile(cls, hdf, key="DetectedPos", columns=PositionColumns, start=0, stop=None, block_rows=1 << 20):
+        # Photons [start, stop) of a run. Positions come from key (DetectedPos or
+        # FinalPosition); wavelength and flags are only available for FinalPosition, whose
+        # rows are every simulated photon. Event IDs follow NumDetected or NumPhotons.
+        Positions = getDataset(hdf, key)
+        if Positions is None:
+            raise KeyError(f"'{key}' is not present in {hdf.filename}")
+        stop = len(Positions) if stop is None else min(stop, len(Positions))
+        batch = cls(max(stop - start, 0), columns)
+        batch.size = batch.capacity
+
+        for name in batch.columns:
+            Column = batch.Blocks[name]
+            if name in PositionColumns:
+                axis = PositionColumns.index(name)
+                for block in range(start, stop, block_rows):
+                    block_stop = min(block + block_rows, stop)
+                    Destination = Column[block - start:block_stop - start]
+                    if Positions.dtype == Column.dtype:
+                        # The hyperslab of one axis goes straight into the column
+                        Positions.read_direct(Destination, np.s_[block:block_stop, axis])
+                    else:
+                        Destination[:] = Positions[block:block_stop, axis]
+            elif name == "event":
+                Counts = getDataset(hdf, ColumnSources[key]["count"])
+                Offsets = np.concatenate([[0], np.cumsum(Counts[:], dtype=np.int64)])
+                for block in range(start, stop, block_rows):
+                    block_stop = min(block + block_rows, stop)
+                    Column[block - start:block_stop - start] = np.searchsorted(Offsets, np.arange(block, block_stop), side='right') - 1
+            else:
+                source = ColumnSources[key].get(name)
+                dataset = getDataset(hdf, source) if source is not None else None
+                if dataset is None:
+                    raise KeyError(f"The {name} of the photons of '{key}' are not available in {hdf.filename}")
+                for block in range(start, stop, block_rows):
+                    block_stop = min(block + block_rows, stop)
+                    Column[block - start:block_stop - start] = dataset[block:block_stop]
+        return batch
+
+    @classmethod
+    def fromPath(cls, file_path, key="DetectedPos", columns=PositionColumns, start=0, stop=None):
+        with h5py.File(file_path, 'r') as hdf:
+            return cls.fromFile(hdf, key, columns, start, stop)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Please provide a file path as an argument.")
+    else:
+        file_path = sys.argv[1]
+        key = sys.argv[2] if len(sys.argv) > 2 else "DetectedPos"
+        columns = PositionColumns + (("event",) if key == "DetectedPos" else ("wavelength", "flags", "event"))
+        try:
+            batch = PhotonBatch.fromPath(file_path, key, columns)
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            sys.exit(1)
+
+        print(f"{len(batch)} photons of {key} with columns {', '.join(batch.columns)}")
+        print(f"PhotonBatch: {batch.nbytes / 1e6:.1f} MB ({batch.nbytes / max(len(batch), 1):.0f} bytes per photon)")
+        if len(batch) > 0:
+            print(f"Events: {batch['event'][0]} to {batch['event'][-1]}")
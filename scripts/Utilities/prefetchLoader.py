@@ -0,0 +1,152 @@
+import numpy as np
+import h5py
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from simulationData import getDataset
+
+'''
+Pipelined reading of the chunks of one or many runs, so that the next chunks are read while
+the current one is binned or reduced instead of leaving the disk or the CPU idle.
+
+A background thread walks through the chunks of every file in order and hands their reads
+to reader threads (or reader processes, since h5py holds the GIL during most of a read).
+A read is only submitted once one of depth slots is free, and a slot is freed when its
+chunk is handed to the analysis: when the analysis falls behind, the slots run out and
+reading pauses (backpressure), so at most depth chunks are being read or waiting, plus the
+one being analyzed. Chunks are always delivered in file and row order.
+
+The loader keeps throughput counters: bytes and chunks delivered, time spent reading, time
+the analysis spent waiting for data and time it spent on its own work. A wait time close to
+zero means the analysis is compute bound; a compute time close to zero means it is I/O bound.
+
+Usage within a script:
+    loader = PrefetchLoader(file_paths, ["DetectedPos"], depth=4)
+    for file_path, start, stop, chunk in loader:
+        ... chunk["DetectedPos"] ...
+    print(loader.report())
+
+Intended use case: python3 prefetchLoader.py <KEY> <PATH_1> <PATH_2> ... [--depth <N>] [--readers <N>] [--processes]
+reads every chunk of the dataset and prints the throughput counters.
+'''
+
+def readChunk(file_path, keys, start, stop):
+    # Rows [start, stop) of the keys, with the time the read took. Opening the file costs
+    # little next to reading a chunk, and it keeps readers free of shared state.
+    read_start = time.perf_counter()
+    with h5py.File(file_path, 'r') as hdf:
+        chunk = {key: getDataset(hdf, key)[start:stop] for key in keys}
+    return chunk, time.perf_counter() - read_start
+
+
+class PrefetchLoader:
+    def __init__(self, file_paths, keys, chunk_rows=1 << 20, depth=4, num_readers=1, use_processes=False):
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+        self.file_paths = file_paths
+        self.keys = keys
+        self.chunk_rows = chunk_rows
+        self.depth = depth
+        self.num_readers = num_readers
+        self.use_processes = use_processes
+        self.Counters = {"chunks": 0, "bytes": 0, "read_seconds": 0.0, "wait_seconds": 0.0, "compute_seconds": 0.0, "wall_seconds": 0.0}
+
+    def chunks(self):
+        # (file_path, start, stop) of every chunk, in order
+        for file_path in self.file_paths:
+            with h5py.File(file_path, 'r') as hdf:
+                datasets = [getDataset(hdf, key) for key in self.keys]
+                if any(dataset is None for dataset in datasets):
+                    raise KeyError(f"{self.keys} are not all present in {file_path}")
+                lengths = {len(dataset) for dataset in datasets}
+                if len(lengths) != 1:
+                    raise ValueError(f"Keys {self.keys} do not have the same number of rows in {file_path}")
+                length = lengths.pop()
+            for start in range(0, length, self.chunk_rows):
+                yield file_path, start, min(start + self.chunk_rows, length)
+
+    def __iter__(self):
+        Executor = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        executor = Executor(self.num_readers)
+        Pending = queue.Queue()
+        Slots = threading.Semaphore(self.depth)
+        stopping = threading.Event()
+        Done = object()
+
+        def produce():
+            # Submits the reads in order, each once a slot is free
+            try:
+                for file_path, start, stop in self.chunks():
+                    while not Slots.acquire(timeout=0.1):
+                        if stopping.is_set():
+                            return
+                    if stopping.is_set():
+                        return
+                    Pending.put((file_path, start, stop, executor.submit(readChunk, file_path, self.keys, start, stop)))
+                Pending.put(Done)
+            except Exception as error:
+                Pending.put(error)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        wall_start = time.perf_counter()
+        producer.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item = Pending.get()
+                if item is Done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                file_path, start, stop, future = item
+                chunk, read_seconds = future.result()
+                Slots.release()
+                delivered = time.perf_counter()
+                self.Counters["wait_seconds"] += delivered - wait_start
+                self.Counters["read_seconds"] += read_seconds
+                self.Counters["chunks"] += 1
+                self.Counters["bytes"] += sum(rows.nbytes for rows in chunk.values())
+
+                yield file_path, start, stop, chunk
+                self.Counters["compute_seconds"] += time.perf_counter() - delivered
+        finally:
+            stopping.set()
+            producer.join()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.Counters["wall_seconds"] += time.perf_counter() - wall_start
+
+    def throughput(self):
+        # Bytes delivered per second of wall time
+        return self.Counters["bytes"] / max(self.Counters["wall_seconds"], 1e-12)
+
+    def report(self):
+        Counters = self.Counters
+        return (f"{Counters['chunks']} chunks, {Counters['bytes'] / 1e6:.1f} MB in {Counters['wall_seconds']:.2f} s "
+                f"({self.throughput() / 1e6:.1f} MB/s): reading {Counters['read_seconds']:.2f} s, "
+                f"waiting for data {Counters['wait_seconds']:.2f} s, computing {Counters['compute_seconds']:.2f} s")
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--depth": "4", "--readers": "1"}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+    use_processes = "--processes" in arguments
+    arguments = [argument for argument in arguments if argument != "--processes"]
+
+    if len(arguments) < 2:
+        print("Please provide a dataset name and at least one file path as arguments.")
+    else:
+        loader = PrefetchLoader(arguments[1:], [arguments[0]], depth=int(options["--depth"]),
+                                num_readers=int(options["--readers"]), use_processes=use_processes)
+        total = 0.0
+        for _, _, _, chunk in loader:
+            total += float(np.sum(chunk[arguments[0]], dtype=np.float64))
+        print(f"Sum of {arguments[0]}: {total:.6g}")
+        print(loader.report())
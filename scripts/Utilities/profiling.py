@@ -0,0 +1,230 @@
+import atexit
+import cProfile
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+'''
+Phase instrumentation for the analysis scripts. Each script marks its load, compute and
+render phases, and when profiling is switched on every phase records:
+  - wall time and CPU time;
+  - bytes read by the process (from /proc/self/io, so h5py reads are included);
+  - peak resident memory during the phase.
+At exit, a JSON trace of the run is written so traces from a whole campaign can be
+aggregated to spot regressions. Optionally the whole run is also profiled with cProfile.
+
+Profiling is off by default and costs nothing then. It is switched on by passing --profile
+to a script or by setting CHROMA_PROFILE=1. Traces go to CHROMA_PROFILE_DIR, by default
+chroma-profiles in the user's cache directory ($XDG_CACHE_HOME or ~/.cache) so that they
+do not end up in the source tree. Passing --cprofile or setting CHROMA_CPROFILE=1 also dumps a .prof
+file next to the trace, to be opened with pstats or snakeviz.
+
+Usage within a script:
+    Profiler = profilerFromArguments("plotChannelCounts")
+    Profiler.begin("load")
+    ...
+    Profiler.begin("compute")  # ends the previous phase
+    ...
+    Profiler.begin("render")
+    ...
+    Profiler.end(draw_figures=True)  # before plt.show()
+
+Matplotlib only draws a figure when it is shown or saved, so the render phase draws the open
+figures before it ends; otherwise it would only time the setup of the artists (and ending it
+after plt.show() would time the user looking at the plot).
+
+Aggregating traces: python3 profiling.py <TRACE_1> <TRACE_2> ...
+prints the median of every counter for each script and phase.
+'''
+
+def defaultTraceDirectory():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "chroma-profiles")
+
+
+def readProcIO():
+    # Bytes read through system calls (rchar) and from the storage layer (read_bytes).
+    # Not available outside of Linux, in which case the counters stay at 0.
+    counters = {"rchar": 0, "read_bytes": 0}
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            for line in io_file:
+                key, value = line.split(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def resetPeakRSS():
+    # Linux can reset the peak RSS of a process, which gives a per-phase peak.
+    # Returns whether it worked; otherwise peaks are those of the whole run so far.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peakRSS():
+    # Peak resident memory in bytes
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PhaseProfiler:
+    def __init__(self, script, enabled=True, trace_directory=None, use_cprofile=False):
+        self.script = script
+        self.enabled = enabled
+        self.trace_directory = trace_directory or defaultTraceDirectory()
+        self.Phases = []
+        self.current = None
+        self.cprofile = None
+        self.written = False
+
+        if not enabled:
+            return
+
+        self.started = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if use_cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        atexit.register(self.finish)
+
+    def begin(self, name):
+        # Starts a phase, ending the current one if any
+        if not self.enabled:
+            return
+        self.end()
+        per_phase_peak = resetPeakRSS()
+        self.current = {
+            "name": name,
+            "wall": time.perf_counter(),
+            "cpu": time.process_time(),
+            "io": readProcIO(),
+            "per_phase_peak": per_phase_peak
+        }
+
+    def end(self, draw_figures=False):
+        # Ends the current phase. With draw_figures, the open matplotlib figures are drawn
+        # first so that the phase includes their rendering.
+        if not self.enabled or self.current is None:
+            return
+        if draw_figures:
+            import matplotlib.pyplot as plt
+            for number in plt.get_fignums():
+                plt.figure(number).canvas.draw()
+        io = readProcIO()
+        self.Phases.append({
+            "name": self.current["name"],
+            "wall_seconds": time.perf_counter() - self.current["wall"],
+            "cpu_seconds": time.process_time() - self.current["cpu"],
+            "bytes_read": io["rchar"] - self.current["io"]["rchar"],
+            "bytes_read_from_storage": io["read_bytes"] - self.current["io"]["read_bytes"],
+            "peak_rss_bytes": peakRSS(),
+            "peak_rss_is_per_phase": self.current["per_phase_peak"]
+        })
+        self.current = None
+
+    @contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def finish(self):
+        # Writes the JSON trace (and the cProfile dump). Called automatically at exit.
+        if not self.enabled or self.written:
+            return
+        self.end()
+        self.written = True
+
+        timestamp = datetime.fromtimestamp(self.started).strftime('%Y-%m-%d_%H-%M-%S')
+        base_name = os.path.join(self.trace_directory, f"{self.script}_{timestamp}_{os.getpid()}")
+        trace = {
+            "script": self.script,
+            "arguments": sys.argv[1:],
+            "host": socket.gethostname(),
+            "started": timestamp,
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            "phases": self.Phases
+        }
+
+        os.makedirs(self.trace_directory, exist_ok=True)
+        with open(base_name + ".json", "w") as trace_file:
+            json.dump(trace, trace_file, indent=2)
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(base_name + ".prof")
+
+        summary = ", ".join(f"{phase['name']} {phase['wall_seconds']:.2f} s" for phase in self.Phases)
+        print(f"Profile of {self.script} ({summary}) written to {base_name}.json", file=sys.stderr)
+
+
+def profilerFromArguments(script):
+    # Builds the profiler of a script from its command line and the environment. The
+    # --profile and --cprofile flags are removed from sys.argv so that the scripts' own
+    # argument handling is unchanged.
+    use_cprofile = "--cprofile" in sys.argv or os.environ.get("CHROMA_CPROFILE", "0") not in ["", "0"]
+    enabled = use_cprofile or "--profile" in sys.argv or os.environ.get("CHROMA_PROFILE", "0") not in ["", "0"]
+    sys.argv[:] = [argument for argument in sys.argv if argument not in ["--profile", "--cprofile"]]
+    return PhaseProfiler(script, enabled, os.environ.get("CHROMA_PROFILE_DIR"), use_cprofile)
+
+
+def aggregateTraces(trace_paths):
+    # Median of every phase counter over the traces, grouped by script and phase
+    grouped = dict()
+    for trace_path in trace_paths:
+        with open(trace_path, "r") as trace_file:
+            trace = json.load(trace_file)
+        for phase in trace["phases"]:
+            grouped.setdefault((trace["script"], phase["name"]), []).append(phase)
+
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+    summary = dict()
+    for key, phases in grouped.items():
+        summary[key] = {
+            "runs": len(phases),
+            "wall_seconds": median([phase["wall_seconds"] for phase in phases]),
+            "cpu_seconds": median([phase["cpu_seconds"] for phase in phases]),
+            "bytes_read": median([phase["bytes_read"] for phase in phases]),
+            "peak_rss_bytes": max(phase["peak_rss_bytes"] for phase in phases)
+        }
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Please provide one or more trace files as arguments.")
+    else:
+        summary = aggregateTraces(sys.argv[1:])
+        print(f"{'script':<24}{'phase':<12}{'runs':>6}{'wall (s)':>12}{'cpu (s)':>12}{'read (MB)':>12}{'peak RSS (MB)':>16}")
+        for (script, phase), counters in sorted(summary.items()):
+            print(f"{script:<24}{phase:<12}{counters['runs']:>6}{counters['wall_seconds']:>12.3f}{counters['cpu_seconds']:>12.3f}"
+                  f"{counters['bytes_read'] / 1e6:>12.1f}{counters['peak_rss_bytes'] / 1e6:>16.1f}")
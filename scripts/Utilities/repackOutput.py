@@ -0,0 +1,381 @@
+import numpy as np
+import h5py
+import os
+import sys
+import time
+
+from simulationData import getDataset, readMetaData
+
+'''
+Rewrites chroma outputs with a storage layout chosen for the way the analysis scripts read
+them, and measures the read throughput of those access patterns before and after.
+
+The candidate layout of a dataset follows its access pattern:
+  - positions (DetectedPos, FinalPosition): scanned column by column over the whole run,
+    so they are chunked as (rows, 1), i.e. split by column, and a scan of x only reads the
+    x chunks;
+  - Flags: read source by source (reflectivityStudy), so a chunk holds the photons of one
+    source when sources have the same number of photons (and fit in 4 chunks);
+  - small per-source arrays (NumDetected, NumPhotons): read whole, so they are stored
+    contiguous and uncompressed, which also lets sharedExecutor memory-map them.
+Other large datasets would be chunked along rows.
+Chunks hold about ChunkBytes bytes and are compressed with the shuffle filter followed by a
+fast codec: lzf by default, or blosc/zstd when the optional hdf5plugin package is installed
+(files written with them need hdf5plugin to be read back).
+
+A layout only helps if it reads faster, which depends on the codec, the disk and the
+original chunking. So the candidate is only used for the datasets that have an access
+pattern to time (LayoutPatterns): the first TrialBytes of the dataset (whole sources for
+Flags) are written in both layouts to trial files next to the output, their access
+patterns are timed from a cold cache, and the candidate is kept only when it is faster.
+Every other dataset, and those for which the candidate is not faster, keep the chunks and
+filters of the original.
+
+Timings are compared fairly: every pattern is first read once from each file without being
+timed (opening the library, loading filters), then the files are timed in turn, in an
+order that alternates between repeats, and the best time of each file is kept.
+
+Attributes of the file, groups and datasets are copied, and every dataset is checked
+against the original after writing.
+
+Intended use case: python3 repackOutput.py <PATH> [--output <PATH>] [--codec <lzf|gzip|blosc|zstd|none>] [--no-benchmark]
+By default the repacked file is written next to the run as <run>.repacked.h5.
+'''
+
+ChunkBytes = 1 << 20
+# Datasets below this size are stored contiguous and uncompressed
+SmallBytes = 1 << 20
+ColumnSplitKeys = ["DetectedPos", "FinalPosition"]
+# Largest sample of a dataset written to the trial files that choose its layout
+TrialBytes = 1 << 26
+
+
+def compressionOptions(codec):
+    # h5py arguments of a codec, always preceded by the shuffle filter
+    if codec == "none":
+        return dict()
+    if codec in ["lzf", "gzip"]:
+        return {"compression": codec, "shuffle": True}
+    try:
+        import hdf5plugin
+    except ImportError:
+        print(f"hdf5plugin is not installed, using lzf instead of {codec}.")
+        return {"compression": "lzf", "shuffle": True}
+    if codec == "blosc":
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if codec == "zstd":
+        return {**hdf5plugin.Zstd(clevel=3), "shuffle": True}
+    raise ValueError(f"Unknown codec '{codec}', use lzf, gzip, blosc, zstd or none")
+
+
+def photonsPerSource(hdf):
+    # Number of photons of every source when they all have the same, None otherwise
+    NumPhotons = getDataset(hdf, "NumPhotons")
+    if NumPhotons is not None and len(NumPhotons) > 0:
+        Counts = NumPhotons[:]
+        if np.all(Counts == Counts[0]) and Counts[0] > 0:
+            return int(Counts[0])
+    Flags = getDataset(hdf, "Flags")
+    num_sources = len(getDataset(hdf, "NumDetected")) if getDataset(hdf, "NumDetected") is not None else 0
+    if Flags is not None and num_sources > 0 and len(Flags) % num_sources == 0:
+        return len(Flags) // num_sources
+    return None
+
+
+def chooseLayout(key, dataset, photons_per_source=None):
+    # Chunk shape of a dataset, or None to store it contiguous
+    if dataset.nbytes <= SmallBytes or len(dataset) == 0:
+        return None
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+    rows = max(ChunkBytes // row_bytes, 1)
+    if key in ColumnSplitKeys and dataset.ndim == 2:
+        return (min(max(ChunkBytes // dataset.dtype.itemsize, 1), len(dataset)), 1)
+    if key == "Flags" and photons_per_source is not None and photons_per_source * dataset.dtype.itemsize <= 4 * ChunkBytes:
+        rows = photons_per_source
+    return (min(rows, len(dataset)),) + dataset.shape[1:]
+
+
+def candidateLayout(key, dataset, options, photons_per_source=None):
+    # create_dataset arguments of the layout chosen for the access pattern of a dataset
+    chunks = chooseLayout(key, dataset, photons_per_source)
+    return dict() if chunks is None else {"chunks": chunks, **options}
+
+
+def originalLayout(dataset):
+    # create_dataset arguments that reproduce the chunks and filters of a dataset
+    return {"dcpl": dataset.id.get_create_plist(), "chunks": dataset.chunks, "maxshape": dataset.maxshape}
+
+
+def copyDataset(source, group, key, layout, copy_rows=1 << 22):
+    target = group.create_dataset(key, shape=source.shape, dtype=source.dtype, **layout)
+    for start in range(0, len(source), copy_rows):
+        stop = min(start + copy_rows, len(source))
+        target[start:stop] = source[start:stop]
+    for name, value in source.attrs.items():
+        target.attrs[name] = value
+    return target
+
+
+def trialKeys(key):
+    # Datasets read by the access patterns that choose the layout of key
+    return {key} | {other for name in LayoutPatterns[key] for other in AccessPatterns[name][0]}
+
+
+def trialRows(dataset, photons_per_source=None):
+    # Number of leading rows of a dataset written to the trial files, whole sources for Flags
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+    rows = min(max(TrialBytes // row_bytes, 1), len(dataset))
+    if photons_per_source is not None and rows < len(dataset):
+        rows = min(max(rows // photons_per_source, 1) * photons_per_source, len(dataset))
+    return rows
+
+
+def writeTrial(hdf, key, layout, rows, trial_path):
+    # Trial file with the first rows of key stored with layout. The other datasets the
+    # patterns need are cut in proportion (e.g. NumDetected to the sources of the sample)
+    # and keep their original layout.
+    total = len(getDataset(hdf, key))
+    with h5py.File(trial_path, 'w') as trial:
+        for other in trialKeys(key):
+            dataset = getDataset(hdf, other)
+            other_rows = rows if other == key else min(-(-len(dataset) * rows // max(total, 1)), len(dataset))
+            other_layout = dict(layout if other == key else originalLayout(dataset))
+            if other_layout.get("chunks") is not None:
+                # Chunks cannot be longer than a fixed-size sample
+                other_layout["chunks"] = (max(min(other_layout["chunks"][0], other_rows), 1),) + tuple(other_layout["chunks"][1:])
+            target = trial.require_group(other).create_dataset(other, shape=(other_rows,) + dataset.shape[1:], dtype=dataset.dtype, **other_layout)
+            target[:] = dataset[:other_rows]
+
+
+def pickLayout(hdf, key, dataset, options, photons_per_source, trial_path):
+    # Candidate layout of a dataset if its access patterns read it faster, else its original one
+    original = originalLayout(dataset)
+    if key not in LayoutPatterns or dataset != getDataset(hdf, key):
+        return original
+    if any(getDataset(hdf, other) is None for other in trialKeys(key)):
+        return original
+    candidate = candidateLayout(key, dataset, options, photons_per_source)
+    rows = trialRows(dataset, photons_per_source if key == "Flags" else None)
+    trial_paths = [trial_path.replace(".trial.", f".trial{index}.") for index in range(2)]
+    try:
+        for layout, path in zip([original, candidate], trial_paths):
+            writeTrial(hdf, key, layout, rows, path)
+        Results = timePatterns(trial_paths, LayoutPatterns[key])
+    finally:
+        for path in trial_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    original_time, candidate_time = (sum(seconds for seconds, _ in Result.values()) for Result in Results)
+    faster = candidate_time < original_time
+    print(f"{key}: keeping the {'repacked' if faster else 'original'} layout "
+          f"({original_time * 1e3:.1f} ms original, {candidate_time * 1e3:.1f} ms repacked, on {rows} of {len(dataset)} rows)")
+    return candidate if faster else original
+
+
+def repackOutput(file_path, output_path=None, codec="lzf"):
+    # Writes the repacked copy of a run and returns its path
+    if output_path is None:
+        output_path = os.path.splitext(file_path)[0] + ".repacked.h5"
+    options = compressionOptions(codec)
+    trial_path = os.path.splitext(output_path)[0] + ".trial.h5"
+
+    with h5py.File(file_path, 'r') as hdf, h5py.File(output_path, 'w') as repacked:
+        for name, value in hdf.attrs.items():
+            repacked.attrs[name] = value
+        photons_per_source = photonsPerSource(hdf)
+
+        def visit(name, item):
+            if isinstance(item, h5py.Group):
+                group = repacked.require_group(name)
+                for attribute, value in item.attrs.items():
+                    group.attrs[attribute] = value
+            elif isinstance(item, h5py.Dataset):
+                parent, key = os.path.split(name)
+                group = repacked.require_group(parent) if parent else repacked
+                if item.ndim == 0:
+                    group.create_dataset(key, data=item[()])
+                else:
+                    copyDataset(item, group, key, pickLayout(hdf, key, item, options, photons_per_source, trial_path))
+
+        hdf.visititems(visit)
+
+    verifyRepack(file_path, output_path)
+    return output_path
+
+
+def verifyRepack(file_path, output_path, compare_rows=1 << 22):
+    # Raises ValueError if any dataset of the repacked file differs from the original
+    with h5py.File(file_path, 'r') as hdf, h5py.File(output_path, 'r') as repacked:
+        def visit(name, item):
+            if not isinstance(item, h5py.Dataset):
+                return
+            copy = repacked[name]
+            if copy.shape != item.shape or copy.dtype != item.dtype:
+                raise ValueError(f"'{name}' changed shape or type while repacking")
+            if item.ndim == 0:
+                Equal = np.array_equal(item[()], copy[()])
+            else:
+                Equal = all(np.array_equal(item[start:start + compare_rows], copy[start:start + compare_rows], equal_nan=item.dtype.kind == 'f')
+                            for start in range(0, len(item), compare_rows))
+            if not Equal:
+                raise ValueError(f"'{name}' differs after repacking")
+        hdf.visititems(visit)
+
+
+def evictFromCache(file_path):
+    # Asks the kernel to drop the cached pages of the file, so reads come from the disk
+    # again. Not available on every platform, in which case the page cache stays warm.
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with open(file_path, 'rb') as opened:
+        os.fsync(opened.fileno())
+        os.posix_fadvise(opened.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def scanColumn(hdf, key="DetectedPos"):
+    # Column scan of positions, as done for a projection on one axis
+    return getDataset(hdf, key)[:, 0].nbytes
+
+
+def scanPositions(hdf, key="DetectedPos"):
+    # Full read of positions, as done by the light maps (DetectedPos) and plot3D (FinalPosition)
+    return getDataset(hdf, key)[:].nbytes
+
+
+def readSourceFlags(hdf, num_reads=50):
+    # Flags of a few sources, each read on its own as reflectivityStudy would per source
+    Flags = getDataset(hdf, "Flags")
+    num_sources = len(getDataset(hdf, "NumDetected"))
+    per_source = len(Flags) // max(num_sources, 1)
+    total = 0
+    for source in np.random.default_rng(0).choice(num_sources, min(num_reads, num_sources), replace=False):
+        total += Flags[source * per_source:(source + 1) * per_source].nbytes
+    return total
+
+
+def readSmall(hdf):
+    # The small per-source arrays
+    return sum(getDataset(hdf, key)[:].nbytes for key in ["NumDetected", "NumPhotons"] if getDataset(hdf, key) is not None)
+
+
+def readCatalog(hdf, repeats=20):
+    # Attributes only, as when listing the parameters of many runs
+    for _ in range(repeats):
+        with h5py.File(hdf.filename, 'r') as opened:
+            readMetaData(opened)
+    return 0
+
+
+# Access patterns with the datasets they need
+AccessPatterns = {
+    "DetectedPos x column": (["DetectedPos"], scanColumn),
+    "DetectedPos full": (["DetectedPos"], scanPositions),
+    "FinalPosition x column": (["FinalPosition"], lambda hdf: scanColumn(hdf, "FinalPosition")),
+    "FinalPosition full": (["FinalPosition"], lambda hdf: scanPositions(hdf, "FinalPosition")),
+    "Flags per source": (["Flags", "NumDetected"], readSourceFlags),
+    "NumDetected/NumPhotons": ([], readSmall),
+    "attributes only (x20)": ([], readCatalog)
+}
+
+# Access patterns timed to choose the layout of a dataset
+LayoutPatterns = {
+    "DetectedPos": ["DetectedPos x column", "DetectedPos full"],
+    "FinalPosition": ["FinalPosition x column", "FinalPosition full"],
+    "Flags": ["Flags per source"],
+    "NumDetected": ["NumDetected/NumPhotons"],
+    "NumPhotons": ["NumDetected/NumPhotons"]
+}
+
+
+def timeCold(file_path, read):
+    # Time of a read from a cold page cache when possible
+    evictFromCache(file_path)
+    start = time.perf_counter()
+    result = read()
+    return time.perf_counter() - start, result
+
+
+def timePatterns(file_paths, names=None, repeats=3):
+    # Best seconds and bytes of the access patterns on each file, as one dictionary per file.
+    # Every pattern is read once from each file before timing, then the files are timed in
+    # turn, in an order alternating between repeats. Patterns some file lacks are skipped.
+    Results = [dict() for _ in file_paths]
+    for name in names or AccessPatterns:
+        keys, pattern = AccessPatterns[name]
+
+        def present(file_path):
+            with h5py.File(file_path, 'r') as hdf:
+                return all(getDataset(hdf, key) is not None for key in keys)
+        if not all(present(file_path) for file_path in file_paths):
+            continue
+
+        def read(file_path):
+            with h5py.File(file_path, 'r') as hdf:
+                return pattern(hdf)
+        for file_path in file_paths:
+            read(file_path)
+
+        Times = [[] for _ in file_paths]
+        Bytes = [0 for _ in file_paths]
+        for repeat in range(repeats):
+            order = range(len(file_paths)) if repeat % 2 == 0 else reversed(range(len(file_paths)))
+            for index in order:
+                seconds, Bytes[index] = timeCold(file_paths[index], lambda: read(file_paths[index]))
+                Times[index].append(seconds)
+        for index in range(len(file_paths)):
+            Results[index][name] = (min(Times[index]), Bytes[index])
+    return Results
+
+
+def repackedKeys(file_path, output_path):
+    # Datasets of LayoutPatterns whose chunks or filters changed while repacking
+    Changed = set()
+    with h5py.File(file_path, 'r') as hdf, h5py.File(output_path, 'r') as repacked:
+        for key in LayoutPatterns:
+            dataset, copy = getDataset(hdf, key), getDataset(repacked, key)
+            if dataset is not None and copy is not None and (dataset.chunks, dataset.compression, dataset.shuffle) != (copy.chunks, copy.compression, copy.shuffle):
+                Changed.add(key)
+    return Changed
+
+
+def printComparison(Before, After, Repacked=None):
+    # With the set of repacked datasets, patterns that only read datasets kept in their
+    # original layout are marked: their change comes from rewriting the file, not from layout
+    print(f"{'access pattern':<26}{'before':>14}{'after':>14}{'speedup':>10}")
+    for name in Before:
+        if name not in After:
+            continue
+        (before_time, num_bytes), (after_time, _) = Before[name], After[name]
+        if num_bytes > 0:
+            before, after = f"{num_bytes / before_time / 1e6:.1f} MB/s", f"{num_bytes / after_time / 1e6:.1f} MB/s"
+        else:
+            before, after = f"{before_time * 1e3:.1f} ms", f"{after_time * 1e3:.1f} ms"
+        keys = [key for key, names in LayoutPatterns.items() if name in names]
+        note = "  (original layout)" if Repacked is not None and keys and not Repacked & set(keys) else ""
+        print(f"{name:<26}{before:>14}{after:>14}{before_time / after_time:>9.2f}x{note}")
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--output": None, "--codec": "lzf"}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+    benchmark = "--no-benchmark" not in arguments
+    arguments = [argument for argument in arguments if argument != "--no-benchmark"]
+
+    if len(arguments) < 1:
+        print("Please provide a file path as an argument.")
+    else:
+        file_path = arguments[0]
+        try:
+            output_path = repackOutput(file_path, options["--output"], options["--codec"])
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            sys.exit(1)
+        print(f"Repacked '{file_path}' ({os.path.getsize(file_path) / 1e6:.1f} MB) into '{output_path}' ({os.path.getsize(output_path) / 1e6:.1f} MB).")
+
+        if benchmark:
+            printComparison(*timePatterns([file_path, output_path]), repackedKeys(file_path, output_path))
@@ -0,0 +1,115 @@
+import numpy as np
+import h5py
+import sys
+
+from simulationData import getDataset
+from prefetchLoader import PrefetchLoader
+
+'''
+Draws a fixed-size, uniformly random subsample of the rows of a dataset (e.g. FinalPosition
+or Origin) in a single streaming pass over its chunks, across any number of files, so that
+point overlays have a bounded number of points whatever the size of the simulation. The
+next chunks are read by prefetchLoader while the current one is sampled.
+
+Every row is given a random key and the rows with the smallest keys are kept (bottom-k
+sampling), which is a uniform sample without replacement. Only the current sample is held
+in memory, and once it is full the rows of a new chunk are only considered when their key
+beats the largest key kept so far. The rows keep their position in the stream, and the
+sample is returned in that order, so colormaps of generation order still work on it.
+
+Intended use case: python3 reservoirSampling.py <KEY> <BUDGET> <PATH_1> <PATH_2> ...
+prints how many rows were drawn out of the total and the first few of them.
+'''
+
+class ReservoirSampler:
+    def __init__(self, budget, rng=None):
+        self.budget = budget
+        self.rng = np.random.default_rng(rng)
+        self.Keys = np.zeros(0)
+        self.Indices = np.zeros(0, dtype=np.int64)
+        self.Rows = None
+        self.seen = 0
+        # Largest key kept once the sample is full; any key is a candidate before that
+        self.threshold = np.inf
+
+    def add(self, Rows, offset=None):
+        # Offers a chunk of rows whose first row is at position offset in the stream
+        # (by default, right after the rows offered so far)
+        if offset is None:
+            offset = self.seen
+        if self.Rows is None:
+            # Empty rows of the right shape and type, returned if nothing is ever kept
+            self.Rows = Rows[:0]
+        self.seen = max(self.seen, offset + len(Rows))
+        if self.budget <= 0:
+            return
+        Keys = self.rng.random(len(Rows))
+        if len(self.Keys) == self.budget:
+            Candidates = np.flatnonzero(Keys < self.threshold)
+        else:
+            Candidates = np.arange(len(Rows))
+        if len(Candidates) == 0:
+            return
+
+        Keys = np.concatenate([self.Keys, Keys[Candidates]])
+        Indices = np.concatenate([self.Indices, offset + Candidates])
+        Rows = np.concatenate([self.Rows, Rows[Candidates]])
+        if len(Keys) > self.budget:
+            Kept = np.argpartition(Keys, self.budget - 1)[:self.budget]
+            Keys, Indices, Rows = Keys[Kept], Indices[Kept], Rows[Kept]
+        self.Keys, self.Indices, self.Rows = Keys, Indices, Rows
+        if len(Keys) == self.budget:
+            self.threshold = np.max(Keys)
+
+    def sample(self):
+        # (positions in the stream, rows) of the sample, in stream order
+        Order = np.argsort(self.Indices, kind='stable')
+        Rows = self.Rows if self.Rows is not None else np.zeros(0)
+        return self.Indices[Order], Rows[Order]
+
+
+def sampleRows(file_paths, key, budget, rng=None, chunk_rows=1 << 20, prefetch_depth=4):
+    # Samples at most budget rows of a dataset over all runs, taken as one stream in the
+    # order of file_paths. Returns (positions in the stream, rows, total number of rows).
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    sampler = ReservoirSampler(budget, rng)
+    # Runs with rows, and the position of their first row in the stream
+    Runs, Offsets = [], []
+    offset = 0
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as hdf:
+            dataset = getDataset(hdf, key)
+            if dataset is None:
+                raise KeyError(f"'{key}' is not present in {file_path}")
+            # Empty datasets still give the shape and type of the rows
+            sampler.add(dataset[0:0], offset)
+            if len(dataset) > 0:
+                Runs.append(file_path)
+                Offsets.append(offset)
+            offset += len(dataset)
+
+    # Chunks come run after run, each run starting with its row 0
+    run = -1
+    for _, start, _, chunk in PrefetchLoader(Runs, [key], chunk_rows, prefetch_depth):
+        if start == 0:
+            run += 1
+        sampler.add(chunk[key], Offsets[run] + start)
+    Indices, Rows = sampler.sample()
+    return Indices, Rows, offset
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("Please provide a dataset name, a number of rows and at least one file path as arguments.")
+    else:
+        key = sys.argv[1]
+        budget = int(sys.argv[2])
+        try:
+            Indices, Rows, total = sampleRows(sys.argv[3:], key, budget)
+        except (FileNotFoundError, KeyError) as error:
+            print(error)
+            sys.exit(1)
+        print(f"Sampled {len(Indices)} of {total} rows of {key}")
+        for index, row in zip(Indices[:10], Rows[:10]):
+            print(f"{index}: {row}")
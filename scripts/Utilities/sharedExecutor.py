@@ -0,0 +1,245 @@
+import numpy as np
+import h5py
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from simulationData import getDataset, countFlags, channelCounts, faceHistograms, NumChannels
+
+'''
+Runs reductions over the datasets of one large file on every core without copying the data
+into each worker.
+
+Each dataset is placed in memory once and shared with the workers:
+  - contiguous, uncompressed datasets are memory-mapped straight from the file, so the
+    workers share the operating system's page cache;
+  - other (chunked or compressed) datasets are read with read_direct into a block of
+    multiprocessing shared memory, without going through an intermediate array.
+Workers attach to the shared arrays once, when they start, and are then only sent index
+ranges [start, stop). Each returns the partial result of a kernel (a histogram, counts or
+sums) over its range, and the partial results are reduced in the parent.
+
+The kernels provided are the reductions of the plotting scripts: the cylindrical projection
+of plotDetectedPhotons, the face light map of plotLoLXLightMap, the flag tally of
+printSimulationOutput and the channel sums of plotChannelCounts. A kernel is any module
+level function kernel(Arrays, start, stop, **kwargs), where Arrays maps dataset names to
+the shared arrays.
+
+Intended use case: python3 sharedExecutor.py <PATH> <KERNEL> [--workers <N>]
+where <KERNEL> is one of cylinder, faces, flags or channels. Prints the reduced result and
+the time it took.
+'''
+
+# Shared arrays of the current worker process, set by attachArrays
+SharedArrays = dict()
+SharedBlocks = []
+
+
+def describeDataset(file_path, dataset):
+    # How a worker can get at a dataset: a memory map of the file when the dataset is
+    # stored contiguously and uncompressed, None when it has to be copied to shared memory
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.compression is not None:
+        return None
+    return ("memmap", file_path, offset, dataset.shape, dataset.dtype.str)
+
+
+def attachArrays(Descriptors):
+    # Worker initializer: maps every shared array into the worker once
+    SharedArrays.clear()
+    for key, (kind, location, offset, shape, dtype) in Descriptors.items():
+        if kind == "memmap":
+            SharedArrays[key] = np.memmap(location, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+        else:
+            # Workers share the resource tracker of the parent, which owns and unlinks the block
+            block = shared_memory.SharedMemory(name=location)
+            SharedBlocks.append(block)
+            SharedArrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def runKernel(kernel, start, stop, kwargs):
+    return kernel(SharedArrays, start, stop, **kwargs)
+
+
+def sumResults(Results):
+    # Default reduction: element-wise sum of the partial histograms, counts or sums
+    Total = Results[0]
+    for Result in Results[1:]:
+        Total = Total + Result
+    return Total
+
+
+def mergeCounts(Results):
+    # Reduction of dictionaries of counts, e.g. flag tallies
+    Total = dict()
+    for Result in Results:
+        for key, count in Result.items():
+            Total[key] = Total.get(key, 0) + count
+    return dict(sorted(Total.items()))
+
+
+def combineRanges(Results):
+    # Reduction of (minimum, maximum) pairs
+    Results = np.array(Results)
+    return np.min(Results[:, 0], axis=0), np.max(Results[:, 1], axis=0)
+
+
+class SharedMemoryExecutor:
+    def __init__(self, file_path, keys, num_workers=None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.Blocks = []
+        self.Arrays = dict()
+        self.Lengths = dict()
+        Descriptors = dict()
+
+        with h5py.File(file_path, 'r') as hdf:
+            for key in keys:
+                dataset = getDataset(hdf, key)
+                if dataset is None:
+                    raise KeyError(f"'{key}' is not present in {file_path}")
+                self.Lengths[key] = len(dataset)
+                descriptor = describeDataset(os.path.abspath(file_path), dataset)
+                if descriptor is None:
+                    block = shared_memory.SharedMemory(create=True, size=max(dataset.nbytes, 1))
+                    self.Blocks.append(block)
+                    Array = np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=block.buf)
+                    if dataset.size > 0:
+                        dataset.read_direct(Array)
+                    descriptor = ("shared", block.name, 0, dataset.shape, dataset.dtype.str)
+                Descriptors[key] = descriptor
+
+        # The parent sees the arrays the same way the workers do
+        for key, (kind, location, offset, shape, dtype) in Descriptors.items():
+            if kind == "memmap":
+                self.Arrays[key] = np.memmap(location, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+            else:
+                block = next(block for block in self.Blocks if block.name == location)
+                self.Arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+        self.pool = None
+        if self.num_workers > 1:
+            self.pool = ProcessPoolExecutor(self.num_workers, initializer=attachArrays, initargs=(Descriptors,))
+
+    def map(self, kernel, length_key, reduce=sumResults, num_tasks=None, **kwargs):
+        # Splits the rows of length_key into ranges, runs the kernel on every range and
+        # reduces the partial results. With a single worker the kernel runs in this process.
+        length = self.Lengths[length_key]
+        num_tasks = num_tasks or 4 * self.num_workers
+        Bounds = np.linspace(0, length, min(num_tasks, max(length, 1)) + 1).astype(np.int64)
+        Ranges = list(zip(Bounds[:-1], Bounds[1:]))
+
+        if self.pool is None:
+            Results = [kernel(self.Arrays, start, stop, **kwargs) for start, stop in Ranges]
+        else:
+            Futures = [self.pool.submit(runKernel, kernel, start, stop, kwargs) for start, stop in Ranges]
+            Results = [future.result() for future in Futures]
+        return reduce(Results)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.Arrays.clear()
+        for block in self.Blocks:
+            block.close()
+            block.unlink()
+        self.Blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Kernels
+
+def cylinderCoordinates(Arrays, start, stop, radius):
+    # Cylindrical projection (r * theta, z) of plotDetectedPhotons
+    x, y, z = np.transpose(np.asarray(Arrays["DetectedPos"][start:stop]))
+    theta = np.mod(np.arctan2(y, x), 2 * np.pi)
+    return radius * theta, z
+
+
+def cylinderRange(Arrays, start, stop, radius=760):
+    projection, z = cylinderCoordinates(Arrays, start, stop, radius)
+    if len(z) == 0:
+        return np.full(2, np.inf), np.full(2, -np.inf)
+    return np.array([np.min(projection), np.min(z)]), np.array([np.max(projection), np.max(z)])
+
+
+def cylinderHistogram(Arrays, start, stop, bin_count, Range, radius=760):
+    projection, z = cylinderCoordinates(Arrays, start, stop, radius)
+    Histogram, _, _ = np.histogram2d(projection, z, bins=bin_count, range=Range)
+    return Histogram
+
+
+def faceHistogram(Arrays, start, stop, num_bins=350, extent=25):
+    # Face light map of the LoLX cube, as in plotLoLXLightMap
+    return faceHistograms(np.asarray(Arrays["DetectedPos"][start:stop]), num_bins, extent)
+
+
+def flagTally(Arrays, start, stop):
+    return countFlags(np.asarray(Arrays["Flags"][start:stop]))
+
+
+def channelSums(Arrays, start, stop, num_channels=NumChannels):
+    return channelCounts(np.asarray(Arrays["ChannelIDs"][start:stop]), np.asarray(Arrays["ChannelCharges"][start:stop]), num_channels)
+
+
+def cylinderProjection(executor, bin_count, radius=760):
+    # Histogram of plotDetectedPhotons and its edges. The range of the projection is found
+    # by a first reduction so that all partial histograms share the same bins, which are
+    # those np.histogram2d picks for the whole array.
+    Minimum, Maximum = executor.map(cylinderRange, "DetectedPos", reduce=combineRanges, radius=radius)
+    Range = [[Minimum[axis], Maximum[axis]] if Maximum[axis] > Minimum[axis] else [Minimum[axis] - 0.5, Minimum[axis] + 0.5] for axis in range(2)]
+    Histogram = executor.map(cylinderHistogram, "DetectedPos", bin_count=bin_count, Range=Range, radius=radius)
+    xedges = np.linspace(Range[0][0], Range[0][1], bin_count + 1)
+    yedges = np.linspace(Range[1][0], Range[1][1], bin_count + 1)
+    return Histogram, xedges, yedges
+
+
+# Datasets, kernel and reduction behind every choice of the command line
+Kernels = {
+    "cylinder": (["DetectedPos"], None, None),
+    "faces": (["DetectedPos"], faceHistogram, sumResults),
+    "flags": (["Flags"], flagTally, mergeCounts),
+    "channels": (["ChannelIDs", "ChannelCharges"], channelSums, sumResults)
+}
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    num_workers = None
+    if "--workers" in arguments:
+        index = arguments.index("--workers")
+        num_workers = int(arguments[index + 1])
+        del arguments[index:index + 2]
+
+    if len(arguments) < 2 or arguments[1] not in Kernels:
+        print(f"Please provide a file path and a kernel ({', '.join(Kernels)}) as arguments.")
+    else:
+        file_path, name = arguments[0], arguments[1]
+        keys, kernel, reduce = Kernels[name]
+        try:
+            start_time = time.perf_counter()
+            with SharedMemoryExecutor(file_path, keys, num_workers) as executor:
+                load_time = time.perf_counter() - start_time
+                if name == "cylinder":
+                    Result, _, _ = cylinderProjection(executor, 1000)
+                else:
+                    Result = executor.map(kernel, keys[0], reduce=reduce)
+                total_time = time.perf_counter() - start_time
+                num_workers = executor.num_workers
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            sys.exit(1)
+
+        if isinstance(Result, dict):
+            for key, count in Result.items():
+                print(f"{key}: {count}")
+        else:
+            print(f"Result of shape {np.shape(Result)}, total {np.sum(Result):.6g}")
+        print(f"{num_workers} workers: {load_time:.2f} s to share the data, {total_time:.2f} s in total")
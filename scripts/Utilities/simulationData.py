@@ -0,0 +1,153 @@
+import numpy as np
+
+'''
+Shared helpers for reading and reducing chroma simulation outputs.
+
+Every array chroma writes lives in a group of the same name, e.g. hdf["Flags"]["Flags"],
+and the run parameters (Generator, NumberOfSources, NumberOfRuns, ...) are stored as
+file attributes. The functions here collect the reading and binning code the plotting
+scripts kept repeating so that new tools can work on slices of a file instead of
+always materializing whole arrays.
+'''
+
+FlagDescriptions = {
+    0: "NO_HIT",
+    1: "BULK_ABSORB",
+    2: "SURFACE_DETECT",
+    3: "SURFACE_ABSORB",
+    4: "RAYLEIGH_SCATTER",
+    5: "REFLECT_DIFFUSE",
+    6: "REFLECT_SPECULAR",
+    7: "SURFACE_REEMIT",
+    8: "SURFACE_TRANSMIT",
+    9: "BULK_REEMIT",
+    10: "MATERIAL_REFL",
+    31: "NAN_ABORT"
+}
+
+# Bit values of the flags used most often in the analyses
+SURFACE_DETECT = 1 << 2
+REFLECT_SPECULAR = 1 << 6
+NAN_ABORT = 1 << 31
+
+# LoLX is a cube of SiPM packages, each face sitting at 20.9 mm from the center
+LoLXHalfWidth = 20.9 # mm
+FaceNames = ['West', 'Bottom', 'East', 'North', 'South', 'Top']
+
+NumChannels = 720
+
+
+def readMetaData(hdf):
+    # Attributes written as bytes are decoded so they print nicely
+    MetaData = dict()
+    for key, value in hdf.attrs.items():
+        if isinstance(value, bytes):
+            MetaData[key] = value.decode()
+        else:
+            MetaData[key] = value
+    return MetaData
+
+
+def getDataset(hdf, key):
+    # Returns the h5py dataset (not its contents) or None if the run did not write it
+    group = hdf.get(key)
+    if group is None:
+        return None
+    return group.get(key)
+
+
+def readDataset(hdf, key, start=None, stop=None):
+    # Reads rows [start, stop) of a dataset. Without bounds the whole array is read.
+    dataset = getDataset(hdf, key)
+    if dataset is None:
+        raise KeyError(f"'{key}' is not present in {hdf.filename}")
+    return dataset[slice(start, stop)]
+
+
+def iterateChunks(hdf, keys, chunk_rows=1 << 20):
+    # Yields (start, stop, {key: rows}) over datasets sharing the same length, so that
+    # a full pass never holds more than chunk_rows rows of each key in memory
+    datasets = {key: getDataset(hdf, key) for key in keys}
+    lengths = {len(dataset) for dataset in datasets.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"Keys {keys} do not have the same number of rows")
+    length = lengths.pop()
+    for start in range(0, length, chunk_rows):
+        stop = min(start + chunk_rows, length)
+        yield start, stop, {key: dataset[start:stop] for key, dataset in datasets.items()}
+
+
+def photonSourceOffsets(hdf, num_photons):
+    # First photon of every source, photons being written source after source
+    NumPhotons = getDataset(hdf, "NumPhotons")
+    if NumPhotons is not None and np.sum(NumPhotons[:], dtype=np.int64) == num_photons:
+        return np.concatenate([[0], np.cumsum(NumPhotons[:], dtype=np.int64)])
+    # Without NumPhotons, the sources are assumed to have the same number of photons
+    num_sources = len(getDataset(hdf, "NumDetected"))
+    if num_sources == 0 or num_photons % num_sources != 0:
+        raise ValueError(f"{hdf.filename} has no NumPhotons matching its {num_photons} photons, and they do not "
+                         f"split evenly between its {num_sources} sources")
+    return np.arange(num_sources + 1, dtype=np.int64) * (num_photons // num_sources)
+
+
+def describeFlag(flag):
+    # Translates a flag into its human-readable combination, e.g. 68 -> SURFACE_DETECT + REFLECT_SPECULAR
+    bits = [bit for bit in FlagDescriptions if int(flag) & (1 << bit)]
+    if len(bits) == 0:
+        return FlagDescriptions[0]
+    return " + ".join(FlagDescriptions[bit] for bit in bits)
+
+
+def countFlags(Flags, counts=None):
+    # Tallies unique flag values into a dictionary, optionally adding to previous counts
+    if counts is None:
+        counts = dict()
+    unique_flags, unique_counts = np.unique(Flags, return_counts=True)
+    for flag, count in zip(unique_flags, unique_counts):
+        counts[int(flag)] = counts.get(int(flag), 0) + int(count)
+    return counts
+
+
+def channelCounts(ChannelIDs, ChannelCharges, num_channels=NumChannels):
+    # Total charge per channel, the vectorized version of summing charges channel by channel
+    return np.bincount(ChannelIDs, weights=ChannelCharges, minlength=num_channels)[:num_channels]
+
+
+def separatePointsByFace(x, y, z, Length=LoLXHalfWidth):
+    # Projects points onto the six faces of the LoLX cube. The returned list follows
+    # FaceNames and holds the two in-plane coordinates of the points on each face.
+    # The coordinates of every face are gathered into one buffer, and each face gets
+    # views of its slice of it rather than its own masked copies.
+    Masks = [x < -Length, z < -Length, x > Length, y < -Length, y > Length, z > Length]
+    # In-plane coordinates of each face, with the sign they are drawn with
+    Planes = [
+        [(y, 1), (z, 1)],
+        [(y, 1), (x, -1)],
+        [(y, -1), (z, 1)],
+        [(x, -1), (z, 1)],
+        [(z, 1), (x, 1)],
+        [(x, 1), (y, 1)]
+    ]
+
+    Offsets = np.concatenate([[0], np.cumsum([np.count_nonzero(Mask) for Mask in Masks])])
+    Buffer = np.empty((2, Offsets[-1]), dtype=np.result_type(x, y, z))
+    PackagedCube = []
+    for Mask, Plane, start, stop in zip(Masks, Planes, Offsets[:-1], Offsets[1:]):
+        Face = []
+        for row, (coordinate, sign) in enumerate(Plane):
+            View = Buffer[row, start:stop]
+            np.compress(Mask, coordinate, out=View)
+            if sign < 0:
+                np.negative(View, out=View)
+            Face.append(View)
+        PackagedCube.append(Face)
+    return PackagedCube
+
+
+def faceHistograms(DetectedPos, num_bins=350, extent=25, Length=LoLXHalfWidth):
+    # 2D histogram of each face of the LoLX cube, with shape (6, num_bins, num_bins)
+    x, y, z = DetectedPos[:, 0], DetectedPos[:, 1], DetectedPos[:, 2]
+    Histograms = np.zeros((len(FaceNames), num_bins, num_bins))
+    for face_index, (dim1, dim2) in enumerate(separatePointsByFace(x, y, z, Length)):
+        Histograms[face_index], _, _ = np.histogram2d(dim1, dim2, bins=num_bins, range=[[-extent, extent], [-extent, extent]])
+    return Histograms
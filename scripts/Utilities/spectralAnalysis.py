@@ -0,0 +1,271 @@
+import numpy as np
+import h5py
+import pandas as pd
+import yaml
+import sys
+
+from simulationData import FlagDescriptions, SURFACE_DETECT, REFLECT_SPECULAR, getDataset, iterateChunks, photonSourceOffsets
+from uncertainty import binomialInterval
+from fresnelFit import fresnelReflectivity, getAOI, sheetAOI
+from stlGeometry import Geometry
+from prefetchLoader import PrefetchLoader
+
+'''
+Wavelength-resolved analysis of runs whose photons do not all share one wavelength, e.g.
+spectral sources such as LXe scintillation.
+
+PhotonWavelength is binned and, for every wavelength bin, the fraction of photons detected,
+the reflectivity (fraction of photons with flag 68, SURFACE_DETECT + REFLECT_SPECULAR, as in
+reflectivityStudy) and the fraction of photons with each flag bit set are computed.
+
+Everything comes from a single grouped pass over the photons, read chunk by chunk (the next
+chunks being read by prefetchLoader while the current one is tallied): each
+photon gets the key (wavelength bin, flag), or (source, wavelength bin, flag) when sources
+are kept apart, and only the counts of the distinct keys are kept. There are few distinct
+flags, so that table stays tiny whatever the size of the run and every quantity above is a
+weighted bincount over it.
+
+The result is a pandas table with one row per wavelength bin (and source), which can be
+joined against the optical properties used by the simulation: every wavelength-dependent
+property is interpolated at the bin centers, so the simulation can be compared to theory
+(e.g. the Fresnel reflectivity of the Sheet) bin by bin.
+
+Intended use case: python3 spectralAnalysis.py <NUM_BINS> <PATH_1> <PATH_2> ... [--yaml <YAML>] [--csv <OUTPUT>]
+With the YAML card of the runs, the optical properties of the materials of every component
+are joined to the table, and when there is a Sheet component the average Fresnel reflectivity
+over the sources is added for each bin. --csv writes the table to a file.
+'''
+
+# Flag bits reported as fractions, NO_HIT being the absence of any bit
+FlagBits = [bit for bit in FlagDescriptions if bit > 0]
+
+
+def interpolateProperty(Value, Wavelengths):
+    # Value of an optical property at the given wavelengths. Properties are either single
+    # valued or tables of (wavelength, value) tuples as written by CSVtoYAML.
+    Wavelengths = np.asarray(Wavelengths, dtype=float)
+    if isinstance(Value, dict):
+        Table = np.array(list(Value.values()), dtype=float)
+        Table = Table[np.argsort(Table[:, 0])]
+        return np.interp(Wavelengths, Table[:, 0], Table[:, 1])
+    return np.full(Wavelengths.shape, float(Value))
+
+
+def complexIndex(Properties, Wavelengths):
+    # Complex refractive index n + ik of a material at the given wavelengths
+    n = interpolateProperty(Properties["IndexOfRefractionRe"], Wavelengths)
+    if "IndexOfRefractionIm" in Properties:
+        return n + 1j * interpolateProperty(Properties["IndexOfRefractionIm"], Wavelengths)
+    return n + 0j
+
+
+def loadOpticalProperties(yaml_data):
+    # The optical properties use !!python/tuple tags, which safe_load refuses
+    with open(yaml_data["Detector"]["OpticalProperties"], "r") as optical_file:
+        return yaml.load(optical_file, Loader=yaml.FullLoader)
+
+
+def componentMaterials(yaml_data):
+    # Materials on either side of the surface of every component, in order of appearance
+    Materials = []
+    for component in yaml_data["Components"].values():
+        for key in ["Surface", "Inside", "Outside"]:
+            for material in (component or {}).get(key, []):
+                if material not in Materials:
+                    Materials.append(material)
+    return Materials
+
+
+def wavelengthRange(file_paths):
+    # Smallest and largest photon wavelength over all runs
+    low, high = np.inf, -np.inf
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as hdf:
+            for _, _, chunk in iterateChunks(hdf, ["PhotonWavelength"]):
+                if len(chunk["PhotonWavelength"]) > 0:
+                    low = min(low, np.min(chunk["PhotonWavelength"]))
+                    high = max(high, np.max(chunk["PhotonWavelength"]))
+    if high <= low:
+        # Monochromatic runs get a single 1 nm wide bin around their wavelength
+        low, high = low - 0.5, low + 0.5
+    return low, high
+
+
+class SpectralTally:
+    # Counts of photons per (group, flag), where the group is the wavelength bin or the
+    # (source, wavelength bin) pair. Chunks of photons are added one after the other.
+    def __init__(self, BinEdges, num_sources=1):
+        self.BinEdges = np.asarray(BinEdges, dtype=float)
+        self.num_bins = len(self.BinEdges) - 1
+        self.num_sources = num_sources
+        self.Keys = np.zeros(0, dtype=np.uint64)
+        self.Counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, Wavelengths, Flags, Sources=None):
+        Bins = np.searchsorted(self.BinEdges, Wavelengths, side='right') - 1
+        # The last edge belongs to the last bin, like in np.histogram
+        Bins[Wavelengths == self.BinEdges[-1]] = self.num_bins - 1
+        Inside = (Bins >= 0) & (Bins < self.num_bins)
+        Groups = Bins if Sources is None else Sources * self.num_bins + Bins
+        Keys = (Groups[Inside].astype(np.uint64) << np.uint64(32)) | Flags[Inside].astype(np.uint64)
+
+        # Merge the distinct keys of the chunk with those seen so far
+        Keys, Counts = np.unique(Keys, return_counts=True)
+        Keys, inverse = np.unique(np.concatenate([self.Keys, Keys]), return_inverse=True)
+        self.Counts = np.bincount(inverse, weights=np.concatenate([self.Counts, Counts]), minlength=len(Keys)).astype(np.int64)
+        self.Keys = Keys
+
+    def table(self):
+        # One row per group with the counts, fractions and their binomial errors
+        num_groups = self.num_sources * self.num_bins
+        Groups = (self.Keys >> np.uint64(32)).astype(np.int64)
+        Flags = (self.Keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+        def count(Selected):
+            return np.bincount(Groups, weights=self.Counts * Selected, minlength=num_groups).astype(np.int64)
+
+        NumPhotons = count(np.ones(len(Flags), dtype=bool))
+        NumDetected = count((Flags & SURFACE_DETECT) != 0)
+        NumReflected = count(Flags == SURFACE_DETECT | REFLECT_SPECULAR)
+
+        Bins = np.arange(num_groups) % self.num_bins
+        Table = pd.DataFrame()
+        if self.num_sources > 1:
+            Table["Source"] = np.arange(num_groups) // self.num_bins
+        Table["WavelengthLow"] = self.BinEdges[Bins]
+        Table["WavelengthHigh"] = self.BinEdges[Bins + 1]
+        Table["Wavelength"] = (self.BinEdges[Bins] + self.BinEdges[Bins + 1]) / 2
+        Table["NumPhotons"] = NumPhotons
+        BitCounts = {bit: count((Flags & (1 << bit)) != 0) for bit in FlagBits}
+        return addFractions(Table, NumDetected, NumReflected, BitCounts)
+
+
+def addFractions(Table, NumDetected, NumReflected, BitCounts):
+    # Counts, fractions and bounds of their binomial (Clopper-Pearson) interval for every row,
+    # from the counts of photons that were detected, reflected and that have each flag bit
+    NumPhotons = Table["NumPhotons"].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, count_name, Passed in [("Detection", "NumDetected", NumDetected), ("Reflectivity", "NumReflected", NumReflected)]:
+            Table[count_name] = Passed
+            Table[name] = Passed / NumPhotons
+            Lower, Upper = binomialInterval(Passed, np.maximum(NumPhotons, 1))
+            Table[name + "Lower"] = np.where(NumPhotons > 0, Lower, np.nan)
+            Table[name + "Upper"] = np.where(NumPhotons > 0, Upper, np.nan)
+        for bit in FlagBits:
+            Table[FlagDescriptions[bit]] = BitCounts[bit] / NumPhotons
+    return Table
+
+
+def analyzeSpectrum(file_paths, num_bins, wavelength_range=None, by_source=False, prefetch_depth=4):
+    # Table of detection, reflectivity and flag fractions per wavelength bin over all runs.
+    # With by_source, the sources (same index in every run) are kept apart.
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    if wavelength_range is None:
+        wavelength_range = wavelengthRange(file_paths)
+    BinEdges = np.linspace(wavelength_range[0], wavelength_range[1], num_bins + 1)
+
+    # Offsets of the sources in every run
+    Offsets = dict()
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as hdf:
+            Offsets[file_path] = photonSourceOffsets(hdf, len(getDataset(hdf, "Flags"))) if by_source else None
+    tally = SpectralTally(BinEdges, max(len(Offsets[file_path]) - 1 for file_path in file_paths) if by_source else 1)
+
+    # The next chunks are read while the current one is tallied
+    loader = PrefetchLoader(file_paths, ["PhotonWavelength", "Flags"], depth=prefetch_depth)
+    for file_path, start, stop, chunk in loader:
+        Sources = np.searchsorted(Offsets[file_path], np.arange(start, stop), side='right') - 1 if by_source else None
+        tally.add(chunk["PhotonWavelength"], chunk["Flags"], Sources)
+    return tally.table()
+
+
+def joinOpticalProperties(Table, OpticalProperties, materials, properties=None):
+    # Adds the value of the optical properties of the materials at the center of every
+    # wavelength bin, as columns named "<material> <property>"
+    for material in materials:
+        for key, Value in OpticalProperties[material].items():
+            if properties is None or key in properties:
+                Table[f"{material} {key}"] = interpolateProperty(Value, Table["Wavelength"])
+    return Table
+
+
+def addTheoryReflectivity(Table, AOI, OpticalProperties, outside, surface):
+    # Average s and p Fresnel reflectivity of every row of a per-source table, going from
+    # the outside material into the surface at the angle of incidence of the row's source
+    Wavelengths = Table["Wavelength"].to_numpy()
+    n1 = complexIndex(OpticalProperties[outside], Wavelengths)
+    n2 = complexIndex(OpticalProperties[surface], Wavelengths)
+    R_s, R_p = fresnelReflectivity(np.asarray(AOI)[Table["Source"].to_numpy()], n1, n2)
+    Table["AOI"] = np.asarray(AOI)[Table["Source"].to_numpy()]
+    Table["TheoryReflectivity"] = (R_s + R_p) / 2
+    return Table
+
+
+def perWavelength(Table):
+    # Sums a per-source table over the sources, averaging the theory over the photons simulated.
+    # The flag fractions are turned back into counts to be summed, and the fractions and their
+    # intervals are computed again from the summed counts.
+    BitNames = [FlagDescriptions[bit] for bit in FlagBits]
+    Counts = Table[["WavelengthLow", "WavelengthHigh", "Wavelength", "NumPhotons", "NumDetected", "NumReflected"]].copy()
+    for name in BitNames:
+        Counts[name] = np.rint(Table[name].fillna(0) * Table["NumPhotons"]).astype(np.int64)
+    Counts["WeightedTheory"] = Table["TheoryReflectivity"] * Table["NumPhotons"]
+    Summed = Counts.groupby(["WavelengthLow", "WavelengthHigh", "Wavelength"], as_index=False).sum()
+
+    Summed = addFractions(Summed, Summed["NumDetected"].to_numpy(), Summed["NumReflected"].to_numpy(),
+                          {bit: Summed.pop(FlagDescriptions[bit]).to_numpy() for bit in FlagBits})
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Summed["TheoryReflectivity"] = Summed.pop("WeightedTheory") / Summed["NumPhotons"]
+    # Same columns, in the same order, as the per-source table, without the per-source ones
+    return Summed[[column for column in Table.columns if column in Summed.columns]]
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {"--yaml": None, "--csv": None}
+    for option in list(options):
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+
+    if len(arguments) < 2:
+        print("Please provide a number of bins and at least one file path as arguments.")
+    else:
+        num_bins = int(arguments[0])
+        file_paths = arguments[1:]
+
+        yaml_data = None
+        HasSheet = False
+        if options["--yaml"] is not None:
+            with open(options["--yaml"], "r") as yaml_file:
+                yaml_data = yaml.load(yaml_file, Loader=yaml.FullLoader)
+            HasSheet = "Sheet" in yaml_data["Components"]
+
+        Table = analyzeSpectrum(file_paths, num_bins, by_source=HasSheet)
+        if yaml_data is not None:
+            OpticalProperties = loadOpticalProperties(yaml_data)
+            if HasSheet:
+                # Sources share their index across runs, the run with the most of them has every origin
+                Origin = np.zeros((0, 3))
+                for file_path in file_paths:
+                    with h5py.File(file_path, 'r') as hdf:
+                        if len(getDataset(hdf, "Origin")) > len(Origin):
+                            Origin = getDataset(hdf, "Origin")[:]
+                try:
+                    AOI = sheetAOI(Origin, Geometry.fromYAML(yaml_data, components=["Sheet"]))
+                except FileNotFoundError:
+                    print("Sheet STL not found, assuming the ReflectivityStudy geometry to compute angles of incidence.")
+                    AOI = getAOI(Origin)
+                Sheet = yaml_data["Components"]["Sheet"]
+                Table = addTheoryReflectivity(Table, AOI, OpticalProperties, Sheet["Outside"][0], Sheet["Surface"][0])
+                Table = perWavelength(Table)
+            Table = joinOpticalProperties(Table, OpticalProperties, componentMaterials(yaml_data))
+
+        Table = Table[Table["NumPhotons"] > 0]
+        with pd.option_context("display.max_columns", None, "display.width", 200):
+            print(Table.to_string(index=False, float_format=lambda value: f"{value:.4g}"))
+        if options["--csv"] is not None:
+            Table.to_csv(options["--csv"], index=False)
+            print(f"Table written to '{options['--csv']}'.")
@@ -0,0 +1,371 @@
+import numpy as np
+import h5py
+import os
+import sys
+import yaml
+from scipy.spatial import cKDTree
+from stl import mesh
+
+from simulationData import readDataset
+
+'''
+Loads the detector geometry (the STL files of the components listed in a YAML card) and
+answers geometric questions about photons in vectorized batches:
+  - which triangle (and therefore which component) a point such as a FinalPosition or a
+    DetectedPos lies on, using a KD-tree spatial index;
+  - where rays, such as the beam of each source, first hit a component;
+  - the angle of incidence of a photon on the triangle it hit.
+
+The KD-tree is built over sample points spread over every triangle (large triangles are
+subdivided so that samples are at most max_spacing apart, the spacing being widened when
+needed to keep the index within sample_budget points).
+A query looks up the few nearest samples and computes the exact point-to-triangle distance
+to their triangles, so the nearest triangle is found without looping over the mesh. Points
+far from every surface (many sample spacings away) may get a close but not the closest triangle.
+Rays use the same index: points are laid every sample spacing along each ray, and only the
+triangles of the samples around them are tested for an intersection. Components made of a
+few triangles, such as the Sheet of a reflectivity study, skip the index and every ray is
+tested against all of their triangles at once.
+
+Intended use case: python3 stlGeometry.py <YAML> <PATH>
+prints which components the photons of a simulation ended on, and the component and angle
+of incidence of the beam of each source, assuming lasers pointed at the origin of the
+detector as mountedLaser does.
+'''
+
+def componentDirectory(yaml_data):
+    # Directory holding the STL files, with [ChromaPath] substituted if the card defines it
+    PathToDetector = yaml_data["Detector"]["PathToDetector"]
+    if "ChromaPath" in yaml_data:
+        return yaml_data["ChromaPath"].join(PathToDetector.split("[ChromaPath]"))
+    return PathToDetector
+
+
+class Geometry:
+    def __init__(self, Names, Triangles, Components, max_spacing=2.0, sample_budget=2000000):
+        # Names: component names, Triangles: (T, 3, 3) vertices, Components: (T,) index in Names
+        self.Names = list(Names)
+        self.Triangles = np.asarray(Triangles, dtype=np.float64)
+        self.Components = np.asarray(Components)
+
+        Edge1 = self.Triangles[:, 1] - self.Triangles[:, 0]
+        Edge2 = self.Triangles[:, 2] - self.Triangles[:, 0]
+        Normals = np.cross(Edge1, Edge2)
+        Norms = np.linalg.norm(Normals, axis=1, keepdims=True)
+        self.Normals = Normals / np.where(Norms > 0, Norms, 1)
+
+        self.max_spacing = max_spacing
+        self.sample_budget = sample_budget
+        self._buildIndex()
+
+    @classmethod
+    def fromYAML(cls, yaml_data, components=None, max_spacing=2.0):
+        # Loads every STL listed under Components in the YAML card (or only those in components)
+        directory = componentDirectory(yaml_data)
+        Names = []
+        Triangles = []
+        for name in yaml_data["Components"]:
+            if components is not None and name not in components:
+                continue
+            stl_file = os.path.join(directory, name + ".stl")
+            if not os.path.exists(stl_file):
+                continue
+            Triangles.append(mesh.Mesh.from_file(stl_file).vectors)
+            Names.append(name)
+        if len(Names) == 0:
+            raise FileNotFoundError(f"No component STL files found in '{directory}'")
+        Components = np.concatenate([np.full(len(vectors), index) for index, vectors in enumerate(Triangles)])
+        return cls(Names, np.concatenate(Triangles), Components, max_spacing)
+
+    @classmethod
+    def fromYAMLFile(cls, yaml_card, components=None, max_spacing=2.0):
+        with open(yaml_card, "r") as yaml_file:
+            yaml_data = yaml.safe_load(yaml_file)
+        return cls.fromYAML(yaml_data, components, max_spacing)
+
+    def _buildIndex(self):
+        # Triangles are split into n x n sub-triangles, n chosen from the longest edge, and the
+        # centroid of every sub-triangle becomes a sample point of the KD-tree
+        Longest = np.max(np.linalg.norm(self.Triangles - np.roll(self.Triangles, 1, axis=1), axis=2), axis=1)
+        # A triangle split n times along its longest edge gives n^2 samples
+        spacing = max(self.max_spacing, np.sqrt(np.sum(Longest ** 2) / self.sample_budget))
+        Subdivisions = np.maximum(np.ceil(Longest / spacing), 1).astype(int)
+        # Every point of a triangle is within spacing of one of its samples
+        self.spacing = spacing
+
+        Samples = []
+        SampleTriangles = []
+        for n in np.unique(Subdivisions):
+            Selected = np.flatnonzero(Subdivisions == n)
+            # Barycentric coordinates of the centroids of the n^2 sub-triangles
+            i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+            Upright = i + j < n
+            Weights = [np.stack([i[Upright] + 1 / 3, j[Upright] + 1 / 3], axis=1)]
+            Inverted = i + j < n - 1
+            Weights.append(np.stack([i[Inverted] + 2 / 3, j[Inverted] + 2 / 3], axis=1))
+            Weights = np.concatenate(Weights) / n
+            Barycentric = np.column_stack([1 - Weights.sum(axis=1), Weights])
+
+            Points = np.einsum('sv,tvd->tsd', Barycentric, self.Triangles[Selected])
+            Samples.append(Points.reshape(-1, 3))
+            SampleTriangles.append(np.repeat(Selected, len(Barycentric)))
+
+        self.SampleTriangles = np.concatenate(SampleTriangles)
+        self.Tree = cKDTree(np.concatenate(Samples))
+
+    def nearestTriangles(self, Points, k=8, surface_tolerance=1e-2, batch_size=1 << 20):
+        # Index of the triangle closest to each point and the distance to it.
+        # Photons end on surfaces, so the triangle of the single nearest sample is tried first
+        # and kept when the point lies on it (within surface_tolerance, in mm). Only the other
+        # points go through the exact search over the triangles of the k nearest samples.
+        Points = np.asarray(Points, dtype=np.float64)
+        TriangleIDs = np.empty(len(Points), dtype=np.int64)
+        Distances = np.empty(len(Points))
+        k = min(k, self.Tree.n)
+
+        for start in range(0, len(Points), batch_size):
+            Batch = Points[start:start + batch_size]
+            _, Nearest = self.Tree.query(Batch, k=1, workers=-1)
+            BatchTriangles = self.SampleTriangles[Nearest]
+            BatchDistances = pointTriangleDistances(Batch, self.Triangles[BatchTriangles])
+
+            OffSurface = np.flatnonzero(BatchDistances > surface_tolerance)
+            if len(OffSurface) > 0 and k > 1:
+                _, Neighbours = self.Tree.query(Batch[OffSurface], k=k, workers=-1)
+                Candidates = self.SampleTriangles[Neighbours]
+                CandidateDistances = pointTriangleDistances(Batch[OffSurface, None, :], self.Triangles[Candidates])
+                Best = np.argmin(CandidateDistances, axis=1)
+                Rows = np.arange(len(OffSurface))
+                BatchTriangles[OffSurface] = Candidates[Rows, Best]
+                BatchDistances[OffSurface] = CandidateDistances[Rows, Best]
+
+            TriangleIDs[start:start + batch_size] = BatchTriangles
+            Distances[start:start + batch_size] = BatchDistances
+
+        return TriangleIDs, Distances
+
+    def nearestComponents(self, Points, **kwargs):
+        # Index (in self.Names) of the component each point lies on
+        TriangleIDs, Distances = self.nearestTriangles(Points, **kwargs)
+        return self.Components[TriangleIDs], TriangleIDs, Distances
+
+    def incidenceAngles(self, Directions, TriangleIDs):
+        # Angle (in degrees) between each direction and the normal of the triangle it hit.
+        # STL normals may point either way, so the angle is folded into [0, 90].
+        Directions = np.asarray(Directions, dtype=np.float64)
+        Directions = Directions / np.linalg.norm(Directions, axis=1, keepdims=True)
+        Cosines = np.abs(np.einsum('pd,pd->p', Directions, self.Normals[TriangleIDs]))
+        return np.degrees(np.arccos(np.clip(Cosines, 0, 1)))
+
+    def marchRays(self, Origins, Directions, Triangles):
+        # Points every sample spacing along each ray (unit directions), over the part of the
+        # ray inside the bounding box of the triangles. Returns their ray, distance and position.
+        Low = Triangles.reshape(-1, 3).min(axis=0) - self.spacing
+        High = Triangles.reshape(-1, 3).max(axis=0) + self.spacing
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1 = (Low - Origins) / Directions
+            t2 = (High - Origins) / Directions
+        # Rays parallel to a slab are inside it everywhere or nowhere
+        Inside = (Origins >= Low) & (Origins <= High)
+        Parallel = Directions == 0
+        t1 = np.where(Parallel, np.where(Inside, -np.inf, np.inf), t1)
+        t2 = np.where(Parallel, np.where(Inside, np.inf, -np.inf), t2)
+        Near = np.maximum(np.max(np.minimum(t1, t2), axis=1), 0)
+        Far = np.min(np.maximum(t1, t2), axis=1)
+
+        Steps = np.where(Far >= Near, np.floor((Far - Near) / self.spacing).astype(np.int64) + 1, 0)
+        Rays = np.repeat(np.arange(len(Origins)), Steps)
+        Step = np.arange(len(Rays)) - np.repeat(np.cumsum(Steps) - Steps, Steps)
+        t = Near[Rays] + Step * self.spacing
+        return Rays, t, Origins[Rays] + t[:, None] * Directions[Rays]
+
+    def castRays(self, Origins, Directions, component=None, nearest_fallback=False, batch_size=1 << 12,
+                 direct_triangles=1024, pair_budget=1 << 16):
+        # First triangle hit by each ray (Moller-Trumbore), optionally only considering one
+        # component. Returns the triangle indices (-1 for misses) and the distances along the
+        # rays. Only the triangles of the samples near the points laid along each ray are tested,
+        # unless there are at most direct_triangles of them: those are tested against every ray,
+        # about pair_budget ray-triangle pairs at a time.
+        # With nearest_fallback, rays that hit nothing get the triangle passing closest to them.
+        Origins = np.asarray(Origins, dtype=np.float64)
+        Directions = np.asarray(Directions, dtype=np.float64)
+        Lengths = np.linalg.norm(Directions, axis=1)
+        Units = Directions / np.where(Lengths > 0, Lengths, 1)[:, None]
+        Allowed = np.ones(len(self.Triangles), dtype=bool)
+        if component is not None:
+            Allowed = self.Components == self.Names.index(component)
+
+        TriangleIDs = np.full(len(Origins), -1)
+        Distances = np.full(len(Origins), np.inf)
+        AllowedIDs = np.flatnonzero(Allowed)
+        if 0 < len(AllowedIDs) <= direct_triangles:
+            Candidates = self.Triangles[AllowedIDs][None]
+            rays_per_batch = max(pair_budget // len(AllowedIDs), 1)
+            for start in range(0, len(Origins), rays_per_batch):
+                stop = start + rays_per_batch
+                t = rayTriangleDistances(Origins[start:stop, None, :], Units[start:stop, None, :], Candidates)
+                Best = np.argmin(t, axis=1)
+                Closest = t[np.arange(len(t)), Best]
+                TriangleIDs[start:stop] = np.where(np.isfinite(Closest), AllowedIDs[Best], -1)
+                Distances[start:stop] = Closest
+
+        # A hit is within half a step of a point along the ray, and within spacing of a sample
+        radius = 1.5 * self.spacing
+        for start in range(0, len(Origins) if len(AllowedIDs) > direct_triangles else 0, batch_size):
+            BatchOrigins, BatchUnits = Origins[start:start + batch_size], Units[start:start + batch_size]
+            Rays, _, Points = self.marchRays(BatchOrigins, BatchUnits, self.Triangles[Allowed])
+            Neighbours = self.Tree.query_ball_point(Points, radius, workers=-1)
+            Counts = np.array([len(samples) for samples in Neighbours], dtype=np.int64)
+            if np.sum(Counts) == 0:
+                continue
+            PairRays = np.repeat(Rays, Counts)
+            PairTriangles = self.SampleTriangles[np.concatenate(Neighbours).astype(np.int64)]
+            Keep = Allowed[PairTriangles]
+            Pairs = np.unique(PairRays[Keep] * len(self.Triangles) + PairTriangles[Keep])
+            PairRays, PairTriangles = Pairs // len(self.Triangles), Pairs % len(self.Triangles)
+
+            t = rayTriangleDistances(BatchOrigins[PairRays], BatchUnits[PairRays], self.Triangles[PairTriangles])
+            Closest = np.full(len(BatchOrigins), np.inf)
+            np.minimum.at(Closest, PairRays, t)
+            Best = np.isfinite(t) & (t == Closest[PairRays])
+            BatchTriangles = np.full(len(BatchOrigins), -1)
+            BatchTriangles[PairRays[Best]] = PairTriangles[Best]
+            TriangleIDs[start:start + batch_size] = BatchTriangles
+            Distances[start:start + batch_size] = Closest
+
+        Missed = np.flatnonzero(TriangleIDs < 0)
+        if nearest_fallback and len(Missed) > 0:
+            TriangleIDs[Missed], Distances[Missed] = self.nearestAlongRays(Origins[Missed], Units[Missed], Allowed)
+            print(f"{len(Missed)} of {len(Origins)} rays hit no triangle{'' if component is None else f' of {component}'}, "
+                  f"the triangle passing closest to them was used for {np.sum(TriangleIDs[Missed] >= 0)} of them.")
+        return TriangleIDs, Distances / np.where(Lengths > 0, Lengths, 1)
+
+    def nearestAlongRays(self, Origins, Units, Allowed, k=16):
+        # Allowed triangle passing closest to each ray, with the distance along the ray of the
+        # closest approach (-1 and inf when no allowed triangle is near the ray)
+        TriangleIDs = np.full(len(Origins), -1)
+        Distances = np.full(len(Origins), np.inf)
+        Rays, t, Points = self.marchRays(Origins, Units, self.Triangles[Allowed])
+        if len(Rays) == 0:
+            return TriangleIDs, Distances
+        k = min(k, self.Tree.n)
+        Gaps, Neighbours = self.Tree.query(Points, k=k, workers=-1)
+        Gaps, Neighbours = Gaps.reshape(len(Points), k), Neighbours.reshape(len(Points), k)
+        Candidates = self.SampleTriangles[np.minimum(Neighbours, len(self.SampleTriangles) - 1)]
+        Gaps = np.where(Allowed[Candidates] & (Neighbours < len(self.SampleTriangles)), Gaps, np.inf)
+        Best = np.argmin(Gaps, axis=1)
+        Gaps = Gaps[np.arange(len(Points)), Best]
+        Closest = np.full(len(Origins), np.inf)
+        np.minimum.at(Closest, Rays, Gaps)
+        Found = np.isfinite(Gaps) & (Gaps == Closest[Rays])
+        TriangleIDs[Rays[Found]] = Candidates[np.flatnonzero(Found), Best[Found]]
+        Distances[Rays[Found]] = t[Found]
+        return TriangleIDs, Distances
+
+    def rayIncidenceAngles(self, Origins, Directions, component=None):
+        # Angle of incidence of each ray on the first triangle it hits (NaN for misses)
+        TriangleIDs, _ = self.castRays(Origins, Directions, component, nearest_fallback=True)
+        Hit = TriangleIDs >= 0
+        AOI = np.full(len(TriangleIDs), np.nan)
+        AOI[Hit] = self.incidenceAngles(np.asarray(Directions)[Hit], TriangleIDs[Hit])
+        return AOI
+
+
+def pointTriangleDistances(Points, Triangles):
+    # Exact distance from points (..., 3) to triangles (..., 3, 3), broadcasting over the
+    # leading dimensions. Follows the closest point computation of Ericson's Real-Time
+    # Collision Detection, with each Voronoi region of the triangle handled as a mask.
+    A, B, C = Triangles[..., 0, :], Triangles[..., 1, :], Triangles[..., 2, :]
+    AB = B - A
+    AC = C - A
+    AP = Points - A
+    BP = Points - B
+    CP = Points - C
+
+    def dot(U, V):
+        return np.sum(U * V, axis=-1)
+
+    d1, d2 = dot(AB, AP), dot(AC, AP)
+    d3, d4 = dot(AB, BP), dot(AC, BP)
+    d5, d6 = dot(AB, CP), dot(AC, CP)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Face region by default
+        denominator = va + vb + vc
+        v = vb / denominator
+        w = vc / denominator
+        Closest = A + AB * v[..., None] + AC * w[..., None]
+
+        # Edge regions
+        EdgeBC = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        Closest = np.where(EdgeBC[..., None], B + (C - B) * w[..., None], Closest)
+
+        EdgeAC = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        w = d2 / (d2 - d6)
+        Closest = np.where(EdgeAC[..., None], A + AC * w[..., None], Closest)
+
+        EdgeAB = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = d1 / (d1 - d3)
+        Closest = np.where(EdgeAB[..., None], A + AB * v[..., None], Closest)
+
+    # Vertex regions
+    Closest = np.where(((d6 >= 0) & (d5 <= d6))[..., None], C, Closest)
+    Closest = np.where(((d3 >= 0) & (d4 <= d3))[..., None], B, Closest)
+    Closest = np.where(((d1 <= 0) & (d2 <= 0))[..., None], A, Closest)
+
+    # Degenerate (zero area) triangles fall back to their first vertex
+    Closest = np.where(np.isfinite(Closest), Closest, A)
+    return np.linalg.norm(Points - Closest, axis=-1)
+
+
+def rayTriangleDistances(Origins, Directions, Triangles, epsilon=1e-12, tolerance=1e-9):
+    # Distance along rays (..., 3) to triangles (..., 3, 3), broadcasting over the leading
+    # dimensions, holding inf where the ray misses. Rays landing on an edge shared by two
+    # triangles hit both, thanks to the tolerance on the barycentric coordinates.
+    A = Triangles[..., 0, :]
+    Edge1 = Triangles[..., 1, :] - A
+    Edge2 = Triangles[..., 2, :] - A
+    P = np.cross(Directions, Edge2)
+    Determinant = np.sum(Edge1 * P, axis=-1)
+    Parallel = np.abs(Determinant) < epsilon
+    InverseDeterminant = 1 / np.where(Parallel, 1, Determinant)
+
+    T = Origins - A
+    u = np.sum(T * P, axis=-1) * InverseDeterminant
+    Q = np.cross(T, Edge1)
+    v = np.sum(Directions * Q, axis=-1) * InverseDeterminant
+    t = np.sum(Edge2 * Q, axis=-1) * InverseDeterminant
+
+    Hit = ~Parallel & (u >= -tolerance) & (v >= -tolerance) & (u + v <= 1 + tolerance) & (t > epsilon)
+    return np.where(Hit, t, np.inf)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Please provide a YAML card and a file path as arguments.")
+    else:
+        geometry = Geometry.fromYAMLFile(sys.argv[1])
+        with h5py.File(sys.argv[2], 'r') as hdf:
+            FinalPosition = readDataset(hdf, "FinalPosition")
+            Origin = readDataset(hdf, "Origin")
+
+        Components, _, _ = geometry.nearestComponents(FinalPosition)
+        for index, name in enumerate(geometry.Names):
+            OnComponent = Components == index
+            if np.any(OnComponent):
+                print(f"{name}: {np.sum(OnComponent)} photons ended on it")
+
+        # Reflected photons do not end on the path they came in on, so the angles of incidence
+        # follow the beam of each source rather than the final positions
+        BeamTriangles, _ = geometry.castRays(Origin, -Origin, nearest_fallback=True)
+        Hit = BeamTriangles >= 0
+        AOI = geometry.incidenceAngles(-Origin[Hit], BeamTriangles[Hit])
+        BeamComponents = geometry.Components[BeamTriangles[Hit]]
+        for index, name in enumerate(geometry.Names):
+            OnComponent = BeamComponents == index
+            if np.any(OnComponent):
+                print(f"{name}: hit by {np.sum(OnComponent)} beams, median angle of incidence {np.median(AOI[OnComponent]):.2f} degrees")
@@ -0,0 +1,188 @@
+import numpy as np
+
+from stlGeometry import Geometry
+
+'''
+Maps points on the detector (typically DetectedPos) to the component they landed on and
+unwraps every component into flat 2D panels, so that light maps can be made for any
+geometry described by a YAML card rather than one script per detector.
+
+Each point is assigned to its nearest triangle with the spatial index of stlGeometry, and
+each triangle belongs to a panel of its component. Components are unwrapped in one of two ways:
+  - "cube": every triangle goes to the face its normal points to. The six faces and their
+    in-plane coordinates follow the convention of plotLoLXLightMap (West, Bottom, East,
+    North, South, Top), so the LoLX SiPM cube gives back the usual light map.
+  - "cylinder": the lateral surface is unrolled into (r * theta, position along the axis),
+    as plotDetectedPhotons did for nEXO, and the two end caps become their own panels.
+The unwrapping is chosen from the distribution of the triangle normals: components whose
+normals (nearly) all point along the detector axes are unwrapped as cubes, the others as
+cylinders whose axis is the direction singled out by the normals.
+
+All panels of all components are histogrammed together with a single bincount, so a pass
+over the points costs the same whatever the number of components.
+'''
+
+CubePanels = ['West', 'Bottom', 'East', 'North', 'South', 'Top']
+CylinderPanels = ['Side', 'Bottom cap', 'Top cap']
+
+# Axis and sign of the outward normal of each cube face, in the order of CubePanels
+CubeFaceAxes = [(0, -1), (2, -1), (0, 1), (1, -1), (1, 1), (2, 1)]
+
+
+def cubeCoordinates(Relative, Faces):
+    # In-plane coordinates of points relative to the center of the cube, matching the
+    # orientation of each face in plotLoLXLightMap
+    x, y, z = Relative[:, 0], Relative[:, 1], Relative[:, 2]
+    Options = [
+        (y, z),    # West
+        (y, -x),   # Bottom
+        (-y, z),   # East
+        (-x, z),   # North
+        (z, x),    # South
+        (x, y)     # Top
+    ]
+    u = np.select([Faces == face for face in range(6)], [option[0] for option in Options])
+    v = np.select([Faces == face for face in range(6)], [option[1] for option in Options])
+    return u, v
+
+
+class ComponentUnwrapping:
+    def __init__(self, Triangles, Normals, unwrap=None):
+        Areas = np.linalg.norm(np.cross(Triangles[:, 1] - Triangles[:, 0], Triangles[:, 2] - Triangles[:, 0]), axis=1) / 2
+        Centroids = Triangles.mean(axis=1)
+        TotalArea = max(np.sum(Areas), 1e-30)
+        self.Center = np.sum(Centroids * Areas[:, None], axis=0) / TotalArea
+
+        if unwrap is None:
+            AxisAligned = np.max(np.abs(Normals), axis=1) > 0.98
+            unwrap = "cube" if np.sum(Areas[AxisAligned]) > 0.9 * TotalArea else "cylinder"
+        self.unwrap = unwrap
+
+        Vertices = Triangles.reshape(-1, 3) - self.Center
+        if unwrap == "cube":
+            self.PanelNames = CubePanels
+            # Faces are taken along the detector axes, like the LoLX cube
+            Dominant = np.argmax(np.abs(Normals), axis=1)
+            Side = np.sign(np.take_along_axis(Centroids - self.Center, Dominant[:, None], axis=1)[:, 0])
+            self.TrianglePanels = np.zeros(len(Triangles), dtype=int)
+            for face, (axis, sign) in enumerate(CubeFaceAxes):
+                self.TrianglePanels[(Dominant == axis) & (Side == sign)] = face
+            HalfWidth = np.max(np.abs(Vertices))
+            self.Extents = [(-HalfWidth, HalfWidth, -HalfWidth, HalfWidth)] * len(CubePanels)
+        elif unwrap == "cylinder":
+            self.PanelNames = CylinderPanels
+            # The area-weighted moments of the normals have two equal eigenvalues for the
+            # directions across the axis of a cylinder, the axis is the odd one out
+            Moments = np.einsum('t,ti,tj->ij', Areas, Normals, Normals) / TotalArea
+            Eigenvalues, Eigenvectors = np.linalg.eigh(Moments)
+            self.Axis = Eigenvectors[:, 0] if Eigenvalues[1] - Eigenvalues[0] > Eigenvalues[2] - Eigenvalues[1] else Eigenvectors[:, 2]
+            # Two directions perpendicular to the axis, the first as close as possible to x
+            Reference = np.eye(3)[np.argmin(np.abs(self.Axis))]
+            self.E1 = Reference - np.dot(Reference, self.Axis) * self.Axis
+            self.E1 /= np.linalg.norm(self.E1)
+            self.E2 = np.cross(self.Axis, self.E1)
+
+            AxialNormal = np.abs(Normals @ self.Axis) > 0.7
+            Along = (Centroids - self.Center) @ self.Axis
+            self.TrianglePanels = np.where(AxialNormal, np.where(Along < 0, 1, 2), 0)
+
+            Heights = Vertices @ self.Axis
+            Radii = np.hypot(Vertices @ self.E1, Vertices @ self.E2)
+            LateralVertices = np.repeat(~AxialNormal, 3)
+            self.Radius = np.median(Radii[LateralVertices]) if np.any(LateralVertices) else np.max(Radii)
+            MaxRadius = np.max(Radii)
+            self.Extents = [
+                (-np.pi * self.Radius, np.pi * self.Radius, np.min(Heights), np.max(Heights)),
+                (-MaxRadius, MaxRadius, -MaxRadius, MaxRadius),
+                (-MaxRadius, MaxRadius, -MaxRadius, MaxRadius)
+            ]
+        else:
+            raise ValueError(f"Unknown unwrapping '{unwrap}', use 'cube' or 'cylinder'")
+
+    def coordinates(self, Points, Panels):
+        # 2D coordinates of points on the given panels of this component
+        Relative = Points - self.Center
+        if self.unwrap == "cube":
+            return cubeCoordinates(Relative, Panels)
+        a = Relative @ self.E1
+        b = Relative @ self.E2
+        Heights = Relative @ self.Axis
+        u = np.where(Panels == 0, self.Radius * np.arctan2(b, a), a)
+        v = np.where(Panels == 0, Heights, b)
+        return u, v
+
+
+class SurfaceMap:
+    def __init__(self, geometry, num_bins=350, unwrap=None):
+        # unwrap may be None (chosen per component), "cube", "cylinder" or a dictionary
+        # giving the unwrapping of some components by name
+        self.geometry = geometry
+        self.num_bins = num_bins
+        self.Components = []
+        self.TrianglePanels = np.zeros(len(geometry.Triangles), dtype=int)
+
+        # Panels of all components are numbered consecutively
+        self.PanelOffsets = []
+        offset = 0
+        for index, name in enumerate(geometry.Names):
+            Selected = np.flatnonzero(geometry.Components == index)
+            component_unwrap = unwrap.get(name) if isinstance(unwrap, dict) else unwrap
+            component = ComponentUnwrapping(geometry.Triangles[Selected], geometry.Normals[Selected], component_unwrap)
+            self.Components.append(component)
+            self.TrianglePanels[Selected] = component.TrianglePanels + offset
+            self.PanelOffsets.append(offset)
+            offset += len(component.PanelNames)
+        self.NumPanels = offset
+        self.PanelOffsets = np.array(self.PanelOffsets)
+
+        PanelComponents = np.repeat(np.arange(len(self.Components)), [len(c.PanelNames) for c in self.Components])
+        self.PanelComponents = PanelComponents
+        self.PanelExtents = np.array([extent for component in self.Components for extent in component.Extents])
+
+    @classmethod
+    def fromYAMLFile(cls, yaml_card, components=None, num_bins=350, unwrap=None):
+        return cls(Geometry.fromYAMLFile(yaml_card, components), num_bins, unwrap)
+
+    def unwrapPoints(self, Points, TriangleIDs=None):
+        # Global panel index and 2D coordinates of each point. The triangles the points lie
+        # on are looked up unless they are given.
+        Points = np.asarray(Points, dtype=np.float64)
+        if TriangleIDs is None:
+            TriangleIDs, _ = self.geometry.nearestTriangles(Points)
+        Panels = self.TrianglePanels[TriangleIDs]
+        Components = self.PanelComponents[Panels]
+        u = np.empty(len(Points))
+        v = np.empty(len(Points))
+        for index, component in enumerate(self.Components):
+            OnComponent = np.flatnonzero(Components == index)
+            if len(OnComponent) > 0:
+                u[OnComponent], v[OnComponent] = component.coordinates(Points[OnComponent], Panels[OnComponent] - self.PanelOffsets[index])
+        return Panels, u, v
+
+    def histogram(self, Points, Histograms=None):
+        # Adds the points to the (NumPanels, num_bins, num_bins) histograms of every panel
+        # of every component (created if not given) and returns them
+        if Histograms is None:
+            Histograms = np.zeros((self.NumPanels, self.num_bins, self.num_bins))
+        Panels, u, v = self.unwrapPoints(Points)
+
+        Extents = self.PanelExtents[Panels]
+        Column = np.floor((u - Extents[:, 0]) / (Extents[:, 1] - Extents[:, 0]) * self.num_bins).astype(np.int64)
+        Row = np.floor((v - Extents[:, 2]) / (Extents[:, 3] - Extents[:, 2]) * self.num_bins).astype(np.int64)
+        # Points exactly on the upper edge belong to the last bin, like in np.histogram2d
+        Column[Column == self.num_bins] = self.num_bins - 1
+        Row[Row == self.num_bins] = self.num_bins - 1
+        Inside = (Column >= 0) & (Column < self.num_bins) & (Row >= 0) & (Row < self.num_bins)
+
+        Flat = (Panels[Inside] * self.num_bins + Column[Inside]) * self.num_bins + Row[Inside]
+        Histograms += np.bincount(Flat, minlength=Histograms.size).reshape(Histograms.shape)
+        return Histograms
+
+    def componentHistograms(self, Histograms):
+        # Splits the histograms of all panels into {component name: (panel names, histograms, extents)}
+        Result = dict()
+        for index, (name, component) in enumerate(zip(self.geometry.Names, self.Components)):
+            start = self.PanelOffsets[index]
+            stop = start + len(component.PanelNames)
+            Result[name] = (component.PanelNames, Histograms[start:stop], component.Extents)
+        return Result
@@ -0,0 +1,130 @@
+import numpy as np
+from scipy.stats import beta, poisson
+
+'''
+Statistical uncertainties for the fractions reported by the analysis scripts, such as the
+fraction of photons reflected by each source in reflectivityStudy or the fraction of photons
+detected (overall or in a single light map bin) in plotLoLXLightMap.
+
+Counts of photons out of a known number simulated are binomial, so exact (Clopper-Pearson)
+intervals are computed directly from the beta distribution. The bootstrap functions resample
+the counts of every source or bin at once, as whole arrays with a leading replica axis
+rather than in a Python loop.
+
+For light maps normalized to their brightest bin (plotLoLXLightMap), the bootstrap also
+carries the fluctuation of that maximum, which the binomial band of a bin does not. Bins
+with the same count are resampled from the same distribution, so a replica only needs, for
+every distinct count, one resampled bin and the maximum of the other bins with that count
+(drawn at once from the distribution of the maximum, F(x)^m for m bins). The cost follows
+the number of distinct counts rather than the number of bins, so thousands of replicas of
+a full 6 x 350 x 350 map stay fast.
+
+All functions work element-wise on arrays of any shape, e.g. (NumSources,) or (6, 350, 350).
+
+Intended use case: python3 uncertainty.py
+checks that the bootstrap and the exact binomial widths agree on a simple case.
+'''
+
+# Fraction of a normal distribution within one standard deviation of the mean
+OneSigma = 0.6827
+
+
+def binomialInterval(k, n, confidence=OneSigma):
+    # Exact Clopper-Pearson interval on the fraction k / n. Returns (lower, upper).
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    alpha = 1 - confidence
+
+    # Light maps have hundreds of thousands of bins but only a few distinct counts, so
+    # with a single n the quantiles are only evaluated once per distinct count
+    if n.ndim == 0 and k.size > 1:
+        unique_k, inverse = np.unique(k, return_inverse=True)
+        if len(unique_k) < k.size:
+            lower, upper = binomialInterval(unique_k, n, confidence)
+            return lower[inverse].reshape(k.shape), upper[inverse].reshape(k.shape)
+
+    with np.errstate(invalid='ignore'):
+        lower = np.where(k > 0, beta.ppf(alpha / 2, k, n - k + 1), 0.0)
+        upper = np.where(k < n, beta.ppf(1 - alpha / 2, k + 1, n - k), 1.0)
+    return lower, upper
+
+
+def binomialErrors(k, n, confidence=OneSigma):
+    # Same interval expressed as (lower, upper) distances from k / n, the format
+    # expected by the yerr argument of matplotlib's errorbar
+    fraction = np.asarray(k, dtype=float) / np.asarray(n, dtype=float)
+    lower, upper = binomialInterval(k, n, confidence)
+    return fraction - lower, upper - fraction
+
+
+def bootstrapFractions(k, n, num_replicas=2000, confidence=OneSigma, rng=None):
+    # Bootstrap of the fractions k / n. Resampling the n photons of a source with replacement
+    # and counting those that pass again is the same as drawing from Binomial(n, k / n), so
+    # all replicas of all sources are drawn in one call.
+    # Returns (lower, upper, standard deviation) with the shape of k.
+    rng = np.random.default_rng(rng)
+    k = np.asarray(k)
+    n = np.broadcast_to(np.asarray(n), k.shape)
+    fraction = k / n
+    replicas = rng.binomial(n.astype(np.int64), fraction, size=(num_replicas,) + k.shape) / n
+    alpha = 1 - confidence
+    lower, upper = np.quantile(replicas, [alpha / 2, 1 - alpha / 2], axis=0)
+    return lower, upper, np.std(replicas, axis=0)
+
+
+def bootstrapHistogram(H, num_replicas=2000, normalize=True, batch_size=500, epsilon=1e-12, rng=None):
+    # Bootstrap standard deviation of every bin of a histogram (e.g. a full light map), the
+    # replicas being Poisson resamplings of the counts. With normalize=True each replica is
+    # divided by its own maximum, like the normalized maps drawn by plotLoLXLightMap.
+    rng = np.random.default_rng(rng)
+    H = np.asarray(H)
+    if not normalize:
+        # The standard deviation of a Poisson count is known exactly
+        return np.sqrt(H.astype(float))
+
+    Counts, inverse, Multiplicity = np.unique(H.ravel(), return_inverse=True, return_counts=True)
+    Counts = Counts.astype(float)
+    # Counts whose other bins cannot reach the maximum, but with a probability below epsilon,
+    # never set the maximum of a replica and their maximum is not drawn
+    Lowest = poisson.ppf(epsilon, max(Counts[-1], 1e-300))
+    Relevant = np.flatnonzero((Multiplicity > 1) & (Counts > 0) & (poisson.isf(epsilon / Multiplicity, np.maximum(Counts, 1e-300)) >= Lowest))
+    Sum = np.zeros(len(Counts))
+    SumOfSquares = np.zeros(len(Counts))
+    for start in range(0, num_replicas, batch_size):
+        size = min(batch_size, num_replicas - start)
+        # One resampled bin of every distinct count...
+        Bins = rng.poisson(Counts, size=(size, len(Counts))).astype(float)
+        # ...and the maximum of the other bins with that count, by inverting F(x)^(m - 1)
+        Quantiles = rng.random((size, len(Relevant))) ** (1 / (Multiplicity[Relevant] - 1))
+        Others = poisson.ppf(Quantiles, Counts[Relevant])
+        Maxima = np.maximum(np.max(Bins, axis=1), 1)
+        if len(Relevant) > 0:
+            Maxima = np.maximum(Maxima, np.max(Others, axis=1))
+        Normalized = Bins / Maxima[:, None]
+        Sum += np.sum(Normalized, axis=0)
+        SumOfSquares += np.sum(Normalized ** 2, axis=0)
+
+    Mean = Sum / num_replicas
+    Sigma = np.sqrt(np.maximum(SumOfSquares / num_replicas - Mean ** 2, 0))
+    return Sigma[inverse.ravel()].reshape(H.shape)
+
+
+if __name__ == '__main__':
+    # A fraction of 0.3 out of 1000 photons, for which the bootstrap and the exact interval
+    # should agree to well within a percent of the fraction
+    k, n = np.array([300, 30, 3]), 1000
+    lower, upper = binomialInterval(k, n)
+    boot_lower, boot_upper, boot_sigma = bootstrapFractions(k, n, num_replicas=200000, rng=0)
+    for index in range(len(k)):
+        print(f"k = {k[index]:>4} / {n}: binomial width {upper[index] - lower[index]:.5f}, "
+              f"bootstrap width {boot_upper[index] - boot_lower[index]:.5f}, bootstrap sigma {boot_sigma[index]:.5f}")
+
+    # The fast normalized map bootstrap against brute-force replicas of a small map
+    rng = np.random.default_rng(1)
+    H = rng.poisson(rng.uniform(0, 200, (6, 20, 20)))
+    Replicas = rng.poisson(H, size=(4000,) + H.shape).astype(float)
+    Replicas /= np.maximum(np.max(Replicas, axis=(1, 2, 3), keepdims=True), 1)
+    BruteForce = np.std(Replicas, axis=0)
+    Fast = bootstrapHistogram(H, num_replicas=4000, rng=2)
+    Difference = np.abs(Fast - BruteForce) / np.maximum(BruteForce, 1e-12)
+    print(f"Normalized map: relative difference to brute force {np.median(Difference):.3f} (median), {np.max(Difference):.3f} (largest)")
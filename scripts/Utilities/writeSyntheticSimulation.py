@@ -0,0 +1,112 @@
+import numpy as np
+import h5py
+import sys
+import time
+
+from simulationData import LoLXHalfWidth, NumChannels, SURFACE_DETECT, REFLECT_SPECULAR
+
+'''
+Writes a chroma-like output file filled with synthetic LoLX events, one event at a time.
+
+The file is opened in HDF5 single-writer/multi-reader (SWMR) mode and flushed after every
+event, which makes it a stand-in for a running simulation when testing tools that follow
+a file as it grows (see Plotting/watchSimulation.py). Detected photons land uniformly on
+the six faces of the LoLX cube and are assigned one of the 720 channels.
+
+Intended use case: python3 writeSyntheticSimulation.py <PATH> <NUM_EVENTS> <PHOTONS_PER_EVENT> <DELAY>
+where <DELAY> is the number of seconds to wait between events (0 writes everything at once).
+'''
+
+# Flags drawn for every photon, with their relative probabilities
+SyntheticFlags = np.array([
+    SURFACE_DETECT,
+    SURFACE_DETECT | REFLECT_SPECULAR,
+    1 << 1,  # BULK_ABSORB
+    1 << 3,  # SURFACE_ABSORB
+    1 << 8   # SURFACE_TRANSMIT
+])
+SyntheticFlagProbabilities = np.array([0.3, 0.1, 0.2, 0.3, 0.1])
+
+
+def createDataset(hdf, key, shape, dtype):
+    # Each array lives in a group of the same name, like in chroma's outputs
+    group = hdf.create_group(key)
+    return group.create_dataset(key, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype, chunks=True)
+
+
+def append(dataset, rows):
+    # Events without detected photons append nothing (and dataset[-0:] would be every row)
+    old = len(dataset)
+    dataset.resize(old + len(rows), axis=0)
+    dataset[old:] = rows
+
+
+def pointsOnCube(num_points, rng, Length=LoLXHalfWidth):
+    # Points spread uniformly over the faces of the cube, slightly outside of it
+    face = rng.integers(0, 6, num_points)
+    points = rng.uniform(-Length, Length, (num_points, 3))
+    axis = face % 3
+    sign = np.where(face < 3, -1, 1)
+    points[np.arange(num_points), axis] = sign * (Length + 0.5)
+    return points
+
+
+def writeSyntheticSimulation(file_path, num_events, photons_per_event, delay=0, seed=0):
+    rng = np.random.default_rng(seed)
+
+    with h5py.File(file_path, 'w', libver='latest') as hdf:
+        hdf.attrs["Generator"] = "Synthetic"
+        hdf.attrs["PhotonLocation"] = "Origin"
+        hdf.attrs["NumberOfSources"] = num_events
+        hdf.attrs["NumberOfRuns"] = 1
+
+        datasets = {
+            "Flags": createDataset(hdf, "Flags", (), np.uint32),
+            "PhotonWavelength": createDataset(hdf, "PhotonWavelength", (), np.float32),
+            "FinalPosition": createDataset(hdf, "FinalPosition", (3,), np.float32),
+            "Origin": createDataset(hdf, "Origin", (3,), np.float32),
+            "NumPhotons": createDataset(hdf, "NumPhotons", (), np.int32),
+            "NumDetected": createDataset(hdf, "NumDetected", (), np.int32),
+            "DetectedPos": createDataset(hdf, "DetectedPos", (3,), np.float32),
+            "DetectorHit": createDataset(hdf, "DetectorHit", (), np.int32),
+            "ChannelIDs": createDataset(hdf, "ChannelIDs", (), np.int32),
+            "ChannelCharges": createDataset(hdf, "ChannelCharges", (), np.float32),
+            "NumChannelsHit": createDataset(hdf, "NumChannelsHit", (), np.int32),
+        }
+        hdf.swmr_mode = True
+
+        for event in range(num_events):
+            Flags = rng.choice(SyntheticFlags, photons_per_event, p=SyntheticFlagProbabilities).astype(np.uint32)
+            Detected = (Flags & SURFACE_DETECT) != 0
+            NumDetected = int(np.sum(Detected))
+            FinalPosition = pointsOnCube(photons_per_event, rng)
+            DetectorHit = rng.integers(0, NumChannels, NumDetected)
+            ChannelIDs, ChannelCharges = np.unique(DetectorHit, return_counts=True)
+
+            append(datasets["Flags"], Flags)
+            append(datasets["PhotonWavelength"], rng.normal(175, 5, photons_per_event))
+            append(datasets["FinalPosition"], FinalPosition)
+            append(datasets["Origin"], rng.uniform(-5, 5, (1, 3)))
+            append(datasets["NumPhotons"], [photons_per_event])
+            append(datasets["NumDetected"], [NumDetected])
+            append(datasets["DetectedPos"], FinalPosition[Detected])
+            append(datasets["DetectorHit"], DetectorHit)
+            append(datasets["ChannelIDs"], ChannelIDs)
+            append(datasets["ChannelCharges"], ChannelCharges)
+            append(datasets["NumChannelsHit"], [len(ChannelIDs)])
+            hdf.flush()
+
+            if delay > 0:
+                print(f"Wrote event {event + 1} of {num_events}")
+                time.sleep(delay)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("Please provide a file path, a number of events and a number of photons per event as arguments.")
+    else:
+        file_path = sys.argv[1]
+        num_events = int(sys.argv[2])
+        photons_per_event = int(sys.argv[3])
+        delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+        writeSyntheticSimulation(file_path, num_events, photons_per_event, delay)